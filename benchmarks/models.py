@@ -0,0 +1,141 @@
+import copy
+import time
+import tracemalloc
+import uuid
+
+from src.models import Annotation, Category, Image, Project
+
+N_ANNOTATIONS = 100_000
+ANNOTATIONS_PER_IMAGE = 10
+N_CATEGORIES = 10
+RUNS = 3
+
+
+## Dict-backed models with the deep-copying to_dict they replaced
+class LegacyModel:
+    def __init__(self, id: str | None = None):
+        if id is None:
+            id = str(uuid.uuid4())
+
+        self.id = id
+
+    def to_dict(self):
+        model_dict = copy.deepcopy(vars(self))
+        if 'password' in model_dict:
+            del model_dict['password']
+
+        for k, v in model_dict.items():
+            if isinstance(v, LegacyModel):
+                model_dict[k] = v.to_dict()
+
+            if isinstance(v, list):
+                lst = []
+                for model in v:
+                    if isinstance(model, LegacyModel):
+                        model = model.to_dict()
+
+                    lst.append(model)
+
+                model_dict[k] = lst
+
+        return model_dict
+
+
+class LegacyAnnotation(LegacyModel):
+    def __init__(self, x: float, y: float, width: float, height: float, id: str | None = None) -> None:
+        super().__init__(id=id)
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+class LegacyImage(LegacyModel):
+    def __init__(
+        self,
+        url: str,
+        width: float,
+        height: float,
+        filename: str,
+        digest: str | None = None,
+        variants: list[dict] | None = None,
+        id: str | None = None
+    ) -> None:
+        super().__init__(id=id)
+        self.url = url
+        self.width = width
+        self.height = height
+        self.filename = filename
+        self.digest = digest
+        self.variants = variants or []
+
+
+class LegacyCategory(LegacyModel):
+    def __init__(self, name: str, color: str, id: str | None = None) -> None:
+        super().__init__(id=id)
+        self.name = name
+        self.color = color
+
+
+class LegacyProject(LegacyModel):
+    def __init__(self, name: str, id: str | None = None) -> None:
+        super().__init__(id=id)
+        self.name = name
+
+
+## Measurements
+# The project tree read_project serializes: images with their annotations,
+# each annotation with its category
+def build_project(project_cls, image_cls, annotation_cls, category_cls):
+    categories = [category_cls(f"category-{i}", 'red') for i in range(N_CATEGORIES)]
+    images = []
+    for i in range(N_ANNOTATIONS // ANNOTATIONS_PER_IMAGE):
+        image = image_cls(
+            f"/media/{i}.png",
+            640.0,
+            480.0,
+            f"image-{i}",
+            'd' * 64,
+            [{'size': 128, 'url': f"/media/{i}-128.png", 'width': 128, 'height': 96}]
+        )
+        image.annotations = []
+        for j in range(ANNOTATIONS_PER_IMAGE):
+            annotation = annotation_cls(1.0, 2.0, 3.0, 4.0)
+            annotation.category = categories[j % N_CATEGORIES]
+            image.annotations.append(annotation)
+
+        images.append(image)
+
+    project = project_cls('project')
+    project.categories = categories
+    project.images = images
+
+    return project
+
+
+def measure(label: str, *classes) -> tuple[float, float]:
+    tracemalloc.start()
+    project = build_project(*classes)
+    memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        project.to_dict()
+        timings.append(time.perf_counter() - start)
+
+    print(f"{label:>8}: to_dict {min(timings) * 1000:8.0f} ms   object graph {memory:6.1f} MiB")
+
+    return min(timings), memory
+
+
+def main() -> None:
+    print(f"{N_ANNOTATIONS} annotations on {N_ANNOTATIONS // ANNOTATIONS_PER_IMAGE} images, best of {RUNS}")
+    legacy_time, legacy_memory = measure('dict', LegacyProject, LegacyImage, LegacyAnnotation, LegacyCategory)
+    slots_time, slots_memory = measure('slots', Project, Image, Annotation, Category)
+    print(f"speedup {legacy_time / slots_time:.1f}x, memory saved {legacy_memory - slots_memory:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
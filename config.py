@@ -1,6 +1,7 @@
 import os
 
 from functools import lru_cache
+from typing import Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -10,11 +11,48 @@ class Settings(BaseSettings):
     database_host: str
     database: str
     database_password: str
-    cloudinary_cloud_name: str
-    cloudinary_api_key: str
-    cloudinary_api_secret: str
+    cloudinary_cloud_name: str = ''
+    cloudinary_api_key: str = ''
+    cloudinary_api_secret: str = ''
+    cloudinary_api_url: str = 'https://api.cloudinary.com'
     config: str
     database_uri: str
+    export_concurrency: int = 8
+    http_max_connections: int = 20
+    http_max_keepalive_connections: int = 10
+    http_keepalive_expiry: float = 30.0
+    http_max_in_flight: int = 16
+    http_timeout: float = 30.0
+    http2: bool = False
+    transfer_retries: int = 3
+    transfer_backoff_base: float = 0.5
+    transfer_backoff_max: float = 8.0
+    storage_backend: Literal['cloudinary', 'local', 'fake'] = 'cloudinary'
+    local_storage_dir: str = 'media'
+    local_storage_url: str = '/media'
+    image_cache_dir: str = 'cache/images'
+    image_cache_max_bytes: int = 512 * 1024 * 1024
+    demo_provisioning: Literal['template', 'upload'] = 'template'
+    demo_template_name: str = 'DEMO-TEMPLATE'
+    job_workers: int = 4
+    job_max_attempts: int = 5
+    job_stale_after: float = 300.0
+    job_staging_dir: str = 'staging'
+    image_variant_sizes: list[int] = [128, 1024, 2048]
+    image_processes: int = 2
+    lookup_cache_backend: Literal['memory', 'redis'] = 'memory'
+    lookup_cache_url: str = 'redis://localhost:6379/0'
+    lookup_cache_ttl: float = 30.0
+    lookup_cache_max_entries: int = 10000
+    page_size: int = 50
+    max_page_size: int = 500
+    autosave_flush_interval: float = 0.5
+    autosave_max_pending: int = 500
+    annotation_min_box_size: float = 1.0
+    annotation_snap_to_pixels: bool = False
+    stats_cache_ttl: float = 3600.0
+    stats_cache_max_entries: int = 256
+    metrics_enabled: bool = False
 
     model_config = (
         SettingsConfigDict(env_file='.env')
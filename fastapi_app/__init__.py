@@ -1,9 +1,11 @@
 from config import get_settings
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
-from storage.orm import SQLModel, engine
+from storage.orm import engine
+from storage.migrations import migrate
 from fastapi_app.core.exception_handlers import handle_validation_exception, handle_httpexception
 from fastapi.exceptions import HTTPException, RequestValidationError
 
@@ -11,16 +13,44 @@ settings = get_settings()
 templates = Jinja2Templates(directory='fastapi_app/frontend/templates')
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from utils import http_client, image_processor
+    from fastapi_app.core.jobs import job_queue
+    from fastapi_app.core.dependencies import lookup_cache, stats_cache
+
+    await http_client.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await http_client.close()
+    image_processor.close()
+    for cache in (lookup_cache, stats_cache):
+        if cache is not None:
+            await cache.close()
+
+
 def create_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     from fastapi_app.routers.auth import auth_router
+    from fastapi_app.routers.metrics import metrics_router
+    from fastapi_app.routers.jobs import jobs_router
     app.include_router(auth_router)
+    app.include_router(metrics_router)
+    app.include_router(jobs_router)
     app.mount('/static', StaticFiles(directory='fastapi_app/frontend/static'), name='static')
+    if settings.storage_backend == 'local':
+        # StaticFiles answers with FileResponse, which uses sendfile when the server supports it
+        app.mount(
+            settings.local_storage_url,
+            StaticFiles(directory=settings.local_storage_dir, check_dir=False),
+            name='media'
+        )
     app.add_exception_handler(HTTPException, handle_httpexception)
     # app.add_exception_handler(RequestValidationError, handle_validation_exception)
     app.add_middleware(SessionMiddleware, secret_key=settings.secret_key)
 
-    SQLModel.metadata.create_all(engine)
+    migrate(engine)
 
     return app
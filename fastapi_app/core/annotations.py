@@ -0,0 +1,278 @@
+import asyncio
+import numpy as np
+
+from itertools import chain
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.models import Annotation, Category
+from fastapi_app import settings
+from storage.orm import async_engine
+from storage.repository import (
+    SQLModelAnnotationRepository,
+    SQLModelCategoryRepository,
+    SQLModelImageRepository,
+    SQLModelProjectRepository
+)
+from fastapi_app.core.schemas import AnnotationSchema, AutosaveMessageSchema
+from utils import logger
+
+
+# Pairs each annotation with the id of its category, adding the missing ones
+async def resolve_categories(
+    db: AsyncSession,
+    project_id: str,
+    annotations: dict[str, list[AnnotationSchema]]
+) -> dict[str, list[tuple[Annotation, str]]]:
+    category_repo = SQLModelCategoryRepository(db)
+    category_ids = await category_repo.get_ids_by_name(project_id)
+    resolved = {}
+    for image_id, image_annotations in annotations.items():
+        pairs = []
+        for a in image_annotations:
+            category_name = a.category.name.lower()
+            if category_name not in category_ids:
+                category = Category(category_name, a.category.color)
+                category_ids[category_name] = await category_repo.add(category, project_id)
+
+            annotation = Annotation(a.x, a.y, a.width, a.height, id=a.id)
+            pairs.append((annotation, category_ids[category_name]))
+
+        resolved[image_id] = pairs
+
+    return resolved
+
+
+## Validation
+# Works on one array of every box of a request, rows are x, y, width, height.
+# Boxes are clipped to the size of their image and optionally snapped to whole
+# pixels, those left smaller than min_size or with non-finite values are dropped.
+# Returns the corrected boxes, the mask of kept rows and of the kept rows that changed
+def clip_boxes(
+    boxes: np.ndarray,
+    sizes: np.ndarray,
+    min_size: float,
+    snap: bool = False
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    origin = boxes[:, :2]
+    corner = origin + boxes[:, 2:]
+    # Boxes drawn up or to the left have negative sizes, their corners are swapped
+    start = np.minimum(origin, corner)
+    end = np.maximum(origin, corner)
+    if snap:
+        start, end = np.rint(start), np.rint(end)
+
+    start = np.clip(start, 0, sizes)
+    end = np.clip(end, 0, sizes)
+
+    # Compared by corner, recomputing the size of an untouched box may round it
+    changed = (start != origin).any(axis=1) | (end != corner).any(axis=1)
+    corrected = np.where(changed[:, None], np.concatenate((start, end - start), axis=1), boxes)
+
+    kept = np.isfinite(boxes).all(axis=1) & (corrected[:, 2:] >= min_size).all(axis=1)
+
+    return corrected, kept, changed & kept
+
+
+# Validates the annotations of several images at once against their sizes, the
+# corrections are applied in place and the dropped annotations left out
+def clean_annotations(
+    annotations: dict[str, list[AnnotationSchema]],
+    sizes: dict[str, tuple[float, float]]
+) -> tuple[dict[str, list[AnnotationSchema]], dict[str, list[str]]]:
+    flat = list(chain.from_iterable(annotations.values()))
+    boxes = np.fromiter(
+        chain.from_iterable((a.x, a.y, a.width, a.height) for a in flat),
+        dtype=np.float64,
+        count=4 * len(flat)
+    ).reshape(-1, 4)
+    box_sizes = np.repeat(
+        np.array([sizes[image_id] for image_id in annotations], dtype=np.float64).reshape(-1, 2),
+        [len(image_annotations) for image_annotations in annotations.values()],
+        axis=0
+    )
+
+    corrected, kept, changed = clip_boxes(
+        boxes,
+        box_sizes,
+        settings.annotation_min_box_size,
+        settings.annotation_snap_to_pixels
+    )
+
+    # Only the corrected rows are written back, the common case touches none
+    for i in np.flatnonzero(changed).tolist():
+        a = flat[i]
+        a.x, a.y, a.width, a.height = corrected[i].tolist()
+
+    kept = kept.tolist()
+    cleaned, start = {}, 0
+    for image_id, image_annotations in annotations.items():
+        end = start + len(image_annotations)
+        cleaned[image_id] = [a for a, keep in zip(image_annotations, kept[start:end]) if keep]
+        start = end
+
+    corrections = {
+        'corrected': [flat[i].id for i in np.flatnonzero(changed).tolist()],
+        'dropped': [a.id for a, keep in zip(flat, kept) if not keep]
+    }
+
+    return cleaned, corrections
+
+
+## Autosave
+class AutosaveBuffer:
+    def __init__(self) -> None:
+        # Pending operations by annotation id, (image id, annotation or None
+        # for a delete). A later operation replaces the pending one, so a burst
+        # of moves of a box is written once
+        self._ops = {}
+        self.last_seq = 0
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def put(self, seq: int, image_id: str, annotation: AnnotationSchema) -> None:
+        self._ops[annotation.id] = (image_id, annotation)
+        self.last_seq = max(self.last_seq, seq)
+
+    def delete(self, seq: int, image_id: str, id: str) -> None:
+        self._ops[id] = (image_id, None)
+        self.last_seq = max(self.last_seq, seq)
+
+    def drain(self) -> tuple[dict, int]:
+        ops, self._ops = self._ops, {}
+
+        return ops, self.last_seq
+
+    # Puts back operations that failed to be written, unless newer ones arrived
+    def restore(self, ops: dict) -> None:
+        for id, op in ops.items():
+            self._ops.setdefault(id, op)
+
+
+class AutosaveSession:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        project_id: str,
+        flush_interval: float,
+        max_pending: int
+    ) -> None:
+        self.websocket = websocket
+        self.project_id = project_id
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._buffer = AutosaveBuffer()
+        self._lock = asyncio.Lock()
+
+    async def run(self) -> None:
+        flusher = asyncio.create_task(self._flush_periodically())
+        try:
+            while True:
+                await self._receive(await self.websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # A flush in progress completes before the flusher is stopped
+            async with self._lock:
+                flusher.cancel()
+
+            # Shielded, the handler may be cancelled as the connection goes away
+            await asyncio.shield(self.flush(acknowledge=False))
+
+    async def _receive(self, text: str) -> None:
+        try:
+            message = AutosaveMessageSchema.model_validate_json(text)
+        except ValidationError:
+            await self._send({'type': 'error', 'message': 'Invalid message'})
+            return
+
+        if message.op == 'put' and message.image and message.annotation:
+            self._buffer.put(message.seq, message.image, message.annotation)
+        elif message.op == 'delete' and message.image and message.id:
+            self._buffer.delete(message.seq, message.image, message.id)
+        elif message.op == 'flush':
+            self._buffer.last_seq = max(self._buffer.last_seq, message.seq)
+            await self.flush()
+            return
+        else:
+            await self._send({'type': 'error', 'seq': message.seq, 'message': 'Invalid message'})
+            return
+
+        if len(self._buffer) >= self.max_pending:
+            await self.flush()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if len(self._buffer):
+                await self.flush()
+
+    async def flush(self, acknowledge: bool = True) -> None:
+        async with self._lock:
+            ops, seq = self._buffer.drain()
+            if not ops and not acknowledge:
+                return
+
+            try:
+                result = await self._write(ops)
+            except Exception:
+                logger.exception(f"Autosave of project {self.project_id} failed")
+                self._buffer.restore(ops)
+                if acknowledge:
+                    await self._send({'type': 'error', 'seq': seq, 'message': 'Failed to save changes'})
+
+                return
+
+            if acknowledge:
+                await self._send({'type': 'ack', 'seq': seq, **result})
+
+    async def _write(self, ops: dict) -> dict:
+        upserts, deletes = {}, {}
+        for id, (image_id, annotation) in ops.items():
+            if annotation is None:
+                deletes.setdefault(image_id, []).append(id)
+            else:
+                upserts.setdefault(image_id, []).append(annotation)
+
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            rejected, sizes = [], {}
+            image_ids = upserts.keys() | deletes.keys()
+            if image_ids:
+                # Operations on images outside of the project are dropped
+                sizes = await SQLModelImageRepository(db).get_sizes(list(image_ids), self.project_id)
+                for image_id in image_ids - sizes.keys():
+                    rejected += [a.id for a in upserts.pop(image_id, [])]
+                    rejected += deletes.pop(image_id, [])
+
+            # A box moved out of its image is removed rather than left where it was
+            upserts, corrections = clean_annotations(upserts, sizes)
+            if corrections['dropped']:
+                dropped = set(corrections['dropped'])
+                for id, (image_id, annotation) in ops.items():
+                    if annotation is not None and id in dropped:
+                        deletes.setdefault(image_id, []).append(id)
+
+            resolved = await resolve_categories(db, self.project_id, upserts)
+            result = await SQLModelAnnotationRepository(db).apply_annotation_changes(
+                self.project_id,
+                resolved,
+                deletes
+            )
+            await db.commit()
+
+            revision = await SQLModelProjectRepository(db).get_revision(self.project_id)
+
+        return {
+            **result,
+            **corrections,
+            'rejected': rejected + result['rejected'],
+            'revision': revision
+        }
+
+    async def _send(self, message: dict) -> None:
+        # The receive loop notices a closed socket, sends to it are dropped
+        try:
+            await self.websocket.send_json(message)
+        except (WebSocketDisconnect, RuntimeError):
+            pass
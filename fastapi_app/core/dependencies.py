@@ -1,41 +1,86 @@
 from fastapi import Request, Depends, Path
+from fastapi_app import settings
 from src.models import User, Project
+from storage.cache import LookupCache, MemoryLookupCache, RedisLookupCache
 from storage.repository import SQLModelUserRepsitory, SQLModelProjectRepository
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Annotated, AsyncGenerator
-from storage.orm import engine
+from storage.orm import async_engine
 from fastapi.exceptions import HTTPException
 
 
-async def get_db() -> AsyncGenerator[Session, None]:
-    db = Session(engine)
-    try:
+def create_lookup_cache(max_entries: int, ttl: float) -> LookupCache | None:
+    if ttl <= 0:
+        return None
+
+    if settings.lookup_cache_backend == 'redis':
+        return RedisLookupCache(settings.lookup_cache_url, ttl)
+
+    return MemoryLookupCache(max_entries, ttl)
+
+
+# User and project lookups run on nearly every request, a cached entry lives
+# for at most LOOKUP_CACHE_TTL seconds and is invalidated when the row is removed
+lookup_cache = create_lookup_cache(settings.lookup_cache_max_entries, settings.lookup_cache_ttl)
+# Project statistics are keyed by revision and never go stale, the ttl only
+# lets entries of old revisions expire
+stats_cache = create_lookup_cache(settings.stats_cache_max_entries, settings.stats_cache_ttl)
+
+
+async def invalidate_user(id: str) -> None:
+    if lookup_cache is not None:
+        await lookup_cache.delete(f"user:{id}")
+
+
+async def invalidate_projects(*ids: str) -> None:
+    if lookup_cache is not None and ids:
+        await lookup_cache.delete(*[f"project:{id}" for id in ids])
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
         yield db
-    finally:
-        db.close()
 
 
 async def load_logged_in_user(
     request: Request,
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ) -> User | None:
     user_id = request.session.get('user_id')
     if user_id is None:
         return None
 
+    if lookup_cache is not None:
+        cached = await lookup_cache.get(f"user:{user_id}")
+        if cached is not None:
+            return User(password='', **cached)
+
     user_repo = SQLModelUserRepsitory(db)
+    user = await user_repo.get_by_id(user_id)
 
-    return user_repo.get_by_id(user_id)
+    # The password hash is never cached
+    if user is not None and lookup_cache is not None:
+        await lookup_cache.set(f"user:{user_id}", user.to_dict())
+
+    return user
 
 
 async def fetch_project(
     id: Annotated[str, Path()],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ) -> Project:
-    project = SQLModelProjectRepository(db).get_by_id(id)
+    if lookup_cache is not None:
+        cached = await lookup_cache.get(f"project:{id}")
+        if cached is not None:
+            return Project(**cached)
+
+    project = await SQLModelProjectRepository(db).get_by_id(id)
     if not project:
         raise HTTPException(status_code=404, detail='Invalid project id')
 
+    if lookup_cache is not None:
+        await lookup_cache.set(f"project:{id}", project.to_dict())
+
     return project
 
 
@@ -0,0 +1,250 @@
+import asyncio
+import random
+import shutil
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable
+from fastapi_app import settings
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.models import Job, Image
+from storage.orm import async_engine
+from storage.repository import (
+    SQLModelJobRepository,
+    SQLModelImageRepository,
+    SQLModelProjectRepository,
+    SQLModelStoredObjectRepository
+)
+from utils import ImageUtil, generate_unique_name, logger
+
+JobHandler = Callable[[AsyncSession, Job], Awaitable[dict | None]]
+
+img_util = ImageUtil()
+
+
+# Ends a job as failed without retrying it, keeping the result it got to
+class JobFailed(Exception):
+    def __init__(self, message: str, result: dict | None = None) -> None:
+        super().__init__(message)
+        self.result = result
+
+
+# In-process worker pool over persisted job rows. A job is committed together with
+# the request's own changes and then submitted; jobs still pending or left running
+# by a stopped worker are picked up again on startup, so handlers must be idempotent.
+# A job whose result lists failed items finishes as partial rather than succeeded.
+class JobQueue:
+    def __init__(self, workers: int, max_attempts: int, stale_after: float) -> None:
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self._handlers = {}
+        self._queue = None
+        self._tasks = []
+        self._running = set()
+
+    def handler(self, kind: str) -> Callable[[JobHandler], JobHandler]:
+        def register(func: JobHandler) -> JobHandler:
+            self._handlers[kind] = func
+
+            return func
+
+        return register
+
+    async def add(
+        self,
+        db: AsyncSession,
+        kind: str,
+        payload: dict,
+        owner: str | None = None,
+        total: int = 0,
+        id: str | None = None
+    ) -> str:
+        job = Job(kind=kind, payload=payload, owner=owner, total=total, id=id)
+
+        return await SQLModelJobRepository(db).add(job)
+
+    def submit(self, id: str) -> None:
+        # Without running workers the job stays pending until the next start
+        if self._queue is not None:
+            self._queue.put_nowait(id)
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+
+        async with AsyncSession(async_engine) as db:
+            job_repo = SQLModelJobRepository(db)
+            await job_repo.reset_stale(datetime.now() - timedelta(seconds=self.stale_after))
+            await db.commit()
+
+            for id in await job_repo.list_pending():
+                self.submit(id)
+
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+        # Jobs cut off by the shutdown are run again on the next start
+        if self._running:
+            async with AsyncSession(async_engine) as db:
+                await SQLModelJobRepository(db).reset_running(list(self._running))
+                await db.commit()
+
+            self._running.clear()
+
+    async def _work(self) -> None:
+        while True:
+            id = await self._queue.get()
+            try:
+                await self._run(id)
+            except Exception:
+                logger.exception(f"Job {id} crashed")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, id: str) -> None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as db:
+            job = await SQLModelJobRepository(db).claim(id)
+            await db.commit()
+            if job is None:
+                return
+
+            self._running.add(id)
+            try:
+                await self._execute(db, job)
+            finally:
+                # A job cut off by stop stays listed here and is put back to pending
+                if not asyncio.current_task().cancelling():
+                    self._running.discard(id)
+
+    async def _execute(self, db: AsyncSession, job: Job) -> None:
+        job_repo = SQLModelJobRepository(db)
+        id = job.id
+
+        logger.info(f"Running job {id} ({job.kind}), attempt {job.attempts}")
+        try:
+            result = await self._handlers[job.kind](db, job)
+        except JobFailed as e:
+            await db.rollback()
+            logger.warning(f"Job {id} ({job.kind}) failed: {e}")
+
+            await job_repo.update(id, status='failed', error=str(e), result=e.result)
+            await db.commit()
+
+            return
+        except Exception as e:
+            await db.rollback()
+            logger.warning(f"Job {id} ({job.kind}) failed: {e}")
+
+            if job.attempts < self.max_attempts:
+                await job_repo.update(id, status='pending', error=str(e))
+                await db.commit()
+
+                delay = random.uniform(0, min(60, 2 ** job.attempts))
+                asyncio.get_running_loop().call_later(delay, self.submit, id)
+            else:
+                await job_repo.update(id, status='failed', error=str(e))
+                await db.commit()
+
+            return
+
+        status = 'partial' if result and result.get('failed') else 'succeeded'
+        await job_repo.update(id, status=status, done=job.total, result=result, error=None)
+        await db.commit()
+
+
+job_queue = JobQueue(
+    workers=settings.job_workers,
+    max_attempts=settings.job_max_attempts,
+    stale_after=settings.job_stale_after
+)
+
+
+def stage_files(directory: Path, files: list[tuple]) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, file, _ in files:
+        file.seek(0)
+        with open(directory / name, 'wb') as f:
+            shutil.copyfileobj(file, f)
+
+
+@job_queue.handler('upload_images')
+async def upload_images(db: AsyncSession, job: Job) -> dict:
+    project_id = job.payload['project_id']
+    directory = Path(job.payload['directory'])
+    files = job.payload['files']
+    original_names = {file['name']: file['original'] for file in files}
+    image_ids = {file['name']: file['id'] for file in files}
+
+    job_repo = SQLModelJobRepository(db)
+    project_repo = SQLModelProjectRepository(db)
+    image_repo = SQLModelImageRepository(db)
+    result = job.result or {'images': [], 'failed': []}
+    # Files that failed on an earlier attempt are pending again, failures are counted afresh
+    result['failed'] = []
+
+    if await project_repo.get_by_id(project_id) is None:
+        logger.warning(f"Project {project_id} was removed before its images were uploaded")
+        result['failed'] = [file['original'] for file in files]
+    else:
+        # Images registered by an earlier attempt are not uploaded again
+        registered = await image_repo.get_existing_ids(list(image_ids.values()))
+        pending = [file for file in files if file['id'] not in registered]
+        done = len(files) - len(pending)
+        batch_size = settings.http_max_in_flight
+
+        for i in range(0, len(pending), batch_size):
+            batch = [
+                (file['name'], open(directory / file['name'], 'rb'), file['content_type'])
+                for file in pending[i:i + batch_size]
+            ]
+            try:
+                uploaded_imgs, failed_names = await img_util.store_images(
+                    SQLModelStoredObjectRepository(db),
+                    batch
+                )
+            finally:
+                for _, file, _ in batch:
+                    file.close()
+
+            images = [
+                Image(**uploaded_img, id=image_ids[uploaded_img['filename']])
+                for uploaded_img in uploaded_imgs
+            ]
+            await image_repo.add_many(images, project_id, lambda: generate_unique_name([], 'image'))
+
+            for image in images:
+                img = image.to_dict()
+                img['annotations'] = []
+                result['images'].append(img)
+
+            result['failed'] += [original_names[name] for name in failed_names]
+            done += len(batch)
+
+            # Progress and the images of the batch are committed together
+            await job_repo.update(job.id, done=done, result=result)
+            await db.commit()
+
+    await asyncio.to_thread(shutil.rmtree, directory, ignore_errors=True)
+
+    if files and not result['images']:
+        raise JobFailed('No image could be uploaded', result)
+
+    return result
+
+
+@job_queue.handler('delete_objects')
+async def delete_objects(db: AsyncSession, job: Job) -> None:
+    for folder in job.payload.get('folders', []):
+        await img_util.delete_all(folder)
+
+    # An object released and then stored again before this job ran is kept
+    urls = job.payload.get('urls', [])
+    referenced = await SQLModelStoredObjectRepository(db).get_referenced_urls(urls)
+    await img_util.delete_urls([url for url in urls if url not in referenced])
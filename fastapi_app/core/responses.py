@@ -0,0 +1,68 @@
+import orjson
+import msgpack
+
+from datetime import datetime
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+MSGPACK_MEDIA_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+# MessagePack is only sent to clients that explicitly accept it, JSON otherwise
+def response_format(accept: str | None) -> str:
+    for media_range in (accept or '').split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        if media_type not in MSGPACK_MEDIA_TYPES:
+            continue
+
+        quality = next((param[2:] for param in params if param.startswith('q=')), '1')
+        try:
+            if float(quality) > 0:
+                return 'msgpack'
+        except ValueError:
+            continue
+
+    return 'json'
+
+
+def encode_msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
+
+
+# The payloads are built from plain dicts already, so they are encoded directly
+# instead of being validated and re-encoded through pydantic. The body is
+# rendered when the response is sent, in the format the request accepts.
+class OutputJSON(Response):
+    media_type = 'application/json'
+
+    def __init__(
+        self,
+        data: dict | list | None = None,
+        failed: list[str] | None = None,
+        status: str = 'success',
+        status_code: int = 200,
+        headers: dict[str, str] | None = None
+    ) -> None:
+        self.content = {
+            'status': status,
+            'data': {} if data is None else data,
+            'failed': failed or []
+        }
+        super().__init__(status_code=status_code, headers=headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if response_format(Headers(scope=scope).get('accept')) == 'msgpack':
+            self.body = msgpack.packb(self.content, default=encode_msgpack_default)
+            self.headers['content-type'] = MSGPACK_MEDIA_TYPES[0]
+        else:
+            self.body = orjson.dumps(self.content)
+
+        self.headers['content-length'] = str(len(self.body))
+        if 'accept' not in self.headers.get('vary', '').lower():
+            self.headers.add_vary_header('Accept')
+
+        await super().__call__(scope, receive, send)
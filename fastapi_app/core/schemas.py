@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Literal
 
 
 class UserSchema(BaseModel):
@@ -8,11 +9,6 @@ class UserSchema(BaseModel):
     model_config = {'extra': 'forbid'}
 
 
-class OutputJSON(BaseModel):
-    status: str = 'success'
-    data: dict | list = {}
-
-
 class CategorySchema(BaseModel):
     id: str
     name: str
@@ -26,3 +22,12 @@ class AnnotationSchema(BaseModel):
     width: float
     id: str
     category: CategorySchema
+
+
+# A message of the autosave channel, put adds or moves an annotation of an image
+class AutosaveMessageSchema(BaseModel):
+    op: Literal['put', 'delete', 'flush']
+    seq: int = 0
+    image: str | None = None
+    id: str | None = None
+    annotation: AnnotationSchema | None = None
@@ -0,0 +1,103 @@
+import numpy as np
+
+# Edges of the area histograms, as fractions of the image area
+AREA_BINS = (0.0, 0.0001, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Box areas in pixels separating small, medium and large boxes, as in COCO
+SIZE_CLASSES = (32 ** 2, 96 ** 2)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def summarize(values: np.ndarray) -> dict:
+    if not len(values):
+        return {'mean': None, 'max': None, **{f'p{p}': None for p in PERCENTILES}}
+
+    return {
+        'mean': float(values.mean()),
+        'max': float(values.max()),
+        **dict(zip((f'p{p}' for p in PERCENTILES), np.percentile(values, PERCENTILES).tolist()))
+    }
+
+
+# Rows map to dense image and category indexes once, every statistic after
+# that is an aggregation over whole arrays. Categories of other projects that
+# annotations still point to are listed after the project's own.
+def project_stats(columns: dict[str, list], categories: dict[str, str]) -> dict:
+    referenced = dict(zip(columns['category_id'], columns['category_name']))
+    referenced.pop(None, None)
+    categories = {**categories, **{id: name for id, name in referenced.items() if id not in categories}}
+
+    image_positions, category_positions = {}, {id: i for i, id in enumerate(categories)}
+    image_index = np.fromiter(
+        (image_positions.setdefault(id, len(image_positions)) for id in columns['image_id']),
+        dtype=np.int64,
+        count=len(columns['image_id'])
+    )
+    category_index = np.fromiter(
+        (category_positions.get(id, -1) for id in columns['category_id']),
+        dtype=np.int64,
+        count=len(columns['category_id'])
+    )
+
+    # Images without annotations come as a single row with no annotation
+    boxed = np.fromiter(
+        (id is not None for id in columns['annotation_id']),
+        dtype=bool,
+        count=len(columns['annotation_id'])
+    )
+    image_ids = list(image_positions)
+    n_images, n_categories, n_bins = len(image_ids), len(categories), len(AREA_BINS) - 1
+
+    image_index, category_index = image_index[boxed], category_index[boxed]
+    width = np.array(columns['width'], dtype=np.float64)[boxed]
+    height = np.array(columns['height'], dtype=np.float64)[boxed]
+    area = width * height
+    image_area = (
+        np.array(columns['image_width'], dtype=np.float64)[boxed]
+        * np.array(columns['image_height'], dtype=np.float64)[boxed]
+    )
+    relative_area = np.divide(area, image_area, out=np.zeros_like(area), where=image_area > 0)
+
+    per_image = np.bincount(image_index, minlength=n_images)
+    per_category = np.bincount(category_index, minlength=n_categories)
+    # Each (category, image) pair is counted once
+    images_per_category = np.bincount(
+        np.unique(category_index * n_images + image_index) // max(n_images, 1),
+        minlength=n_categories
+    )
+    area_per_category = np.bincount(category_index, weights=area, minlength=n_categories)
+    histograms = np.bincount(
+        category_index * n_bins + np.digitize(relative_area, AREA_BINS[1:-1]),
+        minlength=n_categories * n_bins
+    ).reshape(n_categories, n_bins)
+    size_classes = np.bincount(np.digitize(area, SIZE_CLASSES), minlength=len(SIZE_CLASSES) + 1)
+
+    return {
+        'images': n_images,
+        'annotations': int(boxed.sum()),
+        'images_without_annotations': [image_ids[i] for i in np.flatnonzero(per_image == 0).tolist()],
+        'annotations_per_image': summarize(per_image),
+        'box_sizes': {
+            'width': summarize(width),
+            'height': summarize(height),
+            'area': summarize(area),
+            **dict(zip(('small', 'medium', 'large'), size_classes.tolist()))
+        },
+        'area_bins': list(AREA_BINS),
+        'categories': [
+            {
+                'id': id,
+                'name': name,
+                'annotations': count,
+                'images': images,
+                'mean_area': area_sum / count if count else None,
+                'area_histogram': histogram
+            }
+            for (id, name), count, images, area_sum, histogram in zip(
+                categories.items(),
+                per_category.tolist(),
+                images_per_category.tolist(),
+                area_per_category.tolist(),
+                histograms.tolist()
+            )
+        ]
+    }
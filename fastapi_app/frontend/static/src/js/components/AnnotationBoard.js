@@ -5,7 +5,7 @@ import { ImageList } from './ImageList.js';
 import { Annotator } from './Annotator.js';
 import { AnnotationList } from './AnnotationList.js';
 import { Form } from './Form.js';
-import { saveAnnotation, ColorSelector } from '../utils.js';
+import { saveAnnotations, waitForJob, fetchPages, ColorSelector, AutosaveChannel } from '../utils.js';
 
 import htm from 'https://esm.sh/htm';
 import { h } from 'https://esm.sh/preact';
@@ -38,13 +38,31 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
 
   const [projectToBeDeleted, setProjectToBeDeleted] = useState(null);
 
+  const autosave = useRef(null);
+  // Annotations of each image as the server last had them
+  const saved = useRef({});
+
+  useEffect(() => {
+    if (!projectId) return;
+
+    const channel = new AutosaveChannel(projectId, {
+      onError: (message) => {
+        setError(message);
+        setTimeout(() => setError(''), 3000);
+      }
+    });
+    autosave.current = channel;
+
+    return () => channel.close();
+  }, [projectId]);
+
   useEffect(() => {
     const fetchProject = async (pId) => {
       setLoading(true);
 
       try {
         let data;
-        const res = await fetch(`/projects/${pId}`);
+        const res = await fetch(`/projects/${pId}?images=false`);
 
         if (!res.ok) {
           let error = new Error('Failed to fetch project');
@@ -68,7 +86,12 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
             categories: proj.categories
           });
 
-          setImages(proj.images);
+          // Images arrive page by page, the first page is shown as soon as it is loaded
+          setImages([]);
+          await fetchPages(`/projects/${pId}/images?annotations=true`, 'images', page => {
+            setImages(prev => [...prev, ...page]);
+            setLoading(false);
+          });
         }
       } catch (err) {
         setError(err.message);
@@ -86,30 +109,54 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
   useEffect(() => {
     if (!images) return;
 
-    const imageAnnotations = {};
+    if (!image) setImage(images[0]);
 
-    images.forEach(img => {
-      imageAnnotations[img.id] = img.annotations;
-    });
+    // Unsaved annotations of images already loaded are kept
+    setAnnotations(prev => {
+      const imageAnnotations = {};
 
-    if (!image) setImage(images[0]);
-    setAnnotations(imageAnnotations);
+      images.forEach(img => {
+        imageAnnotations[img.id] = prev && img.id in prev ? prev[img.id] : img.annotations;
+        if (!(img.id in saved.current)) {
+          saved.current[img.id] = img.annotations;
+        }
+      });
+
+      return imageAnnotations;
+    });
   }, [images]);
 
   const handleClear = (e) => {
     if (image) {
+      (annotations[image.id] || []).forEach(a => autosave.current?.remove(image.id, a.id));
       setAnnotations({...annotations, [image.id]: []});
     }
   };
 
-  const handleNext = (e) => {
-    saveAnnotation({
+  // Every image changed since the last save goes in one request
+  const saveChanges = async () => {
+    const changed = {};
+    Object.entries(annotations || {}).forEach(([id, boxes]) => {
+      if (boxes !== saved.current[id]) {
+        changed[id] = boxes;
+      }
+    });
+
+    if (!Object.keys(changed).length) return;
+
+    const ok = await saveAnnotations({
       pId: projectId,
-      imgId: image.id,
-      body: JSON.stringify(annotations[image.id]),
+      annotations: changed,
       setError: setError,
       setSaving: setSaving
     });
+    if (ok) {
+      Object.assign(saved.current, changed);
+    }
+  };
+
+  const handleNext = (e) => {
+    saveChanges();
 
     const index = images.findIndex(img => img.id === image.id);
     const nextImage = index + 1;
@@ -122,13 +169,7 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
   };
 
   const handlePrev = (e) => {
-    saveAnnotation({
-      pId: projectId,
-      imgId: image.id,
-      body: JSON.stringify(annotations[image.id]),
-      setError: setError,
-      setSaving: setSaving
-    });
+    saveChanges();
 
     const index = images.findIndex(img => img.id === image.id);
     const prevImage = index - 1;
@@ -141,23 +182,11 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
   };
 
   const handleSave = (e) => {
-    saveAnnotation({
-      pId: projectId,
-      imgId: image.id,
-      body: JSON.stringify(annotations[image.id]),
-      setError: setError,
-      setSaving: setSaving
-    });
+    saveChanges();
   };
 
-  const handleFinish = (e) => {
-    saveAnnotation({
-      pId: projectId,
-      imgId: image.id,
-      body: JSON.stringify(annotations[image.id]),
-      setError: setError,
-      setSaving: setSaving
-    });
+  const handleFinish = async (e) => {
+    await saveChanges();
 
     window.location.href = '/';
   };
@@ -190,32 +219,14 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
           setLoading(true);
 
           try {
-            let data;
-            const res = await fetch('/projects');
-
-            if (!res.ok) {
-              let error = new Error('Failed to fetch projects');
-
-              if (res.status === 401) {
-                window.location.href = '/signin';
-              }
-              else if (res.status === 404 || res.status === 400) {
-                const data = await res.json();
-                error = new Error(`${data.message}`);
-              }
-
-                throw error;
-            } else {
-              data = await res.json();
-
-              const projs = data.data;
+            await fetchPages('/projects', 'projects', projs => {
               if (projs.length > 0) {
                 projectListTitle.current = 'Your Projects';
                 projs.forEach(proj => {
                   projectList.current.push({id: proj.name, value: proj});
                 });
               }
-            }
+            });
 
             setPopupPos({x, y});
           } catch (err) {
@@ -386,6 +397,11 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
             throw error;
         } else {
           data = await res.json();
+          if (data.data.job) {
+            setSaving('Uploading images...');
+            await waitForJob(data.data.job);
+          }
+
           window.location.href = `/project/${data.data.id}`;
         }
       } catch (err) {
@@ -441,7 +457,12 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
             throw error;
         } else {
           data = await res.json();
-          setImages(prev => [...prev, ...data.data]);
+          const job = await waitForJob(data.data.job);
+          setImages(prev => [...prev, ...job.result.images]);
+
+          if (job.result.failed.length) {
+            throw new Error(`Failed to upload: ${job.result.failed.join(', ')}`);
+          }
         }
       } catch (err) {
         setError(err.message);
@@ -548,7 +569,7 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
           setImages=${setImages}
           image=${image}
           setImage=${setImage}
-          annotations=${annotations}
+          saveChanges=${saveChanges}
           setError=${setError}
           setSaving=${setSaving}
           setAnnotationList=${setAnnotationList}
@@ -557,6 +578,7 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
           image=${image}
           annotations=${annotations}
           setAnnotations=${setAnnotations}
+          autosave=${autosave}
           annotationList=${annotationList}
           setAnnotationList=${setAnnotationList}
         />
@@ -610,6 +632,7 @@ export function AnnotationBoard({ projectId, setError, setLoading, setSaving })
                     setProject=${setProject}
                     annotations=${annotations}
                     setAnnotations=${setAnnotations}
+                    autosave=${autosave}
                   />
                 </div>
               </div>
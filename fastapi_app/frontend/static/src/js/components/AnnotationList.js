@@ -11,6 +11,7 @@ export function AnnotationList({
   image,
   annotations,
   setAnnotations,
+  autosave,
   annotationList,
   setAnnotationList
 }) {
@@ -50,6 +51,8 @@ export function AnnotationList({
 
   const handleAnnotationSelect = (annotatn) => {
     if (annotatn) {
+      autosave.current?.remove(image.id, annotatn.id);
+
       const updatedAnnotations = [...annotations[image.id].filter(a => a.id !== annotatn.id)];
       setAnnotations(prev => ({...prev, [image.id]: updatedAnnotations}));
     }
@@ -1,6 +1,6 @@
 import { InputPopup } from './InputPopup.js';
 import { Popup } from './Popup.js';
-import { ColorSelector, Drawer } from '../utils.js';
+import { ColorSelector, Drawer, imageSource } from '../utils.js';
 
 import htm from 'https://esm.sh/htm';
 import { h } from 'https://esm.sh/preact';
@@ -15,6 +15,7 @@ export function Annotator({
   image,
   annotations,
   setAnnotations,
+  autosave,
 }) {
   const imageAnnotationsRef = useRef([]);
 
@@ -160,6 +161,7 @@ export function Annotator({
 
         imageAnnotationsRef.current.push(annotatn);
         setAnnotations({...annotations, [image.id]: imageAnnotationsRef.current});
+        autosave.current?.put(image.id, annotatn);
       }
     }
 
@@ -193,6 +195,7 @@ export function Annotator({
 
       imageAnnotationsRef.current.push(annotatn);
       setAnnotations({...annotations, [image.id]: imageAnnotationsRef.current});
+      autosave.current?.put(image.id, annotatn);
     }
 
     drawAnnotations(scale.x, scale.y);
@@ -271,7 +274,7 @@ export function Annotator({
       : html`
           <div class="relative" style="width: ${containerWidth}px; height: ${containerHeight}px;">
             <img
-              src=${image.url}
+              src=${imageSource(image, containerWidth, containerHeight)}
               ref=${imageRef}
               alt="annotatable"
               class="absolute top-0 left-0 w-full h-full object-contain z-10"
@@ -23,7 +23,7 @@ export function AuthForm({ title, type, setProcessing, setError }) {
         if (!res.ok) throw new Error('Failed to sign in');
         const data = await res.json();
 
-        window.location.href = `/project/${data.data.id}`;
+        window.location.href = data.data.id ? `/project/${data.data.id}` : '/';
       } catch (err) {
         setError(err.message);
         setTimeout(() => setError(''), 3000);
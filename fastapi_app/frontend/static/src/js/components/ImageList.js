@@ -1,6 +1,5 @@
 import { Menu } from './Menu.js';
 import { Popup } from './Popup.js';
-import { saveAnnotation } from '../utils.js';
 
 import htm from 'https://esm.sh/htm';
 import { h } from 'https://esm.sh/preact';
@@ -14,7 +13,7 @@ export function ImageList({
   setImages,
   image,
   setImage,
-  annotations,
+  saveChanges,
   setError,
   setSaving,
   setAnnotationList
@@ -26,17 +25,15 @@ export function ImageList({
   useEffect(() => {
     if (!image || !images) return;
 
-    setImgs(images.map(img => ({id: img.id, value: img.filename})));
+    setImgs(images.map(img => ({
+      id: img.id,
+      value: img.filename,
+      thumbnail: img.variants?.length ? img.variants[0].url : null
+    })));
   }, [image, images]);
 
   const handleSelectImage = (img, e) => {
-    saveAnnotation({
-      pId: projectId,
-      imgId: image.id,
-      body: JSON.stringify(annotations[image.id]),
-      setError: setError,
-      setSaving: setSaving
-    });
+    saveChanges();
 
     setImage(images.find(i => i.id === img.id));
   };
@@ -57,16 +57,18 @@ export class ColorSelector {
   }
 }
 
-export const saveAnnotation = async ({pId, imgId, body, setError, setSaving }) => {
+// Saves the annotations of several images in one request, annotations maps image ids to their boxes.
+// Resolves to whether the server took them
+export const saveAnnotations = async ({ pId, annotations, setError, setSaving }) => {
   setSaving('Saving...');
 
   try {
-    const res = await fetch(`/projects/${pId}/images/${imgId}/annotations`, {
+    const res = await fetch(`/projects/${pId}/annotations`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json'
       },
-      body: body
+      body: JSON.stringify(annotations)
     });
 
     if (!res.ok) {
@@ -80,12 +82,143 @@ export const saveAnnotation = async ({pId, imgId, body, setError, setSaving }) =
         error = new Error(`${data.message}`);
       }
 
-        throw error;
+      throw error;
     }
+
+    return true;
   } catch (err) {
     setError(err.message);
     setTimeout(() => setError(''), 3000);
+
+    return false;
   } finally {
     setSaving('');
   }
 }
+
+// Follows the cursors of a paginated endpoint, handing every page to onPage
+export const fetchPages = async (url, key, onPage) => {
+  let cursor = null;
+
+  do {
+    const sep = url.includes('?') ? '&' : '?';
+    const res = await fetch(cursor ? `${url}${sep}cursor=${encodeURIComponent(cursor)}` : url);
+
+    if (!res.ok) {
+      let error = new Error('Failed to fetch data');
+
+      if (res.status === 401) {
+        window.location.href = '/signin';
+      }
+      else if (res.status === 404 || res.status === 400) {
+        const data = await res.json();
+        error = new Error(`${data.message}`);
+      }
+
+      throw error;
+    }
+
+    const data = (await res.json()).data;
+    onPage(data[key]);
+    cursor = data.next;
+  } while (cursor);
+}
+
+// Streams annotation puts and deletes of a project over a WebSocket. The server
+// writes them in coalesced batches and acknowledges with the last seq written,
+// operations not acknowledged yet are resent after a reconnect
+export class AutosaveChannel {
+  seq = 0;
+  pending = [];
+  socket = null;
+  closed = false;
+
+  constructor(projectId, { onAck = () => {}, onError = () => {} } = {}) {
+    const protocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
+
+    this.url = `${protocol}://${window.location.host}/projects/${projectId}/autosave`;
+    this.onAck = onAck;
+    this.onError = onError;
+    this._connect();
+  }
+
+  _connect() {
+    this.socket = new WebSocket(this.url);
+
+    this.socket.onopen = () => {
+      this.pending.forEach(op => this.socket.send(JSON.stringify(op)));
+    };
+
+    this.socket.onmessage = (e) => {
+      const message = JSON.parse(e.data);
+
+      if (message.type === 'ack') {
+        this.pending = this.pending.filter(op => op.seq > message.seq);
+        this.onAck(message);
+      } else {
+        this.onError(message.message);
+      }
+    };
+
+    this.socket.onclose = (e) => {
+      // 1008 means the project is not the user's, retrying will not help
+      if (this.closed || e.code === 1008) return;
+
+      setTimeout(() => this._connect(), 1000);
+    };
+  }
+
+  _send(op) {
+    op.seq = ++this.seq;
+    this.pending.push(op);
+
+    if (this.socket.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify(op));
+    }
+  }
+
+  put(imageId, annotation) {
+    this._send({ op: 'put', image: imageId, annotation });
+  }
+
+  remove(imageId, id) {
+    this._send({ op: 'delete', image: imageId, id });
+  }
+
+  close() {
+    this.closed = true;
+    this.socket.close();
+  }
+}
+
+export const waitForJob = async (jobId, interval = 1000) => {
+  while (true) {
+    const res = await fetch(`/jobs/${jobId}`);
+    if (!res.ok) {
+      throw new Error('Failed to fetch job status');
+    }
+
+    // A partial job is returned too, its result lists what failed
+    const job = (await res.json()).data;
+    if (job.status === 'succeeded' || job.status === 'partial') {
+      return job;
+    }
+    else if (job.status === 'failed') {
+      const failed = job.result?.failed || [];
+      throw new Error(failed.length ? `${job.error}: ${failed.join(', ')}` : job.error || 'Job failed');
+    }
+
+    await new Promise(resolve => setTimeout(resolve, interval));
+  }
+}
+
+// Smallest stored level that still fills the given box on this screen, the original otherwise
+export const imageSource = (image, width, height) => {
+  const ratio = window.devicePixelRatio || 1;
+  const scale = Math.min(width / image.width, height / image.height) * ratio;
+  const variant = (image.variants || []).find(v =>
+    v.width >= image.width * scale && v.height >= image.height * scale
+  );
+
+  return variant ? variant.url : image.url;
+}
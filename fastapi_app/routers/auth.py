@@ -1,87 +1,168 @@
 import bcrypt
+import asyncio
+import secrets
 
+from functools import lru_cache
 from typing import Annotated
 from utils import ImageUtil, generate_unique_name
+from storage.cache import close_content
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi_app import templates
-from fastapi_app.core.schemas import UserSchema, OutputJSON
-from sqlmodel import Session
+from fastapi_app import templates, settings
+from fastapi_app.core.schemas import UserSchema
+from fastapi_app.core.responses import OutputJSON
+from sqlmodel.ext.asyncio.session import AsyncSession
 from src.models import User, Project, Category, Image
 from fastapi.exceptions import HTTPException
-from fastapi_app.core.dependencies import load_logged_in_user, get_db
+from fastapi_app.core.dependencies import load_logged_in_user, get_db, invalidate_user, invalidate_projects
+from fastapi_app.core.jobs import job_queue
 from storage.repository import (
     SQLModelUserRepsitory,
     SQLModelImageRepository,
-    SQLModelAnnotationRepository,
     SQLModelProjectRepository,
     SQLModelCategoryRepository,
-    SQLModelDemoRepository
+    SQLModelDemoRepository,
+    SQLModelStoredObjectRepository
 )
 
 auth_router = APIRouter()
 img_util = ImageUtil()
+demo_template_lock = asyncio.Lock()
+
+# Generated ids are uuid4s, so neither of these can belong to anything a user created
+DEMO_TEMPLATE_ID = 'demo-template'
+DEMO_TEMPLATE_OWNER_ID = 'demo-template-owner'
+
+
+async def populate_demo_project(db: AsyncSession, project_id: str) -> list[str]:
+    # Handle Categories (classes)
+    categories = [
+        ('car', 'purple'),
+        ('bus', 'brown'),
+        ('van', 'blue')
+    ]
+
+    for name, color in categories:
+        category = Category(name=name, color=color)
+        _ = await SQLModelCategoryRepository(db).add(category, project_id)
+
+    # Upload Images
+    demo_images_urls = await SQLModelDemoRepository(db).get_image_urls()
+    images, failed = await img_util.fetch_images(demo_images_urls)
+
+    files = []
+    image_names = set()
+
+    for img in images.values():
+        image_name = generate_unique_name(image_names, 'image')
+        image_names.add(image_name)
+        files.append((
+            image_name,
+            img,
+            "application/octet-stream"
+        ))
+
+    try:
+        uploaded_imgs, failed_names = await img_util.store_images(
+            SQLModelStoredObjectRepository(db),
+            files
+        )
+    finally:
+        for content in images.values():
+            close_content(content)
+
+    if demo_images_urls and not uploaded_imgs:
+        raise HTTPException(status_code=500, detail='Network Error')
+
+    failed += failed_names
+    images = [Image(**uploaded_img) for uploaded_img in uploaded_imgs]
+    await SQLModelImageRepository(db).add_many(images, project_id, lambda: generate_unique_name([], 'image'))
+
+    return failed
+
+
+async def get_demo_template(db: AsyncSession) -> str:
+    project_repo = SQLModelProjectRepository(db)
+    if await project_repo.get_by_id(DEMO_TEMPLATE_ID):
+        return DEMO_TEMPLATE_ID
+
+    # Built once, on the first demo signin; the lock only spares the other requests of this process
+    async with demo_template_lock:
+        if await project_repo.get_by_id(DEMO_TEMPLATE_ID):
+            return DEMO_TEMPLATE_ID
+
+        # Nobody can sign in as the template owner, and the random names keep clear of user ones
+        suffix = secrets.token_hex(8)
+        user = User(
+            username=f"{settings.demo_template_name.lower()}-{suffix}",
+            password=secrets.token_urlsafe(32),
+            id=DEMO_TEMPLATE_OWNER_ID
+        )
+        await SQLModelUserRepsitory(db).add_if_absent(user)
+
+        # Another worker that got here first has committed the template by the time this returns
+        project = Project(name=f"{settings.demo_template_name}-{suffix}", id=DEMO_TEMPLATE_ID)
+        if not await project_repo.add_if_absent(project, DEMO_TEMPLATE_OWNER_ID):
+            return DEMO_TEMPLATE_ID
+
+        failed = await populate_demo_project(db, DEMO_TEMPLATE_ID)
+        if failed:
+            raise HTTPException(status_code=500, detail='Network Error')
+
+        await db.commit()
+
+        return DEMO_TEMPLATE_ID
+
+
+@lru_cache
+def demo_password_hash() -> str:
+    return bcrypt.hashpw(b'demo', bcrypt.gensalt()).decode('utf-8')
 
 
 @auth_router.get('/demo-signin')
 async def demo_signin(
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     request: Request
 ) -> OutputJSON:
-    if not request.session.get('user_id'):
-        user_repo = SQLModelUserRepsitory(db)
-        usernames = user_repo.get_usernames()
-        username = generate_unique_name(usernames, 'demo')
-
-        user = User(username=username, password='demo')
-        user_id = user_repo.add(user)
-
-        request.session['user_id'] = user_id
-        request.session['demo'] = True
-
-        project_name = generate_unique_name([], 'project').upper()
-        project = Project(name=project_name)
-        project_id = SQLModelProjectRepository(db).add(project, user_id)
-
-        # Handle Categories (classes)
-        categories = [
-            ('car', 'purple'),
-            ('bus', 'brown'),
-            ('van', 'blue')
-        ]
-
-        for name, color in categories:
-            category = Category(name=name, color=color)
-            _ = SQLModelCategoryRepository(db).add(category, project_id)
-
-        # Upload Images
-        demo_images_urls = SQLModelDemoRepository(db).get_image_urls()
-        images = await img_util.fetch_images(demo_images_urls)
-
-        files = []
-        image_names = []
-
-        for img in images:
-            image_name = generate_unique_name(image_names, 'image')
-            image_names.append(image_name)
-            files.append((
-                image_name,
-                img.content,
-                "application/octet-stream"
-            ))
-
-        try:
-            uploaded_imgs = await img_util.upload_images(files, f"FASTAPI/{project_name}")
-        except Exception:
-            raise HTTPException(status_code=500, detail='Network Error')
+    # A signed in user is sent back to their first project instead
+    user_id = request.session.get('user_id')
+    if user_id:
+        projects, _ = await SQLModelProjectRepository(db).list_page(user_id, 1)
+
+        return OutputJSON(data={'id': projects[0].id if projects else None})
 
-        for uploaded_img in uploaded_imgs:
-            image = Image(**uploaded_img)
-            _ = SQLModelImageRepository(db).add(image, project_id)
+    failed = []
+    template_id = None
+    if settings.demo_provisioning == 'template':
+        template_id = await get_demo_template(db)
+
+    user_repo = SQLModelUserRepsitory(db)
+    user = User(username='', password='demo')
+    password_hash = await asyncio.to_thread(demo_password_hash)
+    user_id = await user_repo.add_unique(
+        user,
+        lambda: generate_unique_name([], 'demo'),
+        password_hash=password_hash
+    )
+
+    request.session['user_id'] = user_id
+    request.session['demo'] = True
+
+    project = Project(name='')
+    project_repo = SQLModelProjectRepository(db)
+    project_id = await project_repo.add_unique(
+        project,
+        user_id,
+        lambda: generate_unique_name([], 'project').upper()
+    )
+    if template_id:
+        await project_repo.clone(template_id, project_id)
+    else:
+        failed = await populate_demo_project(db, project_id)
 
-        db.commit()
+    await db.commit()
 
-    return OutputJSON(data={'id': project_id})
+    return OutputJSON(data={'id': project_id}, failed=failed)
 
 
 @auth_router.get('/signin', response_class=HTMLResponse, name='signin')
@@ -100,15 +181,19 @@ async def post_signin(
     request: Request,
     user_schema: UserSchema,
     user: Annotated[User, Depends(load_logged_in_user)],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ):
     if user:
         return RedirectResponse(request.url_for('index'), 302)
 
     user_repo = SQLModelUserRepsitory(db)
-    user = user_repo.get(user_schema.username)
+    user = await user_repo.get(user_schema.username)
     if user:
-        if bcrypt.checkpw(user_schema.password.encode('utf-8'), user.password.encode('utf-8')):
+        if await asyncio.to_thread(
+            bcrypt.checkpw,
+            user_schema.password.encode('utf-8'),
+            user.password.encode('utf-8')
+        ):
             request.session['user_id'] = user.id
 
             return RedirectResponse(request.url_for('index'), 302)
@@ -133,20 +218,20 @@ async def post_signup(
     request: Request,
     user_schema: UserSchema,
     user: Annotated[User, Depends(load_logged_in_user)],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ):
     if user:
         return RedirectResponse(request.url_for('index'), 302)
 
     user_repo = SQLModelUserRepsitory(db)
-    user = user_repo.get(user_schema.username)
+    user = await user_repo.get(user_schema.username)
     if user:
         raise HTTPException(status_code=400, detail='User already exist')
 
     user = User(**user_schema.model_dump())
-    _ = user_repo.add(user)
+    _ = await user_repo.add(user)
 
-    db.commit()
+    await db.commit()
 
     return RedirectResponse(request.url_for('signin'), 302)
 
@@ -155,18 +240,34 @@ async def post_signup(
 async def signout(
     request: Request,
     user: Annotated[User, Depends(load_logged_in_user)],
-    db: Annotated[Session, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ) -> OutputJSON:
-    _ = request.session.pop('user_id', None)
+    user_id = request.session.pop('user_id', None)
     demo = request.session.pop('demo', None)
     if demo:
-        for project in SQLModelProjectRepository(db).list(user.id):
-            try:
-                img_util.delete_all(f"FASTAPI/{project.name}")
-            except Exception:
-                raise HTTPException(status_code=500, detail='Network Error')
-
-        SQLModelUserRepsitory(db).remove(user.id)
-        db.commit()
+        project_repo = SQLModelProjectRepository(db)
+        object_repo = SQLModelStoredObjectRepository(db)
+        unreferenced_urls = []
+        folders = []
+        projects = await project_repo.list(user.id)
+        for project in projects:
+            folders.append(f"FASTAPI/{project.name}")
+            digests = await project_repo.get_project_image_digests(project.id)
+            unreferenced_urls += await object_repo.release(digests)
+
+        await SQLModelUserRepsitory(db).remove(user.id)
+        job_id = await job_queue.add(
+            db,
+            'delete_objects',
+            {'urls': unreferenced_urls, 'folders': folders},
+            total=len(unreferenced_urls) + len(folders)
+        )
+        await db.commit()
+
+        await invalidate_projects(*[project.id for project in projects])
+        job_queue.submit(job_id)
+
+    if user_id:
+        await invalidate_user(user_id)
 
     return OutputJSON()
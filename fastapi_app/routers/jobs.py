@@ -0,0 +1,26 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends
+from fastapi.exceptions import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+from fastapi_app.core.responses import OutputJSON
+from fastapi_app.core.dependencies import get_db, require_login
+from src.models import User
+from storage.repository import SQLModelJobRepository
+
+jobs_router = APIRouter()
+
+
+@jobs_router.get('/jobs/{id}')
+async def read_job(
+    id: str,
+    user: Annotated[User, Depends(require_login)],
+    db: Annotated[AsyncSession, Depends(get_db)]
+) -> OutputJSON:
+    job = await SQLModelJobRepository(db).get_by_id(id)
+    if not job or job.owner != user.id:
+        raise HTTPException(status_code=404, detail='Job not found')
+
+    job = job.to_dict()
+    del job['payload']
+
+    return OutputJSON(data=job)
@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends
+from fastapi.exceptions import HTTPException
+from fastapi_app import settings
+from fastapi_app.core.responses import OutputJSON
+from fastapi_app.core.dependencies import lookup_cache, require_login, stats_cache
+from utils import http_client, image_cache
+
+
+# Pool and cache counters describe the whole deployment, they are only served
+# when METRICS_ENABLED is set and then only to signed in users
+async def require_metrics_enabled() -> None:
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail='Not Found')
+
+
+metrics_router = APIRouter(
+    prefix='/metrics',
+    dependencies=[Depends(require_metrics_enabled), Depends(require_login)]
+)
+
+
+@metrics_router.get('/http-pool')
+async def http_pool_stats() -> OutputJSON:
+    return OutputJSON(data=http_client.stats())
+
+
+@metrics_router.get('/image-cache')
+async def image_cache_stats() -> OutputJSON:
+    if image_cache is None:
+        return OutputJSON(data={'enabled': False})
+
+    return OutputJSON(data={'enabled': True, **image_cache.stats()})
+
+
+@metrics_router.get('/lookup-cache')
+async def lookup_cache_stats() -> OutputJSON:
+    if lookup_cache is None:
+        return OutputJSON(data={'enabled': False})
+
+    return OutputJSON(data={'enabled': True, **lookup_cache.stats()})
+
+
+@metrics_router.get('/stats-cache')
+async def stats_cache_stats() -> OutputJSON:
+    if stats_cache is None:
+        return OutputJSON(data={'enabled': False})
+
+    return OutputJSON(data={'enabled': True, **stats_cache.stats()})
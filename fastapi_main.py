@@ -1,30 +1,91 @@
 import json
-import requests
+import uuid
+import asyncio
 import zipfile
 
-from io import BytesIO
 from json import JSONDecodeError
+from pathlib import Path
 from typing import Annotated
-from fastapi_app import create_app, templates
-from fastapi import Request, Depends, Form, File, UploadFile, Body
-from sqlmodel import Session
-from utils import ImageUtil, generate_unique_name
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from fastapi_app import create_app, templates, settings
+from fastapi import Request, Depends, Form, File, UploadFile, Body, Query, WebSocket
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils import (
+    ImageUtil,
+    ZipStream,
+    decode_cursor,
+    encode_cursor,
+    etag_matches,
+    generate_unique_name,
+    logger
+)
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, Response
 from fastapi.exceptions import HTTPException
-from src.models import User, Project, Category, Image, Annotation
-from fastapi_app.core.schemas import OutputJSON, AnnotationSchema
-from fastapi_app.core.dependencies import load_logged_in_user, get_db, fetch_project, require_login
+from src.models import User, Project, Category
+from fastapi_app.core.schemas import AnnotationSchema
+from fastapi_app.core.responses import OutputJSON, response_format
+from fastapi_app.core.dependencies import (
+    load_logged_in_user,
+    get_db,
+    fetch_project,
+    require_login,
+    invalidate_projects,
+    stats_cache
+)
+from fastapi_app.core.jobs import job_queue, stage_files
+from fastapi_app.core.stats import project_stats
+from fastapi_app.core.annotations import AutosaveSession, clean_annotations, resolve_categories
+from storage.orm import async_engine
 from storage.repository import (
     SQLModelImageRepository,
     SQLModelAnnotationRepository,
     SQLModelProjectRepository,
-    SQLModelCategoryRepository
+    SQLModelCategoryRepository,
+    SQLModelStoredObjectRepository,
+    SQLModelChangeRepository
 )
 
 app = create_app()
 img_util = ImageUtil()
 
 
+async def enqueue_image_uploads(
+    db: AsyncSession,
+    project_id: str,
+    owner: str,
+    files: list[UploadFile]
+) -> str:
+    # Names only need to be unique within the job here, the unique index on
+    # images(project_id, filename) settles conflicts with the project when the
+    # images are inserted
+    staged_files = []
+    job_files = []
+    image_names = set()
+    for img in files:
+        image_name = generate_unique_name(image_names, 'image')
+        image_names.add(image_name)
+        staged_files.append((image_name, img.file, img.content_type))
+        job_files.append({
+            'id': str(uuid.uuid4()),
+            'name': image_name,
+            'original': img.filename,
+            'content_type': img.content_type
+        })
+
+    # Uploads are copied out of the request so that the job can outlive it
+    job_id = str(uuid.uuid4())
+    directory = Path(settings.job_staging_dir).resolve() / job_id
+    await asyncio.to_thread(stage_files, directory, staged_files)
+
+    return await job_queue.add(
+        db,
+        'upload_images',
+        {'project_id': project_id, 'directory': str(directory), 'files': job_files},
+        owner=owner,
+        total=len(job_files),
+        id=job_id
+    )
+
+
 @app.get('/', response_class=HTMLResponse)
 async def index(request: Request, user: Annotated[User, Depends(load_logged_in_user)]):
     if user is None:
@@ -59,20 +120,19 @@ async def fetch_project_id(
 @app.post('/projects', status_code=201)
 async def create_project(
     user: Annotated[User, Depends(require_login)],
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     name: Annotated[str, Form()],
     classes: Annotated[str, Form()],
     files: Annotated[list[UploadFile], File()]
 ) -> OutputJSON:
     try:
         project_repo = SQLModelProjectRepository(db)
-        project_name = name.upper()
-        project = project_repo.get(project_name)
-        if project:
+        # The unique index settles two requests racing for the same name
+        project = Project(name=name.upper())
+        if not await project_repo.add_if_name_free(project, user.id):
             raise HTTPException(status_code=400, detail='Project name already exist')
 
-        project = Project(name=project_name)
-        project_id = project_repo.add(project, user.id)
+        project_id = project.id
 
         ## Handle Categories (classes)
         # Make category names unique
@@ -83,204 +143,355 @@ async def create_project(
 
         for name, color in categories.items():
             category = Category(name=name, color=color)
-            _ = SQLModelCategoryRepository(db).add(category, project_id)
+            _ = await SQLModelCategoryRepository(db).add(category, project_id)
 
         # Upload Images
+        job_id = None
         if files:
-            image_names = []
-            images = []
-
-            for img in files:
-                image_name = generate_unique_name(image_names, 'image')
-                img.filename = image_name
-                image_names.append(image_name)
-                images.append((
-                    img.filename,
-                    img.file,
-                    img.content_type
-                ))
+            job_id = await enqueue_image_uploads(db, project_id, user.id, files)
 
-            try:
-                img_util.delete_all(f"FASTAPI/{project_name}")
-                uploaded_imgs = await img_util.upload_images(images, f"FASTAPI/{project_name}")
-            except Exception:
-                raise HTTPException(status_code=500, detail='Network Error')
-
-            for uploaded_img in uploaded_imgs:
-                image = Image(**uploaded_img)
-                _ = SQLModelImageRepository(db).add(image, project_id)
-
-        db.commit()
+        await db.commit()
     except (KeyError, JSONDecodeError):
         raise HTTPException(status_code=400, detail='Invalid form input')
 
-    project = project_repo.get_by_id(project_id)
+    if job_id:
+        job_queue.submit(job_id)
+
+    project = await project_repo.get_by_id(project_id)
 
-    return OutputJSON(data=project.to_dict())
+    return OutputJSON(data={**project.to_dict(), 'job': job_id}, status_code=201)
 
 
 @app.get('/projects/{id}', dependencies=[Depends(load_logged_in_user)])
 async def read_project(
     id: str,
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+    request: Request,
+    images: bool = True
 ) -> OutputJSON:
-    project = SQLModelProjectRepository(db).get_with_relationships(id)
+    # The revision is read first, so a payload is never tagged newer than it is
+    project_repo = SQLModelProjectRepository(db)
+    revision = await project_repo.get_revision(id)
+    if revision is None:
+        raise HTTPException(status_code=404, detail='Project not found')
+
+    # Each representation of a revision gets its own tag
+    fmt = response_format(request.headers.get('accept'))
+    etag = f'"{revision}"' if fmt == 'json' else f'"{revision}-{fmt}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    project = await project_repo.get_with_relationships(id, with_images=images)
     if not project:
         raise HTTPException(status_code=404, detail='Project not found')
 
-    return OutputJSON(data=project.to_dict())
+    return OutputJSON(data=project.to_dict(), headers=headers)
+
+
+def page_cursor(cursor: str | None) -> tuple | None:
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+@app.get('/projects/{id}/images', dependencies=[Depends(require_login)])
+async def read_project_images(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    project: Annotated[Project, Depends(fetch_project)],
+    limit: Annotated[int, Query(ge=1, le=settings.max_page_size)] = settings.page_size,
+    cursor: str | None = None,
+    annotations: bool = False
+) -> OutputJSON:
+    images, next_key = await SQLModelProjectRepository(db).get_images_page(
+        project.id,
+        limit,
+        after=page_cursor(cursor),
+        with_annotations=annotations
+    )
+
+    return OutputJSON(data={
+        'images': [image.to_dict() for image in images],
+        'next': encode_cursor(next_key)
+    })
+
+
+# Class counts, box sizes and area histograms of a project. They are computed
+# from one columnar read of the annotations and cached for the revision
+@app.get('/projects/{id}/stats', dependencies=[Depends(require_login)])
+async def read_project_stats(
+    id: str,
+    db: Annotated[AsyncSession, Depends(get_db)],
+    request: Request
+) -> OutputJSON:
+    project_repo = SQLModelProjectRepository(db)
+    revision = await project_repo.get_revision(id)
+    if revision is None:
+        raise HTTPException(status_code=404, detail='Project not found')
+
+    fmt = response_format(request.headers.get('accept'))
+    etag = f'"stats-{revision}"' if fmt == 'json' else f'"stats-{revision}-{fmt}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    key = f"stats:{id}:{revision}"
+    stats = await stats_cache.get(key) if stats_cache is not None else None
+    if stats is None:
+        stats = project_stats(
+            await project_repo.get_annotation_columns(id),
+            await SQLModelCategoryRepository(db).get_names_by_id(id)
+        )
+        if stats_cache is not None:
+            await stats_cache.set(key, stats)
+
+    return OutputJSON(data={**stats, 'revision': revision}, headers=headers)
+
+
+# Changes made to a project after revision since, a client that has read the
+# project at that revision applies them in order to catch up
+@app.get('/projects/{id}/changes', dependencies=[Depends(require_login)])
+async def read_project_changes(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    project: Annotated[Project, Depends(fetch_project)],
+    since: Annotated[int, Query(ge=0)],
+    limit: Annotated[int, Query(ge=1, le=settings.max_page_size)] = settings.page_size
+) -> OutputJSON:
+    changes = await SQLModelChangeRepository(db).list_since(project.id, since, limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    return OutputJSON(data={
+        'changes': [change.to_dict() for change in changes],
+        'revision': changes[-1].seq if changes else since,
+        'more': more
+    })
 
 
 @app.get('/projects')
 async def read_projects(
-    db: Annotated[Session, Depends(get_db)],
-    user: Annotated[User, Depends(load_logged_in_user)]
+    db: Annotated[AsyncSession, Depends(get_db)],
+    user: Annotated[User, Depends(require_login)],
+    limit: Annotated[int, Query(ge=1, le=settings.max_page_size)] = settings.page_size,
+    cursor: str | None = None
 ) -> OutputJSON:
-    projects = [
-        project.to_dict() for project in SQLModelProjectRepository(db).list(user.id)
-    ]
+    projects, next_key = await SQLModelProjectRepository(db).list_page(
+        user.id,
+        limit,
+        after=page_cursor(cursor)
+    )
 
-    return OutputJSON(data=projects)
+    return OutputJSON(data={
+        'projects': [project.to_dict() for project in projects],
+        'next': encode_cursor(next_key)
+    })
 
 
 @app.delete('/projects/{id}')
 async def delete_project(
-    db: Annotated[Session, Depends(get_db)],
+    user: Annotated[User, Depends(load_logged_in_user)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     project: Annotated[Project, Depends(fetch_project)]
 ) -> OutputJSON:
-    try:
-        img_util.delete_all(f"FASTAPI/{project.name}")
-    except Exception:
-        raise HTTPException(status_code=500, detail='Network Error')
+    project_repo = SQLModelProjectRepository(db)
+    digests = await project_repo.get_project_image_digests(project.id)
+    unreferenced_urls = await SQLModelStoredObjectRepository(db).release(digests)
+
+    await project_repo.remove(project.id)
+
+    # Images uploaded before content-addressed storage live in the project folder
+    job_id = await job_queue.add(
+        db,
+        'delete_objects',
+        {'urls': unreferenced_urls, 'folders': [f"FASTAPI/{project.name}"]},
+        owner=user.id if user else None,
+        total=len(unreferenced_urls) + 1
+    )
+    await db.commit()
 
-    SQLModelProjectRepository(db).remove(project.id)
-    db.commit()
+    await invalidate_projects(project.id)
+    job_queue.submit(job_id)
 
-    return OutputJSON()
+    return OutputJSON(data={'job': job_id})
 
 
 @app.post('/projects/{id}/images/{i_id}/annotations')
 async def create_annotation(
     i_id: str,
-    db: Annotated[Session, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_db)],
     annotations: Annotated[list[AnnotationSchema], Body()],
     project: Annotated[Project, Depends(fetch_project)]
 ) -> OutputJSON:
-    image_repo = SQLModelImageRepository(db)
-    image = image_repo.get_by_id(i_id)
-    if not image:
+    # Only an image of the project itself is written to
+    sizes = await SQLModelImageRepository(db).get_sizes([i_id], project.id)
+    if not sizes:
         raise HTTPException(status_code=404, detail='Image not found')
 
-    image_repo.remove_image_annotations(image.id)
-
     ## Handle Annotations
+    # Boxes are fitted to the image, categories resolved once and only the
+    # annotations that changed are written
     try:
-        category_repo = SQLModelCategoryRepository(db)
-        for a in annotations:
-            annotation = Annotation(a.x, a.y, a.width, a.height)
-            category_name = a.category.name.lower()
-            category = category_repo.get(category_name)
-            if category:
-                category_id = category.id
-            else:
-                category = Category(category_name, a.category.color)
-                category_id = category_repo.add(category, project.id)
-
-            _ = SQLModelAnnotationRepository(db).add(annotation, image.id, category_id)
-        db.commit()
+        cleaned, corrections = clean_annotations({i_id: annotations}, sizes)
+        resolved = await resolve_categories(db, project.id, cleaned)
+        counts = await SQLModelAnnotationRepository(db).sync_annotations(project.id, resolved)
+        await db.commit()
     except KeyError:
         raise HTTPException(status_code=400, detail='Invalid user input')
 
-    return OutputJSON()
+    return OutputJSON(data={**counts, **corrections})
 
 
-@app.post('/projects/{id}/images', status_code=201)
-async def add_project_images(
-    project: Annotated[Project, Depends(fetch_project)],
-    db: Annotated[Session, Depends(get_db)],
-    files: Annotated[list[UploadFile], File()]
+# Saves the annotations of many images of a project at once, keyed by image id
+@app.post('/projects/{id}/annotations')
+async def save_annotations(
+    user: Annotated[User, Depends(require_login)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+    annotations: Annotated[dict[str, list[AnnotationSchema]], Body()],
+    project: Annotated[Project, Depends(fetch_project)]
 ) -> OutputJSON:
-    # Upload Images
-    if files:
-        images = []
-        image_files = []
-        image_names = SQLModelProjectRepository(db).get_project_image_names(project.id)
+    # Ownership is checked once for the whole batch
+    if await SQLModelProjectRepository(db).get_user_id(project.id) != user.id:
+        raise HTTPException(status_code=404, detail='Project not found')
+
+    sizes = await SQLModelImageRepository(db).get_sizes(list(annotations), project.id)
+    if len(sizes) != len(annotations):
+        raise HTTPException(status_code=404, detail='Image not found')
+
+    try:
+        cleaned, corrections = clean_annotations(annotations, sizes)
+        resolved = await resolve_categories(db, project.id, cleaned)
+        counts = await SQLModelAnnotationRepository(db).sync_annotations(project.id, resolved)
+        await db.commit()
+    except KeyError:
+        raise HTTPException(status_code=400, detail='Invalid user input')
+
+    return OutputJSON(data={**counts, **corrections})
 
-        for img in files:
-            image_name = generate_unique_name(image_names, 'image')
-            img.filename = image_name
-            image_names.append(image_name)
-            image_files.append((
-                img.filename,
-                img.file,
-                img.content_type
-            ))
 
-        try:
-            uploaded_imgs = await img_util.upload_images(image_files, f"FASTAPI/{project.name}")
-        except Exception:
-            raise HTTPException(status_code=500, detail='Network Error')
+# Streams single annotation puts and deletes, which are buffered, coalesced
+# and written every AUTOSAVE_FLUSH_INTERVAL seconds and when the socket closes
+@app.websocket('/projects/{id}/autosave')
+async def autosave_annotations(websocket: WebSocket, id: str) -> None:
+    # Ownership is checked once, when the channel opens
+    user_id = websocket.session.get('user_id')
+    async with AsyncSession(async_engine) as db:
+        owner_id = await SQLModelProjectRepository(db).get_user_id(id)
 
-        for uploaded_img in uploaded_imgs:
-            image = Image(**uploaded_img)
-            _ = SQLModelImageRepository(db).add(image, project.id)
+    if user_id is None or owner_id != user_id:
+        await websocket.close(code=1008)
+        return
 
-            img = image.to_dict()
-            img['annotations'] = []
-            images.append(img)
+    await websocket.accept()
+    await AutosaveSession(
+        websocket,
+        id,
+        settings.autosave_flush_interval,
+        settings.autosave_max_pending
+    ).run()
 
-        db.commit()
 
-    return OutputJSON(data=images)
+@app.post('/projects/{id}/images', status_code=202)
+async def add_project_images(
+    user: Annotated[User, Depends(require_login)],
+    project: Annotated[Project, Depends(fetch_project)],
+    db: Annotated[AsyncSession, Depends(get_db)],
+    files: Annotated[list[UploadFile], File()]
+) -> OutputJSON:
+    job_id = await enqueue_image_uploads(db, project.id, user.id, files)
+    await db.commit()
+
+    job_queue.submit(job_id)
+
+    return OutputJSON(data={'job': job_id}, status_code=202)
 
 
 @app.delete('/images/{id}')
-async def delete_image(id: str, db: Annotated[Session, Depends(get_db)]) -> OutputJSON:
+async def delete_image(
+    id: str,
+    user: Annotated[User, Depends(load_logged_in_user)],
+    db: Annotated[AsyncSession, Depends(get_db)]
+) -> OutputJSON:
     image_repo = SQLModelImageRepository(db)
-    image = image_repo.get_by_id(id)
+    image = await image_repo.get_by_id(id)
     if not image:
         raise HTTPException(status_code=404, detail='Image not found')
 
-    try:
-        img_util.delete_image(image)
-    except Exception:
-        raise HTTPException(status_code=500, detail='Network Error')
+    if image.digest:
+        unreferenced_urls = await SQLModelStoredObjectRepository(db).release([image.digest])
+    else:
+        unreferenced_urls = [image.url]
+
+    await image_repo.remove(image.id)
+    job_id = await job_queue.add(
+        db,
+        'delete_objects',
+        {'urls': unreferenced_urls},
+        owner=user.id if user else None,
+        total=len(unreferenced_urls)
+    )
+    await db.commit()
 
-    image_repo.remove(image.id)
-    db.commit()
+    job_queue.submit(job_id)
 
-    return OutputJSON()
+    return OutputJSON(data={'job': job_id})
 
 
 @app.get('/export/{id}')
 async def export_project(
     id: str,
-    db: Annotated[Project, Depends(get_db)]
+    db: Annotated[AsyncSession, Depends(get_db)]
 ) -> StreamingResponse:
-    project = SQLModelProjectRepository(db).export_project_data(id)
+    project = await SQLModelProjectRepository(db).export_project_data(id)
     if not project:
         raise HTTPException(status_code=404, detail='Project does not exist')
 
     project_name = project.pop('name')
     image_urls = project.pop('image_urls')
 
-    try:
-        responses = await img_util.fetch_images(image_urls)
-    except requests.RequestException:
-        raise HTTPException(status_code=500, detail='Network Error')
-
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
-        for img, response in zip(project['images'], responses):
-            zip_file.writestr(f"images/{img['filename']}", response.content)
-
-        project_str = json.dumps(project, indent=2)
-        zip_file.writestr("annotations.json", project_str)
-
-    zip_buffer.seek(0)
+    async def stream_zip():
+        zip_stream = ZipStream()
+        with zipfile.ZipFile(zip_stream, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            images = img_util.stream_images(image_urls, settings.export_concurrency)
+            failed_images = []
+            try:
+                for img in project['images']:
+                    content = await anext(images)
+                    if content is None:
+                        failed_images.append({'id': img['id'], 'filename': img['filename']})
+                        continue
+
+                    # Images are already compressed, deflating them again only costs CPU
+                    zip_file.writestr(
+                        f"images/{img['filename']}",
+                        content,
+                        compress_type=zipfile.ZIP_STORED
+                    )
+                    del content
+
+                    yield zip_stream.drain()
+            finally:
+                await images.aclose()
+
+            # Images that could not be fetched are left out of the dataset and
+            # listed in failed.json, so an incomplete export is never silent
+            if failed_images:
+                logger.warning(f"Export of project {id} skipped {len(failed_images)} images")
+                failed_ids = {img['id'] for img in failed_images}
+                project['images'] = [img for img in project['images'] if img['id'] not in failed_ids]
+                project['annotations'] = [
+                    a for a in project['annotations']
+                    if a['image_id'] not in failed_ids
+                ]
+                zip_file.writestr("failed.json", json.dumps({'images': failed_images}, indent=2))
+
+            project_str = json.dumps(project, indent=2)
+            zip_file.writestr("annotations.json", project_str)
+
+        yield zip_stream.drain()
 
     return StreamingResponse(
-        zip_buffer,
+        stream_zip(),
         media_type='application/zip',
         headers={
             'Content-Disposition': f'attachment; filename="{project_name}_annotations.zip"'
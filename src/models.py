@@ -1,37 +1,58 @@
-import copy
 import uuid
 
+from datetime import datetime
+from operator import attrgetter
+
 
 class BaseModel:
+    __slots__ = ('id',)
+
+    # Fields left out of to_dict
+    _hidden: tuple[str, ...] = ()
+    # Nested models and lists of models, serialized only once they are set
+    _relations: tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+
+        # The serialized fields are resolved once per class, in declaration order
+        fields = []
+        for klass in reversed(cls.__mro__):
+            for name in vars(klass).get('__slots__', ()):
+                if name not in fields and name not in cls._hidden and name not in cls._relations:
+                    fields.append(name)
+
+        cls._fields = tuple(fields)
+        cls._get_fields = staticmethod(attrgetter(*fields))
+
     def __init__(self, id: str | None = None):
         if id is None:
             id = str(uuid.uuid4())
 
         self.id = id
 
+    # Values are shared with the model rather than copied, so the mutable ones
+    # (Image.variants, Job.payload and result, Change.data) must not be changed
+    # through the returned dict
     def to_dict(self):
-        model_dict = copy.deepcopy(vars(self))
-        if 'password' in model_dict:
-            del model_dict['password']
+        model_dict = dict(zip(self._fields, self._get_fields(self)))
+        for name in self._relations:
+            value = getattr(self, name, None)
+            if value is None:
+                continue
 
-        for k, v in model_dict.items():
-            if isinstance(v, BaseModel):
-                model_dict[k] = v.to_dict()
-
-            if isinstance(v, list):
-                lst = []
-                for model in v:
-                    if isinstance(model, BaseModel):
-                        model = model.to_dict()
-
-                    lst.append(model)
-
-                model_dict[k] = lst
+            if isinstance(value, BaseModel):
+                model_dict[name] = value.to_dict()
+            else:
+                model_dict[name] = [model.to_dict() for model in value]
 
         return model_dict
 
 
 class User(BaseModel):
+    __slots__ = ('username', 'password')
+    _hidden = ('password',)
+
     def __init__(self, username: str, password: str, id: str | None = None) -> None:
         super().__init__(id=id)
         self.username = username
@@ -39,18 +60,27 @@ class User(BaseModel):
 
 
 class Project(BaseModel):
-    def __init__(self, name: str, id: str | None = None) -> None:
+    __slots__ = ('name', 'revision', 'categories', 'images')
+    _relations = ('categories', 'images')
+
+    def __init__(self, name: str, revision: int = 0, id: str | None = None) -> None:
         super().__init__(id=id)
         self.name = name
+        self.revision = revision
 
 
 class Demo(BaseModel):
+    __slots__ = ('url',)
+
     def __init__(self, url: str, id: str | None = None) -> None:
         super().__init__(id=id)
         self.url = url
 
 
 class Annotation(BaseModel):
+    __slots__ = ('x', 'y', 'width', 'height', 'category')
+    _relations = ('category',)
+
     def __init__(
         self,
         x: float,
@@ -67,12 +97,17 @@ class Annotation(BaseModel):
 
 
 class Image(BaseModel):
+    __slots__ = ('url', 'width', 'height', 'filename', 'digest', 'variants', 'annotations')
+    _relations = ('annotations',)
+
     def __init__(
         self,
         url: str,
         width: float,
         height: float,
         filename: str,
+        digest: str | None = None,
+        variants: list[dict] | None = None,
         id: str | None = None
     ) -> None:
         super().__init__(id=id)
@@ -80,10 +115,95 @@ class Image(BaseModel):
         self.width = width
         self.height = height
         self.filename = filename
+        self.digest = digest
+        self.variants = variants or []
+
+
+class StoredObject(BaseModel):
+    __slots__ = ('url', 'width', 'height', 'refcount', 'variants')
+
+    def __init__(
+        self,
+        url: str,
+        width: float,
+        height: float,
+        refcount: int = 0,
+        variants: list[dict] | None = None,
+        id: str | None = None
+    ) -> None:
+        super().__init__(id=id)
+        self.url = url
+        self.width = width
+        self.height = height
+        self.refcount = refcount
+        self.variants = variants or []
 
 
 class Category(BaseModel):
+    __slots__ = ('name', 'color')
+
     def __init__(self, name: str, color: str, id: str | None = None) -> None:
         super().__init__(id=id)
         self.name = name
         self.color = color
+
+
+class Job(BaseModel):
+    __slots__ = (
+        'kind',
+        'payload',
+        'status',
+        'total',
+        'done',
+        'attempts',
+        'error',
+        'result',
+        'owner',
+        'updated_at'
+    )
+
+    def __init__(
+        self,
+        kind: str,
+        payload: dict,
+        status: str = 'pending',
+        total: int = 0,
+        done: int = 0,
+        attempts: int = 0,
+        error: str | None = None,
+        result: dict | None = None,
+        owner: str | None = None,
+        updated_at: datetime | None = None,
+        id: str | None = None
+    ) -> None:
+        super().__init__(id=id)
+        self.kind = kind
+        self.payload = payload
+        self.status = status
+        self.total = total
+        self.done = done
+        self.attempts = attempts
+        self.error = error
+        self.result = result
+        self.owner = owner
+        self.updated_at = updated_at or datetime.now()
+
+
+class Change(BaseModel):
+    __slots__ = ('seq', 'entity', 'op', 'ref', 'data')
+
+    def __init__(
+        self,
+        seq: int,
+        entity: str,
+        op: str,
+        ref: str,
+        data: dict | None = None,
+        id: str | None = None
+    ) -> None:
+        super().__init__(id=id)
+        self.seq = seq
+        self.entity = entity
+        self.op = op
+        self.ref = ref
+        self.data = data
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import io
+import shutil
+import time
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from utils import HTTPClient
+
+NOT_IMPLEMENTED_ERROR = NotImplementedError('Method must be implemented')
+
+
+def read_content(file: tuple) -> bytes:
+    content = file[1]
+    if hasattr(content, 'read'):
+        content.seek(0)
+        content = content.read()
+
+    return content
+
+
+def probe_image(content: bytes) -> tuple[int, int, str]:
+    from PIL import Image as PILImage, UnidentifiedImageError
+
+    try:
+        # Only the header is parsed, pixel data is not decoded
+        with PILImage.open(io.BytesIO(content)) as img:
+            return img.width, img.height, img.format.lower()
+    except UnidentifiedImageError:
+        raise ValueError('Invalid image file')
+
+
+def render_variants(content: bytes, sizes: list[int]) -> list[tuple[int, bytes, int, int]]:
+    from PIL import Image as PILImage, UnidentifiedImageError
+
+    # Runs in a worker process: the image is decoded once and every level is
+    # downscaled from the one above it, JPEG sources are decoded at reduced scale
+    try:
+        with PILImage.open(io.BytesIO(content)) as img:
+            exif = img.getexif()
+            sizes = sorted((size for size in sizes if size < max(img.size)), reverse=True)
+            if not sizes:
+                return []
+
+            img.thumbnail((sizes[0], sizes[0]))
+            level = img.convert('L' if img.mode == 'L' else 'RGB')
+    except UnidentifiedImageError:
+        raise ValueError('Invalid image file')
+
+    variants = []
+    for size in sizes:
+        level.thumbnail((size, size))
+
+        # The orientation tag is kept so browsers rotate variants like the original
+        buffer = io.BytesIO()
+        level.save(buffer, 'JPEG', quality=85, exif=exif)
+        variants.append((size, buffer.getvalue(), level.width, level.height))
+
+    return variants[::-1]
+
+
+## Abstract Image Storage
+class ImageStorage(ABC):
+    # Returns the url, width and height of the stored image
+    @abstractmethod
+    async def upload(self, file: tuple, folder: str) -> dict:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def fetch(self, url: str) -> bytes:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Urls the storage does not own, such as those stored under another backend,
+    # are fetched with a plain GET instead
+    def owns(self, url: str) -> bool:
+        return True
+
+    @abstractmethod
+    async def delete(self, url: str) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def delete_prefix(self, folder: str) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+
+## Implementations of the Image Storage
+class CloudinaryStorage(ImageStorage):
+    def __init__(
+        self,
+        http_client: 'HTTPClient',
+        cloud_name: str,
+        api_key: str,
+        api_secret: str,
+        api_url: str = 'https://api.cloudinary.com'
+    ) -> None:
+        self._http_client = http_client
+        self._cloud_name = cloud_name
+        self._api_key = api_key
+        self._api_secret = api_secret
+        self._api_url = f"{api_url}/v1_1/{cloud_name}"
+
+    def _sign(self, params: dict) -> dict:
+        timestamp = str(int(time.time()))
+        params = {**params, 'timestamp': timestamp}
+
+        # Build signature string
+        params_to_sign = '&'.join(f"{k}={v}" for k, v in sorted(params.items()))
+        signature = hashlib.sha1(f"{params_to_sign}{self._api_secret}".encode('utf-8')).hexdigest()
+
+        return {**params, 'api_key': self._api_key, 'signature': signature}
+
+    @staticmethod
+    def _public_id(url: str) -> str:
+        public_id = url.rsplit('/', 3)[1:]
+
+        return '/'.join(public_id).rsplit('.', 1)[0]
+
+    async def upload(self, file: tuple, folder: str) -> dict:
+        data = self._sign({'folder': folder, 'public_id': file[0]})
+
+        # Rewind file objects partially consumed by a failed attempt
+        if hasattr(file[1], 'seek'):
+            file[1].seek(0)
+
+        async with self._http_client.slot() as client:
+            response = await client.post(
+                f"{self._api_url}/image/upload",
+                data=data,
+                files={'file': file}
+            )
+            response.raise_for_status()
+
+        response = response.json()
+
+        return {
+            'url': response['secure_url'],
+            'width': response['width'],
+            'height': response['height']
+        }
+
+    async def fetch(self, url: str) -> bytes:
+        async with self._http_client.slot() as client:
+            response = await client.get(url)
+            response.raise_for_status()
+
+        return response.content
+
+    async def delete(self, url: str) -> None:
+        data = self._sign({'public_id': self._public_id(url)})
+
+        async with self._http_client.slot() as client:
+            response = await client.post(f"{self._api_url}/image/destroy", data=data)
+            response.raise_for_status()
+
+        result = response.json().get('result')
+        if result not in ('ok', 'not found'):
+            raise RuntimeError(f"Unexpected response: {result}")
+
+    async def delete_prefix(self, folder: str) -> None:
+        # The admin API deletes at most 1000 resources per call
+        partial = True
+        while partial:
+            async with self._http_client.slot() as client:
+                response = await client.delete(
+                    f"{self._api_url}/resources/image/upload",
+                    params={'prefix': folder + '/'},
+                    auth=(self._api_key, self._api_secret)
+                )
+                response.raise_for_status()
+
+            response = response.json()
+            if 'deleted' not in response:
+                raise RuntimeError('Unexpected response')
+
+            partial = response.get('partial', False)
+
+
+class LocalStorage(ImageStorage):
+    def __init__(self, directory: str, base_url: str) -> None:
+        self._directory = Path(directory).resolve()
+        self._base_url = base_url.rstrip('/')
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, url: str) -> Path:
+        if not url.startswith(self._base_url + '/'):
+            raise ValueError(f"Not a local storage url: {url}")
+
+        path = (self._directory / url[len(self._base_url) + 1:]).resolve()
+        if not path.is_relative_to(self._directory):
+            raise ValueError(f"Not a local storage url: {url}")
+
+        return path
+
+    def owns(self, url: str) -> bool:
+        return url.startswith(self._base_url + '/')
+
+    async def upload(self, file: tuple, folder: str) -> dict:
+        def write() -> dict:
+            content = read_content(file)
+            width, height, extension = probe_image(content)
+
+            path = self._directory / folder / f"{file[0]}.{extension}"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+
+            return {
+                'url': f"{self._base_url}/{folder}/{path.name}",
+                'width': width,
+                'height': height
+            }
+
+        return await asyncio.to_thread(write)
+
+    async def fetch(self, url: str) -> bytes:
+        return await asyncio.to_thread(self._path(url).read_bytes)
+
+    async def delete(self, url: str) -> None:
+        await asyncio.to_thread(self._path(url).unlink, missing_ok=True)
+
+    async def delete_prefix(self, folder: str) -> None:
+        path = (self._directory / folder).resolve()
+        if path.is_relative_to(self._directory):
+            await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+NOT_IMPLEMENTED_ERROR = NotImplementedError('Method must be implemented')
+
+
+# Size-bounded, least-recently-used cache of image bytes on the local disk.
+# Entries are written atomically, so several workers can share the directory;
+# an entry evicted by another worker is simply treated as a miss. The size is
+# tracked per process from the entries it knows of, so N workers sharing a
+# directory can fill up to N times max_bytes. Content is returned
+# memory-mapped, callers close the mapping with close_content once done.
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = asyncio.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        # Rebuild the recency order from the access times of the cached files
+        paths = []
+        for path in self.directory.iterdir():
+            if path.name.startswith('.'):
+                continue
+
+            stat = path.stat()
+            paths.append((stat.st_atime, path.name, stat.st_size))
+
+        for _, key, size in sorted(paths):
+            self._entries[key] = size
+            self.size += size
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+    def _read(self, key: str) -> bytes | mmap.mmap:
+        path = self.directory / key
+        with open(path, 'rb') as f:
+            os.utime(path)
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+
+            # Mapped pages are shared with the page cache instead of copied into the process
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _write(self, key: str, content: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, self.directory / key)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def get(self, name: str) -> bytes | mmap.mmap | None:
+        key = self._key(name)
+        if key in self._entries:
+            try:
+                content = await asyncio.to_thread(self._read, key)
+            except FileNotFoundError:
+                self.size -= self._entries.pop(key, 0)
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return content
+
+        self.misses += 1
+
+        return None
+
+    async def put(self, name: str, content: bytes) -> None:
+        size = len(content)
+        if size > self.max_bytes:
+            return
+
+        key = self._key(name)
+        await asyncio.to_thread(self._write, key, content)
+
+        async with self._lock:
+            self.size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+
+            evicted = []
+            while self.size > self.max_bytes:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(self.directory / old_key)
+
+            self.evictions += len(evicted)
+
+        for path in evicted:
+            await asyncio.to_thread(path.unlink, missing_ok=True)
+
+    async def discard(self, name: str) -> None:
+        key = self._key(name)
+        self.size -= self._entries.pop(key, 0)
+        await asyncio.to_thread((self.directory / key).unlink, missing_ok=True)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions
+        }
+
+
+def close_content(content: bytes | mmap.mmap | None) -> None:
+    if isinstance(content, mmap.mmap):
+        content.close()
+
+
+## Abstract Lookup Cache
+# Short-lived copies of small rows read on every request. Entries expire after
+# their ttl and are deleted explicitly when the row changes.
+class LookupCache(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> dict | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def set(self, key: str, value: dict) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    def stats(self) -> dict:
+        raise NOT_IMPLEMENTED_ERROR
+
+    async def close(self) -> None:
+        pass
+
+
+## Implementations of the Lookup Cache
+# Per-process stand-in for the shared cache, bounded by the number of entries
+class MemoryLookupCache(LookupCache):
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    async def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return dict(value)
+
+            del self._entries[key]
+
+        self.misses += 1
+
+        return None
+
+    async def set(self, key: str, value: dict) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, dict(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+
+        return {
+            'backend': 'memory',
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0
+        }
+
+
+# Shared by every worker; an unreachable server degrades to database lookups
+class RedisLookupCache(LookupCache):
+    def __init__(self, url: str, ttl: float) -> None:
+        import redis.asyncio as redis
+
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._error = redis.RedisError
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> dict | None:
+        try:
+            value = await self._client.get(key)
+        except self._error as e:
+            self.errors += 1
+            logger.warning(f"Lookup cache read of {key} failed: {e}")
+
+            return None
+
+        if value is None:
+            self.misses += 1
+
+            return None
+
+        self.hits += 1
+
+        return json.loads(value)
+
+    async def set(self, key: str, value: dict) -> None:
+        try:
+            await self._client.set(key, json.dumps(value), px=int(self.ttl * 1000))
+        except self._error as e:
+            self.errors += 1
+            logger.warning(f"Lookup cache write of {key} failed: {e}")
+
+    async def delete(self, *keys: str) -> None:
+        # A failed delete leaves the entry until its ttl runs out, so it is retried once
+        for _ in range(2):
+            try:
+                await self._client.delete(*keys)
+
+                return
+            except self._error as e:
+                self.errors += 1
+                logger.warning(f"Lookup cache delete of {keys} failed: {e}")
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+
+        return {
+            'backend': 'redis',
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_ratio': self.hits / requests if requests else 0.0
+        }
+
+    async def close(self) -> None:
+        await self._client.aclose()
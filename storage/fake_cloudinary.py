@@ -0,0 +1,73 @@
+from fastapi import FastAPI, Form, File, UploadFile, Request
+from fastapi.responses import JSONResponse, Response
+from storage.backends import probe_image
+
+# In-memory stand-in for the parts of the Cloudinary upload, admin and delivery
+# APIs used by CloudinaryStorage. Runs in-process through httpx.ASGITransport when
+# STORAGE_BACKEND=fake, or as a separate server (`uvicorn storage.fake_cloudinary:app`)
+# that CLOUDINARY_API_URL points at.
+FAKE_CLOUDINARY_URL = 'http://fake-cloudinary'
+
+app = FastAPI()
+app.state.resources = {}
+
+
+@app.post('/v1_1/{cloud_name}/image/upload')
+async def upload(
+    cloud_name: str,
+    request: Request,
+    public_id: str = Form(),
+    folder: str = Form(''),
+    file: UploadFile = File()
+) -> JSONResponse:
+    content = await file.read()
+    try:
+        width, height, extension = probe_image(content)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={'error': {'message': str(e)}})
+
+    public_id = f"{folder}/{public_id}" if folder else public_id
+    request.app.state.resources[public_id] = (content, extension)
+
+    return JSONResponse({
+        'public_id': public_id,
+        'format': extension,
+        'width': width,
+        'height': height,
+        'bytes': len(content),
+        'secure_url': f"{request.base_url}{cloud_name}/image/upload/v1/{public_id}.{extension}"
+    })
+
+
+@app.post('/v1_1/{cloud_name}/image/destroy')
+async def destroy(cloud_name: str, request: Request, public_id: str = Form()) -> JSONResponse:
+    resource = request.app.state.resources.pop(public_id, None)
+
+    return JSONResponse({'result': 'ok' if resource else 'not found'})
+
+
+@app.delete('/v1_1/{cloud_name}/resources/image/upload')
+async def delete_resources_by_prefix(cloud_name: str, prefix: str, request: Request) -> JSONResponse:
+    resources = request.app.state.resources
+    deleted = {
+        public_id: 'deleted'
+        for public_id in list(resources)
+        if public_id.startswith(prefix)
+    }
+
+    for public_id in deleted:
+        del resources[public_id]
+
+    return JSONResponse({'deleted': deleted, 'partial': False})
+
+
+@app.get('/{cloud_name}/image/upload/{version}/{path:path}')
+async def deliver(cloud_name: str, version: str, path: str, request: Request) -> Response:
+    public_id = path.rsplit('.', 1)[0]
+    resource = request.app.state.resources.get(public_id)
+    if resource is None:
+        return Response(status_code=404)
+
+    content, extension = resource
+
+    return Response(content=content, media_type=f"image/{extension}")
@@ -0,0 +1,376 @@
+import logging
+import uuid
+
+from datetime import datetime
+from typing import Callable
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    Engine,
+    Float,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    inspect,
+    insert,
+    select,
+    text
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+logger = logging.getLogger(__name__)
+
+# Held by the migrating process on PostgreSQL, so concurrently starting
+# instances apply each migration once
+MIGRATION_LOCK_KEY = 5781320419
+# Schema changes give up instead of queueing live traffic behind their locks
+LOCK_TIMEOUT = '10s'
+# Rows a data migration writes per statement
+MIGRATION_BATCH_SIZE = 10000
+
+schema_migrations = Table(
+    'schema_migrations',
+    MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+Upgrade = Callable[[Connection], None]
+
+
+class Migration:
+    def __init__(self, version: int, name: str, upgrade: Upgrade, transactional: bool) -> None:
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+        # Non-transactional migrations run in autocommit mode, which concurrent
+        # index builds require, and must be safe to run again after a failure
+        self.transactional = transactional
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, name: str, transactional: bool = True) -> Callable[[Upgrade], Upgrade]:
+    def register(upgrade: Upgrade) -> Upgrade:
+        MIGRATIONS.append(Migration(version, name, upgrade, transactional))
+
+        return upgrade
+
+    return register
+
+
+## Operations
+# Each operation skips what is already in place, databases created by
+# create_all before migrations existed are brought up to date by the same steps
+def add_column(conn: Connection, table_name: str, column: Column) -> None:
+    if column.name in {c['name'] for c in inspect(conn).get_columns(table_name)}:
+        return
+
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {ddl}"))
+
+
+def create_index(
+    conn: Connection,
+    name: str,
+    table_name: str,
+    columns: list[str],
+    unique: bool = False
+) -> None:
+    concurrently = ''
+    if conn.dialect.name == 'postgresql':
+        # Builds without blocking writes, an interrupted build leaves an invalid
+        # index behind that has to be dropped before retrying
+        concurrently = 'CONCURRENTLY '
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {'name': name}).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    conn.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS "
+        f"{name} ON {table_name} ({', '.join(columns)})"
+    ))
+
+
+## Migrations
+# Tables are declared here as they were at each version, never imported from
+# storage.orm, so replaying the history always yields the same schema
+@migration(1, 'baseline')
+def create_baseline(conn: Connection) -> None:
+    metadata = MetaData()
+    Table(
+        'users',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('username', String, nullable=False, unique=True),
+        Column('password', String, nullable=False)
+    )
+    Table(
+        'projects',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('name', String, nullable=False, unique=True),
+        Column('user_id', String, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    )
+    Table(
+        'demo',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('url', String, nullable=False)
+    )
+    Table(
+        'categories',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('project_id', String, ForeignKey('projects.id', ondelete='CASCADE'), nullable=False),
+        Column('name', String, nullable=False),
+        Column('color', String, nullable=False)
+    )
+    Table(
+        'images',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('project_id', String, ForeignKey('projects.id', ondelete='CASCADE'), nullable=False),
+        Column('url', String, nullable=False),
+        Column('filename', String, nullable=False),
+        Column('width', Float, nullable=False),
+        Column('height', Float, nullable=False)
+    )
+    Table(
+        'annotations',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('image_id', String, ForeignKey('images.id', ondelete='CASCADE'), nullable=False),
+        Column('category_id', String, ForeignKey('categories.id', ondelete='CASCADE'), nullable=False),
+        Column('x', Float, nullable=False),
+        Column('y', Float, nullable=False),
+        Column('height', Float, nullable=False),
+        Column('width', Float, nullable=False)
+    )
+    metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, 'stored_objects_jobs_and_change_log')
+def create_stored_objects_jobs_and_change_log(conn: Connection) -> None:
+    metadata = MetaData()
+    Table('projects', metadata, Column('id', String, primary_key=True))
+    Table(
+        'stored_objects',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('url', String, nullable=False),
+        Column('width', Float, nullable=False),
+        Column('height', Float, nullable=False),
+        Column('refcount', Integer, nullable=False),
+        Column('variants', JSON)
+    )
+    Table(
+        'jobs',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('kind', String, nullable=False),
+        Column('payload', JSON),
+        Column('status', String, nullable=False),
+        Column('total', Integer, nullable=False),
+        Column('done', Integer, nullable=False),
+        Column('attempts', Integer, nullable=False),
+        Column('error', String),
+        Column('result', JSON),
+        Column('owner', String),
+        Column('updated_at', DateTime, nullable=False)
+    )
+    Table(
+        'changes',
+        metadata,
+        Column('id', String, primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('project_id', String, ForeignKey('projects.id', ondelete='CASCADE'), nullable=False),
+        Column('seq', Integer, nullable=False),
+        Column('entity', String, nullable=False),
+        Column('op', String, nullable=False),
+        Column('ref', String, nullable=False),
+        Column('data', JSON)
+    )
+    for table_name in ('stored_objects', 'jobs', 'changes'):
+        metadata.tables[table_name].create(conn, checkfirst=True)
+
+    # Nullable or defaulted, so adding them only touches the catalog
+    add_column(conn, 'stored_objects', Column('variants', JSON))
+    add_column(conn, 'images', Column('digest', String))
+    add_column(conn, 'images', Column('variants', JSON))
+    add_column(conn, 'projects', Column('revision', Integer, nullable=False, server_default='0'))
+
+
+@migration(3, 'deduplicate_image_filenames')
+def deduplicate_image_filenames(conn: Connection) -> None:
+    # Filenames become unique per project in the next migration, later
+    # duplicates are suffixed with their id
+    conn.execute(text(
+        "UPDATE images SET filename = filename || '-' || id WHERE id IN ("
+        "SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+        "PARTITION BY project_id, filename ORDER BY created_at, id) AS n FROM images) AS ranked "
+        "WHERE n > 1)"
+    ))
+
+
+@migration(4, 'indexes', transactional=False)
+def create_indexes(conn: Connection) -> None:
+    create_index(conn, 'ix_images_project_id_filename', 'images', ['project_id', 'filename'], unique=True)
+    create_index(conn, 'ix_images_project_id_created_at_id', 'images', ['project_id', 'created_at', 'id'])
+    create_index(conn, 'ix_images_digest', 'images', ['digest'])
+    create_index(conn, 'ix_annotations_image_id', 'annotations', ['image_id'])
+    create_index(conn, 'ix_annotations_category_id', 'annotations', ['category_id'])
+    create_index(conn, 'ix_categories_project_id_name', 'categories', ['project_id', 'name'])
+    create_index(conn, 'ix_projects_user_id_created_at_id', 'projects', ['user_id', 'created_at', 'id'])
+    create_index(conn, 'ix_jobs_status', 'jobs', ['status'])
+    create_index(conn, 'ix_changes_project_id_seq', 'changes', ['project_id', 'seq'], unique=True)
+
+
+@migration(5, 'scope_annotation_categories', transactional=False)
+def scope_annotation_categories(conn: Connection) -> None:
+    # Category lookups by name alone let annotations point to a category of
+    # another project and created duplicates within a project. It runs in
+    # autocommit mode, every batch is committed on its own so no step holds
+    # its locks over a whole table, and each step only touches the rows it
+    # has not fixed yet, so a failed run is resumed by running it again.
+    # Each project first gets the categories its annotations are missing, by name
+    missing = conn.execute(text(
+        "SELECT i.project_id, MIN(f.name), MIN(f.color) FROM annotations a "
+        "JOIN images i ON i.id = a.image_id "
+        "JOIN categories f ON f.id = a.category_id "
+        "WHERE f.project_id <> i.project_id AND NOT EXISTS ("
+        "SELECT 1 FROM categories c WHERE c.project_id = i.project_id AND lower(c.name) = lower(f.name)) "
+        "GROUP BY i.project_id, lower(f.name)"
+    )).all()
+    now = datetime.now()
+    for i in range(0, len(missing), MIGRATION_BATCH_SIZE):
+        conn.execute(
+            text(
+                "INSERT INTO categories (id, created_at, project_id, name, color) "
+                "VALUES (:id, :created_at, :project_id, :name, :color)"
+            ),
+            [
+                {'id': str(uuid.uuid4()), 'created_at': now, 'project_id': project_id, 'name': name, 'color': color}
+                for project_id, name, color in missing[i:i + MIGRATION_BATCH_SIZE]
+            ]
+        )
+
+    # Every annotation then points to the oldest category of its own project
+    # with that name, a range of annotation ids at a time
+    canonical = (
+        "SELECT c.id FROM images i "
+        "JOIN categories f ON f.id = annotations.category_id "
+        "JOIN categories c ON c.project_id = i.project_id AND lower(c.name) = lower(f.name) "
+        "WHERE i.id = annotations.image_id ORDER BY c.created_at, c.id LIMIT 1"
+    )
+    after = ''
+    while True:
+        upper = conn.execute(
+            text("SELECT id FROM annotations WHERE id > :after ORDER BY id LIMIT 1 OFFSET :offset"),
+            {'after': after, 'offset': MIGRATION_BATCH_SIZE - 1}
+        ).scalar()
+        in_range = "annotations.id > :after" + (" AND annotations.id <= :upper" if upper else "")
+        conn.execute(
+            text(f"UPDATE annotations SET category_id = ({canonical}) WHERE {in_range} AND category_id <> ({canonical})"),
+            {'after': after, 'upper': upper}
+        )
+        if upper is None:
+            break
+
+        after = upper
+
+    # Which leaves the later duplicates unused. Deleting one would cascade to
+    # its annotations, so one that is still referenced is kept
+    duplicates = conn.execute(text(
+        "SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+        "PARTITION BY project_id, lower(name) ORDER BY created_at, id) AS n FROM categories) AS ranked "
+        "WHERE n > 1"
+    )).scalars().all()
+    for i in range(0, len(duplicates), MIGRATION_BATCH_SIZE):
+        conn.execute(
+            text(
+                "DELETE FROM categories WHERE id IN :ids AND NOT EXISTS ("
+                "SELECT 1 FROM annotations a WHERE a.category_id = categories.id)"
+            ).bindparams(bindparam('ids', expanding=True)),
+            {'ids': duplicates[i:i + MIGRATION_BATCH_SIZE]}
+        )
+
+
+## Runner
+def _apply(engine: Engine, migration: Migration) -> None:
+    record = insert(schema_migrations).values(
+        version=migration.version,
+        name=migration.name,
+        applied_at=datetime.now()
+    )
+
+    if migration.transactional:
+        with engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+
+            migration.upgrade(conn)
+            conn.execute(record)
+
+        return
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(f"SET lock_timeout = '{LOCK_TIMEOUT}'"))
+
+        migration.upgrade(conn)
+        conn.execute(record)
+
+
+# Applies the migrations the database is missing, in version order
+def migrate(engine: Engine) -> list[int]:
+    applied = []
+    with engine.connect() as lock_conn:
+        postgres = lock_conn.dialect.name == 'postgresql'
+        if postgres:
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+            lock_conn.commit()
+
+        try:
+            with engine.begin() as conn:
+                schema_migrations.create(conn, checkfirst=True)
+                done = set((conn.execute(select(schema_migrations.c.version))).scalars())
+
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in done:
+                    continue
+
+                logger.info(f"Applying migration {migration.version} ({migration.name})")
+                _apply(engine, migration)
+                applied.append(migration.version)
+        finally:
+            if postgres:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+                lock_conn.commit()
+
+    return applied
+
+
+if __name__ == '__main__':
+    from storage.orm import engine
+
+    logging.basicConfig(level=logging.INFO)
+    print(f"Applied migrations: {migrate(engine) or 'none'}")
@@ -1,9 +1,44 @@
-from sqlmodel import SQLModel, Field, create_engine, Relationship
+from sqlmodel import SQLModel, Field, create_engine, Relationship, Column, Index, JSON
+from sqlalchemy import event
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import create_async_engine
 from config import get_settings
 from datetime import datetime
 
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+
+def make_async_url(database_uri: str) -> URL:
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+
+    # asyncpg takes `ssl` where libpq takes `sslmode`
+    if url.drivername == 'postgresql+asyncpg' and 'sslmode' in url.query:
+        query = dict(url.query)
+        query['ssl'] = query.pop('sslmode')
+        url = url.set(query=query)
+
+    return url
+
+
+# Deletes rely on ON DELETE CASCADE, which SQLite only enforces when asked to
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
 settings = get_settings()
 engine = create_engine(settings.database_uri)
+async_engine = create_async_engine(make_async_url(settings.database_uri))
+if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', enable_sqlite_foreign_keys)
+    event.listen(async_engine.sync_engine, 'connect', enable_sqlite_foreign_keys)
 
 
 class BaseORM(SQLModel):
@@ -20,8 +55,8 @@ class BaseORM(SQLModel):
 
 class AnnotationORM(BaseORM, table=True):
     __tablename__ = 'annotations'
-    image_id: str = Field(..., foreign_key='images.id', ondelete='CASCADE')
-    category_id: str = Field(..., foreign_key='categories.id', ondelete='CASCADE')
+    image_id: str = Field(..., foreign_key='images.id', ondelete='CASCADE', index=True)
+    category_id: str = Field(..., foreign_key='categories.id', ondelete='CASCADE', index=True)
     x: float
     y: float
     height: float
@@ -36,36 +71,91 @@ class DemoORM(BaseORM, table=True):
     url: str
 
 
+class StoredObjectORM(BaseORM, table=True):
+    __tablename__ = 'stored_objects'
+    # The id is the sha256 digest of the content
+    url: str
+    width: float
+    height: float
+    refcount: int = 0
+    # Downscaled copies, smallest first: [{'url', 'width', 'height'}]
+    variants: list = Field(default_factory=list, sa_column=Column(JSON))
+
+
+class JobORM(BaseORM, table=True):
+    __tablename__ = 'jobs'
+    kind: str
+    payload: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    status: str = Field(default='pending', index=True)
+    total: int = 0
+    done: int = 0
+    attempts: int = 0
+    error: str | None = None
+    result: dict | None = Field(default=None, sa_column=Column(JSON))
+    owner: str | None = None
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class ChangeORM(BaseORM, table=True):
+    __tablename__ = 'changes'
+    __table_args__ = (
+        Index('ix_changes_project_id_seq', 'project_id', 'seq', unique=True),
+    )
+    project_id: str = Field(..., foreign_key='projects.id', ondelete='CASCADE')
+    # Position in the project's log, the project revision is the last seq
+    seq: int
+    entity: str
+    op: str
+    ref: str
+    data: dict | None = Field(default=None, sa_column=Column(JSON))
+
+
 class ImageORM(BaseORM, table=True):
     __tablename__ = 'images'
+    __table_args__ = (
+        Index('ix_images_project_id_filename', 'project_id', 'filename', unique=True),
+        # Keyset pagination of a project's images
+        Index('ix_images_project_id_created_at_id', 'project_id', 'created_at', 'id')
+    )
     project_id: str = Field(..., foreign_key='projects.id', ondelete='CASCADE')
     url: str
     filename: str
     width: float
     height: float
+    digest: str | None = Field(default=None, index=True)
+    variants: list = Field(default_factory=list, sa_column=Column(JSON))
 
     project: 'ProjectORM' = Relationship(back_populates='images')
-    annotations: list[AnnotationORM] = Relationship(back_populates='image', cascade_delete=True)
+    annotations: list[AnnotationORM] = Relationship(back_populates='image', cascade_delete=True, passive_deletes=True)
 
 
 class CategoryORM(BaseORM, table=True):
     __tablename__ = 'categories'
+    __table_args__ = (
+        Index('ix_categories_project_id_name', 'project_id', 'name'),
+    )
     project_id: str = Field(..., foreign_key='projects.id', ondelete='CASCADE')
     name: str
     color: str
 
     project: 'ProjectORM' = Relationship(back_populates='categories')
-    annotations: list[AnnotationORM] = Relationship(back_populates='category', cascade_delete=True)
+    annotations: list[AnnotationORM] = Relationship(back_populates='category', cascade_delete=True, passive_deletes=True)
 
 
 class ProjectORM(BaseORM, table=True):
     __tablename__ = 'projects'
+    __table_args__ = (
+        # Keyset pagination of a user's projects
+        Index('ix_projects_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
     name: str = Field(..., unique=True)
     user_id: str = Field(..., foreign_key='users.id', ondelete='CASCADE')
+    # Seq of the project's latest change
+    revision: int = 0
 
     user: 'UserORM' = Relationship(back_populates='projects')
-    categories: list[CategoryORM] = Relationship(back_populates='project', cascade_delete=True)
-    images: list[ImageORM] = Relationship(back_populates='project', cascade_delete=True)
+    categories: list[CategoryORM] = Relationship(back_populates='project', cascade_delete=True, passive_deletes=True)
+    images: list[ImageORM] = Relationship(back_populates='project', cascade_delete=True, passive_deletes=True)
 
 
 class UserORM(BaseORM, table=True):
@@ -73,4 +163,4 @@ class UserORM(BaseORM, table=True):
     username: str = Field(..., unique=True)
     password: str
 
-    projects: list[ProjectORM] = Relationship(back_populates='user', cascade_delete=True)
+    projects: list[ProjectORM] = Relationship(back_populates='user', cascade_delete=True, passive_deletes=True)
@@ -1,272 +1,720 @@
-from src.models import User, Project, Image, Annotation, Category
-from storage.orm import UserORM, ProjectORM, ImageORM, AnnotationORM, CategoryORM, DemoORM
-from sqlmodel import Session, select
+import uuid
+import asyncio
+
+from collections import Counter
+from datetime import datetime
+from src.models import User, Project, Image, Annotation, Category, StoredObject, Job, Change
+from storage.orm import (
+    UserORM,
+    ProjectORM,
+    ImageORM,
+    AnnotationORM,
+    CategoryORM,
+    DemoORM,
+    StoredObjectORM,
+    JobORM,
+    ChangeORM
+)
+from sqlalchemy import DateTime, String, case, delete, event, func, insert, literal, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from abc import ABC, abstractmethod
-from pathlib import Path
+from typing import Callable, Sequence
 
 NOT_IMPLEMENTED_ERROR = NotImplementedError('Method must be implemented')
+# Rows per statement, keeps multi-row statements under the bound parameter
+# limits of SQLite and asyncpg
+BATCH_SIZE = 1000
+
+
+def chunked(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 ## Abstract Model Repositories
 class UserRepository(ABC):
     @abstractmethod
-    def add(self, user: User) -> str:
+    async def add(self, user: User, password_hash: str | None = None) -> str:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get(self, username: str) -> User | None:
+    async def get(self, username: str) -> User | None:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get_by_id(self, id: str) -> User | None:
+    async def get_by_id(self, id: str) -> User | None:
         raise NOT_IMPLEMENTED_ERROR
 
+    # Inserts the user under the first name from new_name that is not taken
     @abstractmethod
-    def get_usernames(self) -> list[str]:
+    async def add_unique(
+        self,
+        user: User,
+        new_name: Callable[[], str],
+        password_hash: str | None = None
+    ) -> str:
         raise NOT_IMPLEMENTED_ERROR
 
+    # Inserts the user unless its id is taken, in which case nothing is written
     @abstractmethod
-    def remove(self, id: str) -> None:
+    async def add_if_absent(self, user: User, password_hash: str | None = None) -> bool:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def remove(self, id: str) -> None:
         raise NOT_IMPLEMENTED_ERROR
 
 
 class ProjectRepository(ABC):
     @abstractmethod
-    def add(self, project: Project, user_id: str) -> str:
+    async def add(self, project: Project, user_id: str) -> str:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get(self, name: str) -> Project | None:
+    async def get(self, name: str) -> Project | None:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get_by_id(self, id: str) -> Project | None:
+    async def get_by_id(self, id: str) -> Project | None:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get_with_relationships(self, id: str) -> Project | None:
+    async def get_with_relationships(self, id: str, with_images: bool = True) -> Project | None:
         raise NOT_IMPLEMENTED_ERROR
 
+    # Pages are ordered by (created_at, id) and start after the key of the previous
+    # page's last row; the key of the last row is returned when more rows follow
     @abstractmethod
-    def get_project_image_names(self, id: str) -> list[str]:
+    async def get_images_page(
+        self,
+        id: str,
+        limit: int,
+        after: tuple[datetime, str] | None = None,
+        with_annotations: bool = False
+    ) -> tuple[list[Image], tuple[datetime, str] | None]:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def list(self, user_id: str) -> list[Project]:
+    async def list_page(
+        self,
+        user_id: str,
+        limit: int,
+        after: tuple[datetime, str] | None = None
+    ) -> tuple[list[Project], tuple[datetime, str] | None]:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def remove(self, id: str) -> None:
+    async def get_revision(self, id: str) -> int | None:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def export_project_data(self, id: str) -> dict:
+    async def get_user_id(self, id: str) -> str | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Inserts the project under the first name from new_name that is not taken
+    @abstractmethod
+    async def add_unique(self, project: Project, user_id: str, new_name: Callable[[], str]) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Inserts the project unless its id is taken, in which case nothing is written
+    @abstractmethod
+    async def add_if_absent(self, project: Project, user_id: str) -> bool:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Inserts the project unless its name is taken, in which case nothing is written
+    @abstractmethod
+    async def add_if_name_free(self, project: Project, user_id: str) -> bool:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def get_project_image_digests(self, id: str) -> list[str]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def list(self, user_id: str) -> list[Project]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def remove(self, id: str) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def export_project_data(self, id: str) -> dict:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Box geometry of every annotation of the project, one list per column.
+    # Images without annotations appear once with None in the annotation columns
+    @abstractmethod
+    async def get_annotation_columns(self, id: str) -> dict[str, list]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def clone(self, template_id: str, project_id: str) -> None:
         raise NOT_IMPLEMENTED_ERROR
 
 
 class AnnotationRepository(ABC):
     @abstractmethod
-    def add(self, annotation: Annotation, image_id: str, category_id: str) -> str:
+    async def add(self, annotation: Annotation, image_id: str, category_id: str) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Makes the annotations of each given image match its (annotation, category id)
+    # pairs, returns the number of inserted, updated and deleted annotations
+    @abstractmethod
+    async def sync_annotations(
+        self,
+        project_id: str,
+        annotations: dict[str, list[tuple[Annotation, str]]]
+    ) -> dict[str, int]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Upserts and deletes single annotations of the given images, leaving their
+    # other annotations alone. Ids used by annotations of other images are not
+    # written and are returned under 'rejected'
+    @abstractmethod
+    async def apply_annotation_changes(
+        self,
+        project_id: str,
+        upserts: dict[str, list[tuple[Annotation, str]]],
+        deletes: dict[str, list[str]]
+    ) -> dict:
         raise NOT_IMPLEMENTED_ERROR
 
 
 class CategoryRepository(ABC):
     @abstractmethod
-    def add(self, category: Category, project_id: str) -> str:
+    async def add(self, category: Category, project_id: str) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def get(self, name: str, project_id: str) -> Category | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Category name to id, for every category of the project
+    @abstractmethod
+    async def get_ids_by_name(self, project_id: str) -> dict[str, str]:
         raise NOT_IMPLEMENTED_ERROR
 
+    # Category id to name, for every category of the project
     @abstractmethod
-    def get(self, name: str) -> Category | None:
+    async def get_names_by_id(self, project_id: str) -> dict[str, str]:
         raise NOT_IMPLEMENTED_ERROR
 
 
 class ImageRepository(ABC):
     @abstractmethod
-    def add(self, image: Image, project_id: str) -> str:
+    async def add(self, image: Image, project_id: str) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Images whose filename is taken in the project are renamed with new_name
+    @abstractmethod
+    async def add_many(self, images: list[Image], project_id: str, new_name: Callable[[], str]) -> None:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def get_by_id(self, id: str) -> Image | None:
+    async def get_existing_ids(self, ids: list[str], project_id: str | None = None) -> set[str]:
         raise NOT_IMPLEMENTED_ERROR
 
+    # Maps the ids of the project's images among ids to their (width, height)
     @abstractmethod
-    def remove(self, id: str) -> None:
+    async def get_sizes(self, ids: list[str], project_id: str) -> dict[str, tuple[float, float]]:
         raise NOT_IMPLEMENTED_ERROR
 
     @abstractmethod
-    def remove_image_annotations(self, id: str) -> None:
+    async def get_by_id(self, id: str) -> Image | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Returns the id of the project the image belonged to
+    @abstractmethod
+    async def remove(self, id: str) -> str | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+
+class StoredObjectRepository(ABC):
+    @abstractmethod
+    async def add(self, stored_object: StoredObject) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def get_many(self, ids: list[str]) -> dict[str, StoredObject]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # Takes one reference per entry of objects, recreating objects that were
+    # released and removed since they were read
+    @abstractmethod
+    async def acquire(self, objects: list[StoredObject]) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def release(self, ids: list[str]) -> list[str]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    # The urls among urls that belong to a stored object, or to its variants
+    @abstractmethod
+    async def get_referenced_urls(self, urls: list[str]) -> set[str]:
+        raise NOT_IMPLEMENTED_ERROR
+
+
+class JobRepository(ABC):
+    @abstractmethod
+    async def add(self, job: Job) -> str:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def get_by_id(self, id: str) -> Job | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def claim(self, id: str) -> Job | None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def update(self, id: str, **fields) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def list_pending(self) -> list[str]:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def reset_stale(self, before: datetime) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+    @abstractmethod
+    async def reset_running(self, ids: list[str]) -> None:
+        raise NOT_IMPLEMENTED_ERROR
+
+
+class ChangeRepository(ABC):
+    # At most limit changes with a seq greater than since, in seq order
+    @abstractmethod
+    async def list_since(self, project_id: str, since: int, limit: int) -> list[Change]:
         raise NOT_IMPLEMENTED_ERROR
 
 
 class DemoRepository(ABC):
     @abstractmethod
-    def get_image_urls(self) -> list[str]:
+    async def get_image_urls(self) -> list[str]:
         raise NOT_IMPLEMENTED_ERROR
 
 
+## Change Log
+# Repositories buffer the changes they make to a project's images, annotations
+# and categories on the session. At commit, each project's revision is advanced
+# by the number of its changes and the changes are written with the resulting
+# sequence numbers; the row lock taken by that update orders concurrent writers.
+@event.listens_for(Session, 'before_commit')
+def write_change_log(session: Session) -> None:
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+
+    by_project = {}
+    for project_id, *change in changes:
+        by_project.setdefault(project_id, []).append(change)
+
+    for project_id, project_changes in by_project.items():
+        revision = session.execute(
+            update(ProjectORM)
+            .where(ProjectORM.id == project_id)
+            .values(revision=ProjectORM.revision + len(project_changes))
+            .returning(ProjectORM.revision)
+        ).scalar()
+        if revision is None:
+            # The project was removed in the same transaction
+            continue
+
+        first_seq = revision - len(project_changes) + 1
+        rows = [
+            {
+                'id': str(uuid.uuid4()),
+                'created_at': datetime.now(),
+                'project_id': project_id,
+                'seq': first_seq + i,
+                'entity': entity,
+                'op': op,
+                'ref': ref,
+                'data': data
+            }
+            for i, (entity, op, ref, data) in enumerate(project_changes)
+        ]
+        # Bound parameters are capped per statement by the drivers
+        for batch in chunked(rows, BATCH_SIZE):
+            session.execute(insert(ChangeORM).values(batch))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_change_log(session: Session) -> None:
+    session.info.pop('changes', None)
+
+
 ## Implementations of the Model Repositories
 class BaseSQLModelRepository:
-    def __init__(self, session: Session) -> None:
+    def __init__(self, session: AsyncSession) -> None:
         self._session = session
         super().__init__()
 
+    def _log_change(
+        self,
+        project_id: str,
+        entity: str,
+        op: str,
+        ref: str,
+        data: dict | None = None
+    ) -> None:
+        self._session.info.setdefault('changes', []).append((project_id, entity, op, ref, data))
+
+    def _insert(self, table):
+        # ON CONFLICT is only available on the dialect specific insert
+        dialect = postgresql if self._session.bind.dialect.name == 'postgresql' else sqlite
+
+        return dialect.insert(table)
+
+    async def _insert_unique(self, table, values: dict, name_field: str, new_name: Callable[[], str]) -> None:
+        # The unique index decides which name is free, a taken one is simply retried
+        while True:
+            values[name_field] = new_name()
+            statement = (
+                self._insert(table)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=[name_field])
+                .returning(table.id)
+            )
+            if (await self._session.exec(statement)).first():
+                return
+
+    async def _insert_if_absent(self, table, values: dict, key: str = 'id') -> bool:
+        # A concurrent insert of the same key waits for the other transaction and then does nothing
+        statement = (
+            self._insert(table)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=[key])
+            .returning(table.id)
+        )
+
+        return (await self._session.exec(statement)).first() is not None
+
 
 class SQLModelUserRepsitory(BaseSQLModelRepository, UserRepository):
-    def add(self, user: User) -> str:
+    @staticmethod
+    async def _hash_password(password: str) -> str:
         import bcrypt
 
-        password_hash = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
-        user_orm = UserORM(password=password_hash.decode('utf-8'), **user.to_dict())
+        # bcrypt is deliberately slow, keep it off the event loop
+        return (await asyncio.to_thread(
+            bcrypt.hashpw,
+            password.encode('utf-8'),
+            bcrypt.gensalt()
+        )).decode('utf-8')
+
+    async def add(self, user: User, password_hash: str | None = None) -> str:
+        if password_hash is None:
+            password_hash = await self._hash_password(user.password)
+
+        user_orm = UserORM(password=password_hash, **user.to_dict())
         self._session.add(user_orm)
 
         return user_orm.id
 
-    def get(self, username: str) -> User | None:
+    async def get(self, username: str) -> User | None:
         statement = select(UserORM).where(UserORM.username == username)
         try:
-            user_orm = self._session.exec(statement).one()
+            user_orm = (await self._session.exec(statement)).one()
         except Exception:
             return None
 
         return User(**user_orm.model_dump())
 
-    def get_by_id(self, id: str) -> User | None:
-        user_orm = self._session.get(UserORM, id)
+    async def get_by_id(self, id: str) -> User | None:
+        user_orm = await self._session.get(UserORM, id)
         if user_orm:
             return User(**user_orm.model_dump())
 
         return None
 
-    def get_usernames(self) -> list[str]:
-        return [
-            user.username
-            for user in self._session.exec(select(UserORM)).all()
-        ]
+    async def add_unique(
+        self,
+        user: User,
+        new_name: Callable[[], str],
+        password_hash: str | None = None
+    ) -> str:
+        if password_hash is None:
+            password_hash = await self._hash_password(user.password)
 
-    def remove(self, id: str) -> None:
-        statement = select(UserORM).where(UserORM.id == id)
-        user_orm = self._session.exec(statement).first()
-        if user_orm:
-            self._session.delete(user_orm)
+        values = {**user.to_dict(), 'password': password_hash, 'created_at': datetime.now()}
+        await self._insert_unique(UserORM, values, 'username', new_name)
+        user.username = values['username']
+
+        return user.id
+
+    async def add_if_absent(self, user: User, password_hash: str | None = None) -> bool:
+        if password_hash is None:
+            password_hash = await self._hash_password(user.password)
+
+        values = {**user.to_dict(), 'password': password_hash, 'created_at': datetime.now()}
+
+        return await self._insert_if_absent(UserORM, values)
+
+    # Projects and everything under them go with the user through ON DELETE CASCADE
+    async def remove(self, id: str) -> None:
+        await self._session.exec(delete(UserORM).where(UserORM.id == id))
 
 
 class SQLModelProjectRepository(BaseSQLModelRepository, ProjectRepository):
-    def add(self, project: Project, user_id: str) -> str:
+    async def add(self, project: Project, user_id: str) -> str:
         project_orm = ProjectORM(user_id=user_id, **project.to_dict())
         self._session.add(project_orm)
 
         return project_orm.id
 
-    def get(self, name: str) -> Project | None:
+    async def add_unique(self, project: Project, user_id: str, new_name: Callable[[], str]) -> str:
+        values = {**project.to_dict(), 'user_id': user_id, 'created_at': datetime.now()}
+        await self._insert_unique(ProjectORM, values, 'name', new_name)
+        project.name = values['name']
+
+        return project.id
+
+    async def add_if_absent(self, project: Project, user_id: str) -> bool:
+        values = {**project.to_dict(), 'user_id': user_id, 'created_at': datetime.now()}
+
+        return await self._insert_if_absent(ProjectORM, values)
+
+    async def add_if_name_free(self, project: Project, user_id: str) -> bool:
+        values = {**project.to_dict(), 'user_id': user_id, 'created_at': datetime.now()}
+
+        return await self._insert_if_absent(ProjectORM, values, key='name')
+
+    async def get(self, name: str) -> Project | None:
         statement = select(ProjectORM).where(ProjectORM.name == name)
         try:
-            project_orm = self._session.exec(statement).one()
+            project_orm = (await self._session.exec(statement)).one()
         except Exception:
             return None
 
         return Project(**project_orm.model_dump())
 
-    def get_by_id(self, id: str) -> Project | None:
-        project_orm = self._session.get(ProjectORM, id)
+    async def get_by_id(self, id: str) -> Project | None:
+        project_orm = await self._session.get(ProjectORM, id)
         if project_orm:
             return Project(**project_orm.model_dump())
 
         return None
 
-    def get_project_image_names(self, id: str) -> list[str]:
-        return [
-            Path(img.url).stem
-            for img in self._session.exec(select(ImageORM).where(ImageORM.project_id == id)).all()
-        ]
+    async def get_project_image_digests(self, id: str) -> list[str]:
+        statement = select(ImageORM.digest).where(
+            ImageORM.project_id == id,
+            ImageORM.digest.is_not(None)
+        )
 
-    def get_with_relationships(self, id: str) -> Project | None:
-        project_orm = self._session.get(ProjectORM, id)
-        if project_orm is None:
-            return None
+        return list((await self._session.exec(statement)).all())
 
-        project = Project(**project_orm.model_dump())
-        categories = [
-            Category(**category.model_dump())
-            for category in project_orm.categories
-        ]
+    async def get_revision(self, id: str) -> int | None:
+        statement = select(ProjectORM.revision).where(ProjectORM.id == id)
 
-        images = [
-            Image(**image.model_dump())
-            for image in project_orm.images
-        ]
+        return (await self._session.exec(statement)).first()
 
-        for image, image_orm in zip(images, project_orm.images):
-            annotations = [
-                Annotation(**annotation.model_dump())
-                for annotation in image_orm.annotations
-            ]
+    async def get_user_id(self, id: str) -> str | None:
+        statement = select(ProjectORM.user_id).where(ProjectORM.id == id)
+
+        return (await self._session.exec(statement)).first()
 
-            for a, a_orm in zip(annotations, image_orm.annotations):
-                a.category = Category(**a_orm.category.model_dump())
+    async def get_with_relationships(self, id: str, with_images: bool = True) -> Project | None:
+        project_orm = await self._session.get(ProjectORM, id)
+        if project_orm is None:
+            return None
 
-            image.annotations = annotations
+        # A fixed number of set-based queries, regardless of the project size
+        category_orms = (await self._session.exec(
+            select(CategoryORM).where(CategoryORM.project_id == id)
+        )).all()
+        categories = {
+            category_orm.id: Category(**category_orm.model_dump())
+            for category_orm in category_orms
+        }
 
-        project.categories = categories
-        project.images = images
+        project = Project(**project_orm.model_dump())
+        project.categories = list(categories.values())
+        if with_images:
+            image_orms = (await self._session.exec(
+                select(ImageORM).where(ImageORM.project_id == id)
+            )).all()
+            annotation_orms = await self._get_project_annotations(id)
+            project.images = await self._build_images(image_orms, annotation_orms, categories)
 
         return project
 
-    def list(self, user_id: str = None) -> list[Project]:
+    async def get_images_page(
+        self,
+        id: str,
+        limit: int,
+        after: tuple[datetime, str] | None = None,
+        with_annotations: bool = False
+    ) -> tuple[list[Image], tuple[datetime, str] | None]:
+        statement = select(ImageORM).where(ImageORM.project_id == id)
+        if after:
+            statement = statement.where(tuple_(ImageORM.created_at, ImageORM.id) > after)
+
+        # One extra row tells whether another page follows
+        image_orms = (await self._session.exec(
+            statement.order_by(ImageORM.created_at, ImageORM.id).limit(limit + 1)
+        )).all()
+        image_orms, next_key = self._page(image_orms, limit)
+
+        if not with_annotations:
+            return [Image(**image_orm.model_dump()) for image_orm in image_orms], next_key
+
+        annotation_orms = (await self._session.exec(
+            select(AnnotationORM).where(AnnotationORM.image_id.in_([i.id for i in image_orms]))
+        )).all()
+
+        return await self._build_images(image_orms, annotation_orms, {}), next_key
+
+    async def list_page(
+        self,
+        user_id: str,
+        limit: int,
+        after: tuple[datetime, str] | None = None
+    ) -> tuple[list[Project], tuple[datetime, str] | None]:
+        statement = select(ProjectORM).where(ProjectORM.user_id == user_id)
+        if after:
+            statement = statement.where(tuple_(ProjectORM.created_at, ProjectORM.id) > after)
+
+        project_orms = (await self._session.exec(
+            statement.order_by(ProjectORM.created_at, ProjectORM.id).limit(limit + 1)
+        )).all()
+        project_orms, next_key = self._page(project_orms, limit)
+
+        return [Project(**project_orm.model_dump()) for project_orm in project_orms], next_key
+
+    @staticmethod
+    def _page(orms: Sequence, limit: int) -> tuple[Sequence, tuple[datetime, str] | None]:
+        if len(orms) <= limit:
+            return orms, None
+
+        orms = orms[:limit]
+
+        return orms, (orms[-1].created_at, orms[-1].id)
+
+    async def _build_images(
+        self,
+        image_orms: Sequence[ImageORM],
+        annotation_orms: Sequence[AnnotationORM],
+        categories: dict[str, Category]
+    ) -> list[Image]:
+        # Annotations may point at categories outside of the given ones
+        missing_category_ids = {a_orm.category_id for a_orm in annotation_orms} - categories.keys()
+        if missing_category_ids:
+            categories = dict(categories)
+            for category_orm in (await self._session.exec(
+                select(CategoryORM).where(CategoryORM.id.in_(missing_category_ids))
+            )).all():
+                categories[category_orm.id] = Category(**category_orm.model_dump())
+
+        images = {}
+        for image_orm in image_orms:
+            image = Image(**image_orm.model_dump())
+            image.annotations = []
+            images[image_orm.id] = image
+
+        for a_orm in annotation_orms:
+            annotation = Annotation(**a_orm.model_dump())
+            annotation.category = categories[a_orm.category_id]
+            images[a_orm.image_id].annotations.append(annotation)
+
+        return list(images.values())
+
+    async def list(self, user_id: str = None) -> list[Project]:
         if user_id:
-            user_orm = self._session.get(UserORM, user_id)
+            user_orm = await self._session.get(UserORM, user_id)
             if not user_orm:
                 return []
 
             return [
                 Project(**project_orm.model_dump())
-                for project_orm in self._session.exec(
+                for project_orm in (await self._session.exec(
                     select(ProjectORM).where(ProjectORM.user_id == user_id)
-                ).all()
+                )).all()
             ]
 
         return [
             Project(**project_orm.model_dump())
-            for project_orm in self._session.exec(select(ProjectORM)).all()
+            for project_orm in (await self._session.exec(select(ProjectORM))).all()
         ]
 
-    def remove(self, id: str) -> None:
-        project_orm = self._session.get(ProjectORM, id)
-        if project_orm:
-            self._session.delete(project_orm)
+    async def remove(self, id: str) -> None:
+        await self._session.exec(delete(ProjectORM).where(ProjectORM.id == id))
+
+    async def get_annotation_columns(self, id: str) -> dict[str, list]:
+        names = (
+            'image_id',
+            'image_width',
+            'image_height',
+            'annotation_id',
+            'category_id',
+            'category_name',
+            'width',
+            'height'
+        )
+        # The category is joined by id, so one of another project still gets its own name
+        rows = (await self._session.exec(
+            select(
+                ImageORM.id,
+                ImageORM.width,
+                ImageORM.height,
+                AnnotationORM.id,
+                AnnotationORM.category_id,
+                CategoryORM.name,
+                AnnotationORM.width,
+                AnnotationORM.height
+            )
+            .select_from(ImageORM)
+            .outerjoin(AnnotationORM, AnnotationORM.image_id == ImageORM.id)
+            .outerjoin(CategoryORM, CategoryORM.id == AnnotationORM.category_id)
+            .where(ImageORM.project_id == id)
+        )).all()
+
+        return dict(zip(names, map(list, zip(*rows)))) if rows else {name: [] for name in names}
 
-    def export_project_data(self, id: str) -> dict:
+    async def export_project_data(self, id: str) -> dict:
         project = {}
-        project_orm = self._session.get(ProjectORM, id)
+        project_orm = await self._session.get(ProjectORM, id)
         if project_orm:
             categories = [
                 {'id': category_orm.id, 'name': category_orm.name}
-                for category_orm in project_orm.categories
+                for category_orm in (await self._session.exec(
+                    select(CategoryORM).where(CategoryORM.project_id == id)
+                )).all()
             ]
 
             images = []
             image_urls = []
-            annotations = []
-            for image_orm in project_orm.images:
+            for image_orm in (await self._session.exec(
+                select(ImageORM).where(ImageORM.project_id == id)
+            )).all():
                 image_dict = image_orm.model_dump()
                 image_urls.append(image_dict.pop('url'))
+                del image_dict['digest']
+                del image_dict['variants']
                 images.append(image_dict)
 
-                for annotation_orm in image_orm.annotations:
-                    annotation = {
-                        'id': annotation_orm.id,
-                        'image_id': annotation_orm.image_id,
-                        'category_id': annotation_orm.category_id,
-                        'iscrowd': 0,
-                        'area': annotation_orm.width * annotation_orm.height,
-                        'bbox': [
-                            annotation_orm.x,
-                            annotation_orm.y,
-                            annotation_orm.width,
-                            annotation_orm.height
-                        ]
-                    }
-
-                    annotations.append(annotation)
+            annotations = [
+                {
+                    'id': annotation_orm.id,
+                    'image_id': annotation_orm.image_id,
+                    'category_id': annotation_orm.category_id,
+                    'iscrowd': 0,
+                    'area': annotation_orm.width * annotation_orm.height,
+                    'bbox': [
+                        annotation_orm.x,
+                        annotation_orm.y,
+                        annotation_orm.width,
+                        annotation_orm.height
+                    ]
+                }
+                for annotation_orm in await self._get_project_annotations(id)
+            ]
 
             project.update(
                 name=project_orm.name.lower(),
@@ -278,63 +726,484 @@ class SQLModelProjectRepository(BaseSQLModelRepository, ProjectRepository):
 
         return project
 
+    async def clone(self, template_id: str, project_id: str) -> None:
+        await self._session.flush()
+
+        # Cloned rows get ids derived from the new project id and the template row
+        # id, so every table is copied with a single INSERT ... SELECT
+        def cloned_id(column):
+            return literal(f"{project_id}:", String).concat(column)
+
+        # Bound like the timestamps of every other insert, so keyset cursors compare
+        # them the same way; the database clock and format are never used
+        now = literal(datetime.now(), DateTime)
+
+        template_images = select(ImageORM.id).where(ImageORM.project_id == template_id)
+        statements = [
+            insert(CategoryORM).from_select(
+                ['id', 'created_at', 'project_id', 'name', 'color'],
+                select(
+                    cloned_id(CategoryORM.id),
+                    now,
+                    literal(project_id),
+                    CategoryORM.name,
+                    CategoryORM.color
+                ).where(CategoryORM.project_id == template_id)
+            ),
+            insert(ImageORM).from_select(
+                [
+                    'id', 'created_at', 'project_id', 'url', 'filename',
+                    'width', 'height', 'digest', 'variants'
+                ],
+                select(
+                    cloned_id(ImageORM.id),
+                    now,
+                    literal(project_id),
+                    ImageORM.url,
+                    ImageORM.filename,
+                    ImageORM.width,
+                    ImageORM.height,
+                    ImageORM.digest,
+                    ImageORM.variants
+                ).where(ImageORM.project_id == template_id)
+            ),
+            insert(AnnotationORM).from_select(
+                ['id', 'created_at', 'image_id', 'category_id', 'x', 'y', 'height', 'width'],
+                select(
+                    cloned_id(AnnotationORM.id),
+                    now,
+                    cloned_id(AnnotationORM.image_id),
+                    cloned_id(AnnotationORM.category_id),
+                    AnnotationORM.x,
+                    AnnotationORM.y,
+                    AnnotationORM.height,
+                    AnnotationORM.width
+                ).where(AnnotationORM.image_id.in_(template_images))
+            ),
+            # The clone shares the template's stored objects, take a reference per image
+            update(StoredObjectORM)
+            .where(StoredObjectORM.id.in_(
+                select(ImageORM.digest).where(ImageORM.project_id == project_id)
+            ))
+            .values(refcount=StoredObjectORM.refcount + (
+                select(func.count())
+                .select_from(ImageORM)
+                .where(ImageORM.project_id == project_id, ImageORM.digest == StoredObjectORM.id)
+                .scalar_subquery()
+            ))
+        ]
+
+        for statement in statements:
+            await self._session.exec(statement)
+
+    async def _get_project_annotations(self, id: str) -> Sequence[AnnotationORM]:
+        statement = (
+            select(AnnotationORM)
+            .join(ImageORM, AnnotationORM.image_id == ImageORM.id)
+            .where(ImageORM.project_id == id)
+        )
+
+        return (await self._session.exec(statement)).all()
+
 
 class SQLModelImageRepository(BaseSQLModelRepository, ImageRepository):
-    def add(self, image: Image, project_id: str) -> str:
+    async def add(self, image: Image, project_id: str) -> str:
         image_orm = ImageORM(project_id=project_id, **image.to_dict())
         self._session.add(image_orm)
+        self._log_change(project_id, 'image', 'insert', image_orm.id, image.to_dict())
 
         return image_orm.id
 
-    def get_by_id(self, id: str) -> Image | None:
-        image_orm = self._session.get(ImageORM, id)
+    async def add_many(self, images: list[Image], project_id: str, new_name: Callable[[], str]) -> None:
+        # All images go in one round trip, only those whose filename is taken in
+        # the project are renamed and inserted again
+        pending = images
+        while pending:
+            statement = (
+                self._insert(ImageORM)
+                .values([
+                    {**image.to_dict(), 'project_id': project_id, 'created_at': datetime.now()}
+                    for image in pending
+                ])
+                .on_conflict_do_nothing(index_elements=['project_id', 'filename'])
+                .returning(ImageORM.id)
+            )
+            inserted = set((await self._session.exec(statement)).scalars().all())
+
+            pending = [image for image in pending if image.id not in inserted]
+            for image in pending:
+                image.filename = new_name()
+
+        for image in images:
+            self._log_change(project_id, 'image', 'insert', image.id, image.to_dict())
+
+    async def get_existing_ids(self, ids: list[str], project_id: str | None = None) -> set[str]:
+        statement = select(ImageORM.id).where(ImageORM.id.in_(set(ids)))
+        if project_id:
+            statement = statement.where(ImageORM.project_id == project_id)
+
+        return set((await self._session.exec(statement)).all())
+
+    async def get_sizes(self, ids: list[str], project_id: str) -> dict[str, tuple[float, float]]:
+        rows = await self._session.exec(
+            select(ImageORM.id, ImageORM.width, ImageORM.height)
+            .where(ImageORM.id.in_(set(ids)), ImageORM.project_id == project_id)
+        )
+
+        return {id: (width, height) for id, width, height in rows}
+
+    async def get_by_id(self, id: str) -> Image | None:
+        image_orm = await self._session.get(ImageORM, id)
         if image_orm:
             return Image(**image_orm.model_dump())
 
         return None
 
-    def remove(self, id: str) -> None:
-        image_orm = self._session.get(ImageORM, id)
-        if image_orm:
-            self._session.delete(image_orm)
-
-    def remove_image_annotations(self, id: str) -> None:
-        image_orm = self._session.get(ImageORM, id)
-        if image_orm:
-            for a in image_orm.annotations:
-                self._session.delete(a)
+    async def remove(self, id: str) -> str | None:
+        project_id = (await self._session.exec(
+            delete(ImageORM).where(ImageORM.id == id).returning(ImageORM.project_id)
+        )).scalar()
+        if project_id:
+            self._log_change(project_id, 'image', 'delete', id)
 
-        self._session.commit()
+        return project_id
 
 
 class SQLModelAnnotationRepository(AnnotationRepository, BaseSQLModelRepository):
-    def add(self, annotation: Annotation, image_id: str, category_id: str) -> str:
+    async def add(self, annotation: Annotation, image_id: str, category_id: str) -> str:
         annotation_orm = AnnotationORM(category_id=category_id, image_id=image_id, **annotation.to_dict())
         self._session.add(annotation_orm)
 
+        image_orm = await self._session.get(ImageORM, image_id)
+        self._log_change(
+            image_orm.project_id,
+            'annotation',
+            'insert',
+            annotation_orm.id,
+            {**annotation.to_dict(), 'image_id': image_id, 'category_id': category_id}
+        )
+
         return annotation_orm.id
 
+    _columns = (
+        AnnotationORM.id,
+        AnnotationORM.image_id,
+        AnnotationORM.category_id,
+        AnnotationORM.x,
+        AnnotationORM.y,
+        AnnotationORM.width,
+        AnnotationORM.height
+    )
+
+    async def sync_annotations(
+        self,
+        project_id: str,
+        annotations: dict[str, list[tuple[Annotation, str]]]
+    ) -> dict[str, int]:
+        stored = {}
+        for image_ids in chunked(list(annotations), BATCH_SIZE):
+            stored.update(
+                (row.id, row)
+                for row in (await self._session.exec(
+                    select(*self._columns).where(AnnotationORM.image_id.in_(image_ids))
+                )).all()
+            )
+
+        # Ids are assigned by the client, the last occurrence of an id wins and
+        # an annotation may move between the given images
+        incoming = {
+            annotation.id: {**annotation.to_dict(), 'image_id': image_id, 'category_id': category_id}
+            for image_id, pairs in annotations.items()
+            for annotation, category_id in pairs
+        }
+
+        inserts, updates = self._diff(stored, incoming)
+        deletes = [row for id, row in stored.items() if id not in incoming]
+        await self._write(project_id, inserts, updates, deletes)
+
+        return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(deletes)}
+
+    async def apply_annotation_changes(
+        self,
+        project_id: str,
+        upserts: dict[str, list[tuple[Annotation, str]]],
+        deletes: dict[str, list[str]]
+    ) -> dict:
+        incoming = {
+            annotation.id: {**annotation.to_dict(), 'image_id': image_id, 'category_id': category_id}
+            for image_id, pairs in upserts.items()
+            for annotation, category_id in pairs
+        }
+        removed = {id: image_id for image_id, ids in deletes.items() for id in ids}
+
+        stored = {}
+        for ids in chunked(list(incoming.keys() | removed.keys()), BATCH_SIZE):
+            stored.update(
+                (row.id, row)
+                for row in (await self._session.exec(
+                    select(*self._columns).where(AnnotationORM.id.in_(ids))
+                )).all()
+            )
+
+        image_ids = upserts.keys() | deletes.keys()
+        rejected = [id for id, row in stored.items() if row.image_id not in image_ids]
+        for id in rejected:
+            incoming.pop(id, None)
+            stored.pop(id)
+
+        inserts, updates = self._diff(stored, incoming)
+        delete_rows = [stored[id] for id in removed if id in stored and id not in incoming]
+        await self._write(project_id, inserts, updates, delete_rows)
+
+        return {
+            'inserted': len(inserts),
+            'updated': len(updates),
+            'deleted': len(delete_rows),
+            'rejected': rejected
+        }
+
+    @staticmethod
+    def _diff(stored: dict, incoming: dict[str, dict]) -> tuple[list[dict], list[dict]]:
+        inserts, updates = [], []
+        for id, values in incoming.items():
+            row = stored.get(id)
+            if row is None:
+                inserts.append(values)
+            elif any(getattr(row, k) != v for k, v in values.items()):
+                updates.append(values)
+
+        return inserts, updates
+
+    async def _write(
+        self,
+        project_id: str,
+        inserts: list[dict],
+        updates: list[dict],
+        deletes: list
+    ) -> None:
+        for rows in chunked(deletes, BATCH_SIZE):
+            await self._session.exec(
+                delete(AnnotationORM).where(AnnotationORM.id.in_([row.id for row in rows]))
+            )
+
+        if updates:
+            # Bulk UPDATE by primary key, one statement executed for all rows
+            await self._session.exec(update(AnnotationORM), params=updates)
+
+        now = datetime.now()
+        for rows in chunked(inserts, BATCH_SIZE):
+            # An id already used by an annotation of another image is replaced
+            taken = set((await self._session.exec(
+                select(AnnotationORM.id).where(AnnotationORM.id.in_([v['id'] for v in rows]))
+            )).all())
+            for values in rows:
+                if values['id'] in taken:
+                    values['id'] = str(uuid.uuid4())
+
+            await self._session.exec(insert(AnnotationORM).values([
+                {**values, 'created_at': now} for values in rows
+            ]))
+
+        for op, rows in (('insert', inserts), ('update', updates)):
+            for values in rows:
+                self._log_change(project_id, 'annotation', op, values['id'], values)
+
+        for row in deletes:
+            self._log_change(project_id, 'annotation', 'delete', row.id, {'image_id': row.image_id})
+
 
 class SQLModelCategoryRepository(CategoryRepository, BaseSQLModelRepository):
-    def add(self, category: Category, project_id: str) -> str:
+    async def add(self, category: Category, project_id: str) -> str:
         category_orm = CategoryORM(project_id=project_id, **category.to_dict())
         self._session.add(category_orm)
+        self._log_change(project_id, 'category', 'insert', category_orm.id, category.to_dict())
 
         return category_orm.id
 
-    def get(self, name: str) -> Category | None:
-        statement = select(CategoryORM).where(CategoryORM.name == name)
-        try:
-            category_orm = self._session.exec(statement).one()
-        except Exception:
+    async def get(self, name: str, project_id: str) -> Category | None:
+        statement = select(CategoryORM).where(
+            CategoryORM.project_id == project_id,
+            CategoryORM.name == name
+        )
+        category_orm = (await self._session.exec(statement)).first()
+        if category_orm is None:
             return None
 
         return Category(**category_orm.model_dump())
 
+    async def get_ids_by_name(self, project_id: str) -> dict[str, str]:
+        statement = select(CategoryORM.name, CategoryORM.id).where(CategoryORM.project_id == project_id)
+
+        return dict((await self._session.exec(statement)).all())
+
+    async def get_names_by_id(self, project_id: str) -> dict[str, str]:
+        statement = (
+            select(CategoryORM.id, CategoryORM.name)
+            .where(CategoryORM.project_id == project_id)
+            .order_by(CategoryORM.name, CategoryORM.id)
+        )
+
+        return dict((await self._session.exec(statement)).all())
+
+
+class SQLModelStoredObjectRepository(StoredObjectRepository, BaseSQLModelRepository):
+    async def add(self, stored_object: StoredObject) -> str:
+        # Concurrent uploads of the same content race to insert the same digest
+        statement = (
+            self._insert(StoredObjectORM)
+            .values(**StoredObjectORM(**stored_object.to_dict()).model_dump(), created_at=func.now())
+            .on_conflict_do_nothing(index_elements=['id'])
+        )
+        await self._session.exec(statement)
+
+        return stored_object.id
+
+    async def get_many(self, ids: list[str]) -> dict[str, StoredObject]:
+        statement = select(StoredObjectORM).where(StoredObjectORM.id.in_(set(ids)))
+
+        return {
+            object_orm.id: StoredObject(**object_orm.model_dump())
+            for object_orm in (await self._session.exec(statement)).all()
+        }
+
+    async def acquire(self, objects: list[StoredObject]) -> None:
+        counts = Counter(stored_object.id for stored_object in objects)
+        by_id = {stored_object.id: stored_object for stored_object in objects}
+
+        # Insert-or-increment in one statement, so a reference is never taken on
+        # a row that a concurrent release has just removed
+        for ids in chunked(list(counts), BATCH_SIZE):
+            statement = self._insert(StoredObjectORM).values([
+                {
+                    **StoredObjectORM(**by_id[id].to_dict()).model_dump(),
+                    'refcount': counts[id],
+                    'created_at': datetime.now()
+                }
+                for id in ids
+            ])
+            statement = statement.on_conflict_do_update(
+                index_elements=['id'],
+                set_={'refcount': StoredObjectORM.refcount + statement.excluded.refcount}
+            ).returning(StoredObjectORM.id)
+
+            acquired = set((await self._session.exec(statement)).scalars())
+            if acquired != set(ids):
+                raise RuntimeError(f"References on {set(ids) - acquired} could not be taken")
+
+    async def release(self, ids: list[str]) -> list[str]:
+        unreferenced = []
+        counts = Counter(ids)
+        for chunk in chunked(list(counts), BATCH_SIZE):
+            await self._session.exec(
+                update(StoredObjectORM)
+                .where(StoredObjectORM.id.in_(chunk))
+                .values(refcount=StoredObjectORM.refcount - case(
+                    {id: counts[id] for id in chunk},
+                    value=StoredObjectORM.id
+                ))
+            )
+
+            # Objects no longer referenced by any image are removed, their urls and
+            # the urls of their variants are returned so that the caller can delete
+            # them from storage after commit
+            unreferenced += (await self._session.exec(
+                delete(StoredObjectORM)
+                .where(StoredObjectORM.id.in_(chunk), StoredObjectORM.refcount <= 0)
+                .returning(StoredObjectORM.url, StoredObjectORM.variants)
+            )).all()
+
+        return [
+            url
+            for object_url, variants in unreferenced
+            for url in [object_url] + [variant['url'] for variant in variants or []]
+        ]
+
+    async def get_referenced_urls(self, urls: list[str]) -> set[str]:
+        referenced = set()
+        for chunk in chunked(list(set(urls)), BATCH_SIZE):
+            for object_url, variants in (await self._session.exec(
+                select(StoredObjectORM.url, StoredObjectORM.variants).where(StoredObjectORM.url.in_(chunk))
+            )).all():
+                referenced.add(object_url)
+                referenced.update(variant['url'] for variant in variants or [])
+
+        return referenced
+
+
+class SQLModelJobRepository(JobRepository, BaseSQLModelRepository):
+    async def add(self, job: Job) -> str:
+        job_orm = JobORM(**job.to_dict())
+        self._session.add(job_orm)
+
+        return job_orm.id
+
+    async def get_by_id(self, id: str) -> Job | None:
+        job_orm = await self._session.get(JobORM, id)
+        if job_orm:
+            return Job(**job_orm.model_dump())
+
+        return None
+
+    async def claim(self, id: str) -> Job | None:
+        # Only one worker can move a pending job to running
+        statement = (
+            update(JobORM)
+            .where(JobORM.id == id, JobORM.status == 'pending')
+            .values(status='running', attempts=JobORM.attempts + 1, updated_at=datetime.now())
+        )
+        if (await self._session.exec(statement)).rowcount != 1:
+            return None
+
+        job_orm = await self._session.get(JobORM, id, populate_existing=True)
+
+        return Job(**job_orm.model_dump())
+
+    async def update(self, id: str, **fields) -> None:
+        await self._session.exec(
+            update(JobORM)
+            .where(JobORM.id == id)
+            .values(**fields, updated_at=datetime.now())
+        )
+
+    async def list_pending(self) -> list[str]:
+        statement = select(JobORM.id).where(JobORM.status == 'pending').order_by(JobORM.created_at)
+
+        return list((await self._session.exec(statement)).all())
+
+    async def reset_stale(self, before: datetime) -> None:
+        # Jobs left running by a worker that went away are picked up again
+        await self._session.exec(
+            update(JobORM)
+            .where(JobORM.status == 'running', JobORM.updated_at < before)
+            .values(status='pending')
+        )
+
+    async def reset_running(self, ids: list[str]) -> None:
+        await self._session.exec(
+            update(JobORM)
+            .where(JobORM.id.in_(ids), JobORM.status == 'running')
+            .values(status='pending', updated_at=datetime.now())
+        )
+
+
+class SQLModelChangeRepository(ChangeRepository, BaseSQLModelRepository):
+    async def list_since(self, project_id: str, since: int, limit: int) -> list[Change]:
+        statement = (
+            select(ChangeORM)
+            .where(ChangeORM.project_id == project_id, ChangeORM.seq > since)
+            .order_by(ChangeORM.seq)
+            .limit(limit)
+        )
+
+        return [
+            Change(**change_orm.model_dump())
+            for change_orm in (await self._session.exec(statement)).all()
+        ]
+
 
 class SQLModelDemoRepository(DemoRepository, BaseSQLModelRepository):
-    def get_image_urls(self) -> list[str]:
+    async def get_image_urls(self) -> list[str]:
         return [
             demo.url
-            for demo in self._session.exec(select(DemoORM)).all()
+            for demo in (await self._session.exec(select(DemoORM))).all()
         ]
@@ -0,0 +1,169 @@
+import os
+import tempfile
+import uuid
+
+# Settings are read when the app is imported, so the environment is set up
+# first. Tests run against a throwaway SQLite database and local storage.
+TEST_DIR = tempfile.mkdtemp(prefix='annotate-x-tests-')
+os.environ.update(
+    CONFIG='test',
+    DATABASE_URI=f"sqlite:///{TEST_DIR}/test.db",
+    STORAGE_BACKEND='local',
+    LOCAL_STORAGE_DIR=f"{TEST_DIR}/media",
+    IMAGE_CACHE_DIR=f"{TEST_DIR}/image-cache",
+    JOB_STAGING_DIR=f"{TEST_DIR}/staging",
+    TRANSFER_BACKOFF_BASE='0.01'
+)
+for key in (
+    'SECRET_KEY',
+    'DATABASE_USERNAME',
+    'DATABASE_HOST',
+    'DATABASE',
+    'DATABASE_PASSWORD',
+    'CLOUDINARY_CLOUD_NAME',
+    'CLOUDINARY_API_KEY',
+    'CLOUDINARY_API_SECRET'
+):
+    os.environ.setdefault(key, 'test')
+
+import pytest
+
+from contextlib import contextmanager
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.models import Annotation, Category, Image, Project, User
+from storage.orm import async_engine
+from storage.repository import (
+    SQLModelAnnotationRepository,
+    SQLModelCategoryRepository,
+    SQLModelImageRepository,
+    SQLModelProjectRepository,
+    SQLModelUserRepsitory
+)
+
+
+@pytest.fixture(scope='session')
+def client():
+    from fastapi_main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+# Runs fn(db) on the event loop of the app, with a session of its own
+@pytest.fixture
+def run_db(client):
+    def run(fn, *args):
+        async def call():
+            async with AsyncSession(async_engine, expire_on_commit=False) as db:
+                return await fn(db, *args)
+
+        return client.portal.call(call)
+
+    return run
+
+
+# Counts the statements sent to the database while the block runs
+@pytest.fixture
+def count_statements():
+    @contextmanager
+    def count():
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_engine.sync_engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(async_engine.sync_engine, 'before_cursor_execute', record)
+
+    return count
+
+
+# Signs a new user in on the shared client and returns their id
+@pytest.fixture
+def signed_in(client, run_db):
+    username = f"user-{uuid.uuid4().hex[:8]}"
+    client.get('/signout')
+    client.post('/signup', json={'username': username, 'password': 'pw'})
+    client.post('/signin', json={'username': username, 'password': 'pw'})
+
+    async def get_id(db):
+        return (await SQLModelUserRepsitory(db).get(username)).id
+
+    return run_db(get_id)
+
+
+# Builds a project of n_images images of 100x100 with n_boxes boxes each
+@pytest.fixture
+def make_project(run_db):
+    def make(
+        user_id: str | None = None,
+        n_images: int = 2,
+        n_boxes: int = 2,
+        categories: tuple[str, ...] = ('car',)
+    ) -> dict:
+        async def build(db):
+            if user_id is None:
+                owner_id = await SQLModelUserRepsitory(db).add(
+                    User(f"owner-{uuid.uuid4().hex[:8]}", 'pw'),
+                    password_hash='pw'
+                )
+            else:
+                owner_id = user_id
+
+            project = Project(f"project-{uuid.uuid4().hex[:8]}")
+            await SQLModelProjectRepository(db).add(project, owner_id)
+            category_ids = []
+            for name in categories:
+                category_ids.append(await SQLModelCategoryRepository(db).add(Category(name, 'red'), project.id))
+
+            images = {}
+            for i in range(n_images):
+                image = Image(f"/media/{uuid.uuid4().hex}.png", 100, 100, f"image-{i}.png")
+                await SQLModelImageRepository(db).add(image, project.id)
+                images[image.id] = []
+                for j in range(n_boxes):
+                    annotation = Annotation(j, j, 10, 10)
+                    await SQLModelAnnotationRepository(db).add(
+                        annotation,
+                        image.id,
+                        category_ids[j % len(category_ids)]
+                    )
+                    images[image.id].append(annotation.id)
+
+            await db.commit()
+
+            return {'id': project.id, 'user_id': owner_id, 'images': images, 'categories': category_ids}
+
+        return run_db(build)
+
+    return make
+
+
+def box(id: str | None = None, x: float = 1, y: float = 1, width: float = 10, height: float = 10, category: str = 'car') -> dict:
+    return {
+        'id': id or str(uuid.uuid4()),
+        'x': x,
+        'y': y,
+        'width': width,
+        'height': height,
+        'category': {'id': '', 'name': category, 'color': 'red'}
+    }
+
+
+# Follows the cursors of a paginated endpoint, returns every item in order
+def walk_pages(client, url: str, key: str, limit: int) -> list[dict]:
+    items, cursor = [], None
+    while True:
+        params = {'limit': limit, **({'cursor': cursor} if cursor else {})}
+        response = client.get(url, params=params)
+        assert response.status_code == 200
+        data = response.json()['data']
+        items += data[key]
+        cursor = data['next']
+        if cursor is None:
+            return items
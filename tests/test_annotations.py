@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import time
+
+from starlette.websockets import WebSocketDisconnect
+from fastapi_app import settings
+from fastapi_app.core.annotations import clip_boxes
+from tests.conftest import box
+
+
+## Validation
+def test_boxes_are_clipped_to_their_image():
+    boxes = np.array([
+        [10, 10, 20, 20],
+        [-5, 90, 20, 20],
+        [30, 30, -10, -20],
+        [99.5, 10, 5, 5],
+        [np.nan, 0, 10, 10]
+    ], dtype=np.float64)
+    sizes = np.full((len(boxes), 2), 100.0)
+
+    corrected, kept, changed = clip_boxes(boxes, sizes, min_size=1.0)
+
+    assert corrected[:3].tolist() == [[10, 10, 20, 20], [0, 90, 15, 10], [20, 10, 10, 20]]
+    assert kept.tolist() == [True, True, True, False, False]
+    assert changed.tolist() == [False, True, True, False, False]
+
+
+def test_boxes_are_snapped_to_whole_pixels_only_when_asked():
+    boxes = np.array([[1.2, 1.6, 10.2, 10.0], [2.0, 2.0, 5.0, 5.0]])
+    sizes = np.full((2, 2), 100.0)
+
+    corrected, _, changed = clip_boxes(boxes, sizes, min_size=1.0)
+    assert corrected.tolist() == boxes.tolist() and not changed.any()
+
+    corrected, _, changed = clip_boxes(boxes, sizes, min_size=1.0, snap=True)
+    assert corrected.tolist() == [[1, 2, 10, 10], [2, 2, 5, 5]]
+    assert changed.tolist() == [True, False]
+
+
+## Autosave
+@pytest.fixture
+def autosave(client, monkeypatch):
+    # Only explicit flushes write, so every ack in a test is accounted for
+    monkeypatch.setattr(settings, 'autosave_flush_interval', 60.0)
+
+    def connect(project_id: str):
+        return client.websocket_connect(f"/projects/{project_id}/autosave")
+
+    return connect
+
+
+def stored_boxes(client, project_id: str) -> dict[str, dict]:
+    images = client.get(f"/projects/{project_id}/images?annotations=true").json()['data']['images']
+
+    return {a['id']: a for img in images for a in img['annotations']}
+
+
+def test_autosave_coalesces_puts_and_acknowledges_the_flush(client, signed_in, make_project, autosave, count_statements):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    annotation = box()
+
+    with autosave(project['id']) as ws:
+        for seq, x in enumerate((1, 2, 3), start=1):
+            ws.send_json({'op': 'put', 'seq': seq, 'image': image_id, 'annotation': {**annotation, 'x': x}})
+
+        with count_statements() as statements:
+            ws.send_json({'op': 'flush', 'seq': 4})
+            ack = ws.receive_json()
+
+    assert ack['type'] == 'ack' and ack['seq'] == 4
+    assert (ack['inserted'], ack['updated'], ack['rejected']) == (1, 0, [])
+    assert sum(statement.startswith('INSERT INTO annotations') for statement in statements) == 1
+    assert stored_boxes(client, project['id'])[annotation['id']]['x'] == 3
+    assert ack['revision'] == client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+
+
+def test_autosave_rejects_images_of_another_project(client, signed_in, make_project, autosave):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    other = make_project(n_images=1, n_boxes=0)
+    other_image, = other['images']
+    annotation = box()
+
+    with autosave(project['id']) as ws:
+        ws.send_json({'op': 'put', 'seq': 1, 'image': other_image, 'annotation': annotation})
+        ws.send_json({'op': 'flush', 'seq': 2})
+        ack = ws.receive_json()
+
+    assert (ack['seq'], ack['inserted'], ack['rejected']) == (2, 0, [annotation['id']])
+    assert stored_boxes(client, other['id']) == {}
+
+
+def test_autosave_is_closed_for_anyone_but_the_owner(client, signed_in, make_project, autosave):
+    other = make_project(n_images=1, n_boxes=0)
+
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with autosave(other['id']) as ws:
+            ws.receive_json()
+
+    assert closed.value.code == 1008
+
+
+def test_autosave_flushes_pending_changes_on_disconnect(client, signed_in, make_project, autosave):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    annotation = box()
+
+    with autosave(project['id']) as ws:
+        ws.send_json({'op': 'put', 'seq': 1, 'image': image_id, 'annotation': annotation})
+
+    # The flush runs as the handler winds down
+    for _ in range(100):
+        if annotation['id'] in stored_boxes(client, project['id']):
+            break
+
+        time.sleep(0.02)
+
+    assert annotation['id'] in stored_boxes(client, project['id'])
@@ -0,0 +1,99 @@
+from fastapi_app.core.dependencies import lookup_cache
+from sqlmodel import update
+from fastapi_app.routers.auth import DEMO_TEMPLATE_ID, DEMO_TEMPLATE_OWNER_ID, get_demo_template
+from src.models import Project
+from storage.orm import ProjectORM, UserORM
+from storage.repository import SQLModelProjectRepository
+
+
+## Demo
+def test_demo_template_is_not_taken_from_a_user_project_of_the_same_name(client, make_project, run_db):
+    impostor = make_project(n_images=3, n_boxes=1)
+
+    # Both names are free for anyone to take
+    async def rename(db):
+        await db.exec(update(UserORM).where(UserORM.id == impostor['user_id']).values(username='demo-template'))
+        await db.exec(update(ProjectORM).where(ProjectORM.id == impostor['id']).values(name='DEMO-TEMPLATE'))
+        await db.commit()
+
+    run_db(rename)
+
+    client.get('/signout')
+    response = client.get('/demo-signin')
+    assert response.status_code == 200
+    project_id = response.json()['data']['id']
+
+    async def read(db, id):
+        project = await SQLModelProjectRepository(db).get_with_relationships(id)
+
+        return project, await SQLModelProjectRepository(db).get_user_id(DEMO_TEMPLATE_ID)
+
+    project, owner_id = run_db(read, project_id)
+    assert project.images == []
+    assert owner_id == DEMO_TEMPLATE_OWNER_ID
+
+    client.get('/signout')
+
+
+def test_demo_template_built_by_another_worker_is_reused(client, run_db):
+    async def build(db):
+        return await get_demo_template(db)
+
+    assert run_db(build) == DEMO_TEMPLATE_ID
+
+    # A worker that lost the race finds the id taken and writes nothing
+    async def add_again(db):
+        return await SQLModelProjectRepository(db).add_if_absent(
+            Project('another-template', id=DEMO_TEMPLATE_ID),
+            DEMO_TEMPLATE_OWNER_ID
+        )
+
+    assert run_db(add_again) is False
+
+
+def test_demo_signin_while_signed_in_returns_the_existing_project(client):
+    client.get('/signout')
+    project_id = client.get('/demo-signin').json()['data']['id']
+
+    response = client.get('/demo-signin')
+    assert response.status_code == 200
+    assert response.json()['data']['id'] == project_id
+
+    client.get('/signout')
+
+
+def test_demo_signin_while_signed_in_without_projects(client, signed_in):
+    response = client.get('/demo-signin')
+    assert response.status_code == 200
+    assert response.json()['data']['id'] is None
+
+    client.get('/signout')
+
+
+## Lookup cache
+def test_signout_drops_the_cached_user(client, signed_in):
+    assert client.get('/projects').status_code == 200
+    assert client.portal.call(lookup_cache.get, f"user:{signed_in}") is not None
+
+    client.get('/signout')
+
+    assert client.portal.call(lookup_cache.get, f"user:{signed_in}") is None
+
+
+def test_demo_signout_drops_the_removed_user_and_projects(client, run_db):
+    client.get('/signout')
+    project_id = client.get('/demo-signin').json()['data']['id']
+    assert client.get(f"/projects/{project_id}/images").status_code == 200
+
+    async def get_user_id(db):
+        return await SQLModelProjectRepository(db).get_user_id(project_id)
+
+    user_id = run_db(get_user_id)
+    assert client.portal.call(lookup_cache.get, f"user:{user_id}") is not None
+    assert client.portal.call(lookup_cache.get, f"project:{project_id}") is not None
+
+    client.get('/signout')
+
+    assert client.portal.call(lookup_cache.get, f"user:{user_id}") is None
+    assert client.portal.call(lookup_cache.get, f"project:{project_id}") is None
+    assert run_db(get_user_id) is None
@@ -0,0 +1,134 @@
+import asyncio
+import io
+import pytest
+import time
+import uuid
+
+from fastapi_app.core.jobs import JobQueue, stage_files, upload_images
+from src.models import Job
+from tests.test_main_endpoints import png
+from storage.repository import SQLModelJobRepository
+
+
+def wait_for_job(client, id: str) -> dict:
+    for _ in range(200):
+        job = client.get(f"/jobs/{id}").json()['data']
+        if job['status'] not in ('pending', 'running'):
+            return job
+
+        time.sleep(0.05)
+
+    raise AssertionError(f"Job {id} did not finish")
+
+
+def upload(client, project_id: str, files: list[tuple[str, bytes]]) -> dict:
+    response = client.post(
+        f"/projects/{project_id}/images",
+        files=[('files', (name, content, 'image/png')) for name, content in files]
+    )
+    assert response.status_code == 202
+
+    return wait_for_job(client, response.json()['data']['job'])
+
+
+## Uploads
+def test_upload_where_every_file_failed_ends_failed(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=0)
+
+    job = upload(client, project['id'], [('a.png', b'not an image'), ('b.png', b'nor this')])
+
+    assert job['status'] == 'failed'
+    assert job['result'] == {'images': [], 'failed': ['a.png', 'b.png']}
+
+
+def test_upload_where_some_files_failed_ends_partial(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=0)
+
+    job = upload(client, project['id'], [('a.png', png(20, 10)), ('b.png', b'not an image')])
+
+    assert job['status'] == 'partial'
+    assert [img['width'] for img in job['result']['images']] == [20]
+    assert job['result']['failed'] == ['b.png']
+
+
+def test_upload_retried_after_a_failure_lists_each_failed_file_once(make_project, run_db, tmp_path):
+    project = make_project(n_images=0)
+    contents = {'a.png': png(20, 10), 'b.png': b'not an image'}
+    files = [
+        {'id': str(uuid.uuid4()), 'name': name, 'original': name, 'content_type': 'image/png'}
+        for name in contents
+    ]
+    payload = {'project_id': project['id'], 'directory': str(tmp_path / 'staged'), 'files': files}
+
+    async def add(db):
+        id = await SQLModelJobRepository(db).add(Job('upload_images', payload, total=len(files)))
+        await db.commit()
+
+        return id
+
+    async def attempt(db, id):
+        stage_files(tmp_path / 'staged', [(name, io.BytesIO(content), None) for name, content in contents.items()])
+        job = await SQLModelJobRepository(db).get_by_id(id)
+
+        return await upload_images(db, job)
+
+    id = run_db(add)
+    assert run_db(attempt, id)['failed'] == ['b.png']
+
+    # The image stored by the first attempt is not uploaded again
+    result = run_db(attempt, id)
+    assert result['failed'] == ['b.png']
+    assert [img['filename'] for img in result['images']] == ['a.png']
+
+
+## Shutdown
+def test_jobs_cut_off_by_stop_go_back_to_pending(client, run_db):
+    queue = JobQueue(workers=1, max_attempts=3, stale_after=3600)
+    started = asyncio.Event()
+
+    @queue.handler('block')
+    async def block(db, job):
+        started.set()
+        await asyncio.Event().wait()
+
+    async def scenario(db):
+        id = await queue.add(db, 'block', {})
+        await db.commit()
+
+        queue._queue = asyncio.Queue()
+        queue._tasks = [asyncio.create_task(queue._work())]
+        queue.submit(id)
+        await started.wait()
+        await queue.stop()
+
+        return id
+
+    id = run_db(scenario)
+
+    async def read(db):
+        return await SQLModelJobRepository(db).get_by_id(id)
+
+    job = run_db(read)
+    assert (job.status, job.attempts) == ('pending', 1)
+
+
+def test_a_job_that_crashes_is_not_left_to_stop(run_db):
+    queue = JobQueue(workers=1, max_attempts=3, stale_after=3600)
+
+    @queue.handler('noop')
+    async def noop(db, job):
+        return None
+
+    async def crash(db, job):
+        raise RuntimeError('database went away')
+
+    queue._execute = crash
+
+    async def scenario(db):
+        id = await queue.add(db, 'noop', {})
+        await db.commit()
+        with pytest.raises(RuntimeError):
+            await queue._run(id)
+
+    run_db(scenario)
+    assert queue._running == set()
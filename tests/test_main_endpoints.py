@@ -0,0 +1,368 @@
+import io
+import json
+import msgpack
+import os
+import pytest
+import uuid
+import zipfile
+
+from datetime import datetime
+from fastapi_app.core.dependencies import lookup_cache
+from PIL import Image as PILImage
+from sqlmodel import update
+from src.models import Annotation
+from storage.repository import (
+    BATCH_SIZE,
+    SQLModelAnnotationRepository,
+    SQLModelImageRepository,
+    SQLModelProjectRepository
+)
+from storage.orm import ImageORM, ProjectORM
+from tests.conftest import box, walk_pages
+
+
+def png(width: int, height: int) -> bytes:
+    content = io.BytesIO()
+    PILImage.new('RGB', (width, height), 'red').save(content, 'PNG')
+
+    return content.getvalue()
+
+
+## Projects
+def test_creating_a_project_under_a_taken_name_is_rejected(client, signed_in):
+    form = {'name': f"taken-{uuid.uuid4().hex[:8]}", 'classes': json.dumps({'car': 'red'})}
+    files = [('files', ('a.png', png(10, 10), 'image/png'))]
+
+    assert client.post('/projects', data=form, files=files).status_code == 201
+
+    response = client.post('/projects', data=form, files=files)
+    assert response.status_code == 400
+    assert response.json()['message'] == 'Project name already exist'
+
+
+
+def test_unchanged_project_is_answered_with_not_modified(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=2, n_boxes=1)
+    url = f"/projects/{project['id']}"
+
+    response = client.get(url)
+    etag = response.headers['etag']
+    assert etag == f'"{response.json()["data"]["revision"]}"'
+    assert response.headers['cache-control'] == 'no-cache'
+
+    for if_none_match in (etag, f'W/{etag}', f'"0", {etag}', '*'):
+        response = client.get(url, headers={'If-None-Match': if_none_match})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+
+    assert client.get(url, headers={'If-None-Match': '"0"'}).status_code == 200
+
+
+def test_write_to_a_project_invalidates_its_etag(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    url = f"/projects/{project['id']}"
+    response = client.get(url)
+    etag, revision = response.headers['etag'], response.json()['data']['revision']
+
+    client.post(f"{url}/images/{image_id}/annotations", json=[box()])
+
+    # The old tag no longer matches, the new payload carries the new revision
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['data']['revision'] == revision + 1
+    assert response.headers['etag'] == f'"{revision + 1}"'
+    assert len(response.json()['data']['images'][0]['annotations']) == 1
+
+    assert client.get(url, headers={'If-None-Match': response.headers['etag']}).status_code == 304
+
+
+
+def test_deleted_project_is_not_served_from_the_lookup_cache(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    url = f"/projects/{project['id']}/images"
+    assert client.get(url).status_code == 200
+    assert client.portal.call(lookup_cache.get, f"project:{project['id']}") is not None
+
+    assert client.delete(f"/projects/{project['id']}").status_code == 200
+
+    assert client.portal.call(lookup_cache.get, f"project:{project['id']}") is None
+    assert client.get(url).status_code == 404
+
+
+
+def test_project_is_sent_as_msgpack_to_clients_that_accept_it(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=2, n_boxes=2)
+    url = f"/projects/{project['id']}"
+    as_json = client.get(url)
+
+    response = client.get(url, headers={'Accept': 'application/json, application/msgpack;q=0.5'})
+    assert response.headers['content-type'] == 'application/msgpack'
+    assert 'accept' in response.headers['vary'].lower()
+    assert msgpack.unpackb(response.content) == as_json.json()
+
+    for accept in ('application/msgpack;q=0', 'application/json', '*/*'):
+        response = client.get(url, headers={'Accept': accept})
+        assert response.headers['content-type'] == 'application/json'
+        assert response.json() == as_json.json()
+
+
+def test_etag_of_one_format_does_not_match_another(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=1)
+    url = f"/projects/{project['id']}"
+    msgpack_headers = {'Accept': 'application/msgpack'}
+    response = client.get(url)
+    json_etag, revision = response.headers['etag'], response.json()['data']['revision']
+    msgpack_etag = client.get(url, headers=msgpack_headers).headers['etag']
+    assert (json_etag, msgpack_etag) == (f'"{revision}"', f'"{revision}-msgpack"')
+
+    # A cached msgpack body must never be revalidated for a JSON client
+    response = client.get(url, headers={'If-None-Match': msgpack_etag})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    assert response.json()['data']['id'] == project['id']
+
+    response = client.get(url, headers={**msgpack_headers, 'If-None-Match': json_etag})
+    assert response.status_code == 200
+    assert msgpack.unpackb(response.content)['data']['id'] == project['id']
+
+    assert client.get(url, headers={**msgpack_headers, 'If-None-Match': msgpack_etag}).status_code == 304
+
+
+## Pagination
+def test_cloned_project_pages_through_every_image(client, signed_in, make_project, run_db):
+    template = make_project(n_images=5, n_boxes=1)
+    project = make_project(user_id=signed_in, n_images=0)
+
+    async def clone(db):
+        await SQLModelProjectRepository(db).clone(template['id'], project['id'])
+        await db.commit()
+
+    run_db(clone)
+
+    images = walk_pages(client, f"/projects/{project['id']}/images", 'images', limit=2)
+    assert sorted(img['filename'] for img in images) == [f"image-{i}.png" for i in range(5)]
+    assert len({img['id'] for img in images}) == 5
+
+
+
+# Rows created within the same clock tick share created_at, the id breaks the tie
+TIED_AT = datetime(2024, 1, 1)
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 10])
+def test_images_page_through_ties_without_duplicates(limit, client, signed_in, make_project, run_db):
+    project = make_project(user_id=signed_in, n_images=7, n_boxes=0)
+    tied = list(project['images'])[:5]
+
+    async def tie(db):
+        await db.exec(update(ImageORM).where(ImageORM.id.in_(tied)).values(created_at=TIED_AT))
+        await db.commit()
+
+    run_db(tie)
+
+    images = walk_pages(client, f"/projects/{project['id']}/images", 'images', limit=limit)
+    ids = [img['id'] for img in images]
+    assert len(ids) == len(set(ids)) == 7
+    assert ids[:5] == sorted(tied)
+
+
+@pytest.mark.parametrize('limit', [1, 2, 4])
+def test_projects_page_through_ties_without_duplicates(limit, client, signed_in, make_project, run_db):
+    ids = [make_project(user_id=signed_in, n_images=0)['id'] for _ in range(4)]
+    make_project(n_images=0)
+
+    async def tie(db):
+        await db.exec(update(ProjectORM).where(ProjectORM.id.in_(ids)).values(created_at=TIED_AT))
+        await db.commit()
+
+    run_db(tie)
+
+    projects = walk_pages(client, '/projects', 'projects', limit=limit)
+    assert [project['id'] for project in projects] == sorted(ids)
+
+
+@pytest.mark.parametrize('url', ['/projects', '/projects/{id}/images'])
+@pytest.mark.parametrize('cursor', ['not-a-cursor', 'W10=', 'WzEsICJhIl0='])
+def test_bad_cursor_is_rejected(url, cursor, client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+
+    response = client.get(url.format(id=project['id']), params={'cursor': cursor})
+    assert response.status_code == 400
+    assert response.json()['message'] == 'Invalid cursor'
+
+
+## Annotations
+def test_batch_save_writes_the_boxes_of_every_image(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=2, n_boxes=2)
+    first, second = project['images']
+    kept = project['images'][first][0]
+    before = client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+
+    response = client.post(f"/projects/{project['id']}/annotations", json={
+        first: [box(kept, x=5, y=5), box(), box()],
+        second: []
+    })
+    assert response.status_code == 200
+    data = response.json()['data']
+    assert (data['inserted'], data['updated'], data['deleted']) == (2, 1, 3)
+
+    images = client.get(f"/projects/{project['id']}/images?annotations=true").json()['data']['images']
+    boxes = {img['id']: img['annotations'] for img in images}
+    assert len(boxes[first]) == 3 and boxes[second] == []
+
+    changes = client.get(f"/projects/{project['id']}/changes?since={before}").json()['data']['changes']
+    assert sorted(change['op'] for change in changes) == ['delete'] * 3 + ['insert'] * 2 + ['update']
+
+
+def test_saving_an_image_of_another_project_is_rejected(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    other = make_project(n_images=1, n_boxes=2)
+    other_image, = other['images']
+    revision = client.get(f"/projects/{other['id']}?images=false").json()['data']['revision']
+
+    response = client.post(f"/projects/{project['id']}/images/{other_image}/annotations", json=[box()])
+    assert response.status_code == 404
+
+    assert client.get(f"/projects/{other['id']}?images=false").json()['data']['revision'] == revision
+    images = client.get(f"/projects/{other['id']}/images?annotations=true").json()['data']['images']
+    assert {a['id'] for a in images[0]['annotations']} == set(other['images'][other_image])
+
+
+def test_saving_an_image_writes_only_what_changed(client, signed_in, make_project, count_statements):
+    statement_counts = []
+    for n_boxes in (5, 50):
+        project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+        image_id, = project['images']
+        url = f"/projects/{project['id']}/images/{image_id}/annotations"
+        boxes = [box(x=i, y=i) for i in range(n_boxes)]
+        client.post(url, json=boxes)
+        revision = client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+
+        # Saving the same boxes again writes nothing
+        data = client.post(url, json=boxes).json()['data']
+        assert (data['inserted'], data['updated'], data['deleted']) == (0, 0, 0)
+        assert client.get(f"/projects/{project['id']}?images=false").json()['data']['revision'] == revision
+
+        with count_statements() as statements:
+            data = client.post(url, json=[{**boxes[0], 'x': 50}, *boxes[1:]]).json()['data']
+
+        assert (data['inserted'], data['updated'], data['deleted']) == (0, 1, 0)
+        statement_counts.append(len(statements))
+
+    assert statement_counts[0] == statement_counts[1]
+
+
+def test_saved_boxes_are_fitted_to_their_image(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    inside, overflowing, outside = box(x=10, y=10), box(x=95, y=-5, width=10, height=10), box(x=150, y=150)
+
+    response = client.post(
+        f"/projects/{project['id']}/images/{image_id}/annotations",
+        json=[inside, overflowing, outside]
+    )
+    data = response.json()['data']
+    assert (data['inserted'], data['corrected'], data['dropped']) == (2, [overflowing['id']], [outside['id']])
+
+    images = client.get(f"/projects/{project['id']}/images?annotations=true").json()['data']['images']
+    stored = {a['id']: (a['x'], a['y'], a['width'], a['height']) for a in images[0]['annotations']}
+    assert stored == {inside['id']: (10, 10, 10, 10), overflowing['id']: (95, 0, 5, 5)}
+
+
+# SQLite binds at most 250000 parameters per statement and PostgreSQL 32767
+def test_batch_save_logs_changes_in_bounded_inserts(client, signed_in, make_project, count_statements):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    n = 2 * BATCH_SIZE + 1
+    before = client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+
+    with count_statements() as statements:
+        response = client.post(f"/projects/{project['id']}/annotations", json={image_id: [box() for _ in range(n)]})
+
+    assert response.status_code == 200
+    assert response.json()['data']['inserted'] == n
+    assert sum(statement.startswith('INSERT INTO changes') for statement in statements) == 3
+
+    revision = client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+    assert revision == before + n
+
+
+## Changes
+def test_changes_since_a_revision_are_returned_in_order(client, signed_in, make_project):
+    project = make_project(user_id=signed_in, n_images=1, n_boxes=0)
+    image_id, = project['images']
+    url = f"/projects/{project['id']}/images/{image_id}/annotations"
+    since = client.get(f"/projects/{project['id']}?images=false").json()['data']['revision']
+
+    first, second = box(), box()
+    client.post(url, json=[first, second])
+    client.post(url, json=[{**first, 'x': 5}])
+
+    data = client.get(f"/projects/{project['id']}/changes?since={since}").json()['data']
+    assert [(c['seq'], c['op'], c['ref']) for c in data['changes']] == [
+        (since + 1, 'insert', first['id']),
+        (since + 2, 'insert', second['id']),
+        (since + 3, 'update', first['id']),
+        (since + 4, 'delete', second['id'])
+    ]
+    assert (data['revision'], data['more']) == (since + 4, False)
+
+    # A client that has seen part of them only gets the rest, a page at a time
+    data = client.get(f"/projects/{project['id']}/changes?since={since + 2}&limit=1").json()['data']
+    assert [c['seq'] for c in data['changes']] == [since + 3]
+    assert (data['revision'], data['more']) == (since + 3, True)
+
+    etag = client.get(f"/projects/{project['id']}").headers['etag']
+    assert etag == f'"{since + 4}"'
+
+
+## Stats
+def test_stats_count_boxes_under_the_category_they_point_to(client, signed_in, make_project, run_db):
+    project = make_project(user_id=signed_in, n_images=2, n_boxes=2, categories=('car', 'car'))
+    other = make_project(n_images=0, categories=('bus',))
+    image_id = next(iter(project['images']))
+
+    # Left behind by the category mixup between projects
+    async def add_foreign_box(db):
+        await SQLModelAnnotationRepository(db).add(Annotation(0, 0, 10, 10), image_id, other['categories'][0])
+        await db.commit()
+
+    run_db(add_foreign_box)
+
+    stats = client.get(f"/projects/{project['id']}/stats").json()['data']
+    assert stats['annotations'] == 5
+    assert stats['images_without_annotations'] == []
+
+    counts = {category['id']: (category['name'], category['annotations']) for category in stats['categories']}
+    assert counts == {
+        project['categories'][0]: ('car', 2),
+        project['categories'][1]: ('car', 2),
+        other['categories'][0]: ('bus', 1)
+    }
+
+
+## Export
+def test_export_lists_images_that_could_not_be_fetched(client, make_project, run_db):
+    project = make_project(n_images=2, n_boxes=1)
+    stored_id, missing_id = project['images']
+
+    async def get_url(db, id):
+        return (await SQLModelImageRepository(db).get_by_id(id)).url
+
+    # Only the first image exists in storage
+    url = run_db(get_url, stored_id)
+    with open(os.path.join(os.environ['LOCAL_STORAGE_DIR'], url.rsplit('/', 1)[-1]), 'wb') as f:
+        f.write(png(100, 100))
+
+    response = client.get(f"/export/{project['id']}")
+    assert response.status_code == 200
+
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
+        dataset = json.loads(zip_file.read('annotations.json'))
+        failed = json.loads(zip_file.read('failed.json'))
+
+    assert [img['id'] for img in dataset['images']] == [stored_id]
+    assert {a['image_id'] for a in dataset['annotations']} == {stored_id}
+    assert failed == {'images': [{'id': missing_id, 'filename': 'image-1.png'}]}
@@ -0,0 +1,28 @@
+import pytest
+
+from fastapi_app import settings
+
+METRICS = ['/metrics/http-pool', '/metrics/image-cache', '/metrics/lookup-cache', '/metrics/stats-cache']
+
+
+@pytest.fixture
+def metrics_enabled(monkeypatch):
+    monkeypatch.setattr(settings, 'metrics_enabled', True)
+
+
+@pytest.mark.parametrize('url', METRICS)
+def test_metrics_are_not_served_unless_enabled(url, client, signed_in):
+    assert client.get(url).status_code == 404
+
+
+@pytest.mark.parametrize('url', METRICS)
+def test_metrics_are_only_served_to_signed_in_users(url, client, metrics_enabled):
+    client.get('/signout')
+    assert client.get(url).status_code == 401
+
+
+@pytest.mark.parametrize('url', METRICS)
+def test_enabled_metrics_are_served(url, client, signed_in, metrics_enabled):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json()['status'] == 'success'
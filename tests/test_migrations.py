@@ -0,0 +1,116 @@
+import pytest
+
+from sqlalchemy import event
+from sqlmodel import select
+from src.models import Annotation
+from storage import migrations
+from storage.migrations import scope_annotation_categories
+from storage.orm import AnnotationORM, CategoryORM, engine
+from storage.repository import SQLModelAnnotationRepository
+
+
+## Data migrations
+# Runs a non-transactional migration the way the runner does
+def run_upgrade(upgrade) -> None:
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        upgrade(conn)
+
+
+# Projects whose annotations point to categories of another project or to duplicates
+@pytest.fixture
+def misplaced(make_project, run_db, monkeypatch):
+    monkeypatch.setattr(migrations, 'MIGRATION_BATCH_SIZE', 2)
+    own = make_project(n_images=1, n_boxes=0, categories=('car',))
+    other = make_project(n_images=1, n_boxes=0, categories=('car', 'Car', 'bus'))
+    car, duplicate, bus = other['categories']
+    own_image, = own['images']
+    other_image, = other['images']
+
+    async def add_boxes(db):
+        repo = SQLModelAnnotationRepository(db)
+        ids = {
+            'foreign_car': await repo.add(Annotation(0, 0, 10, 10), own_image, car),
+            'foreign_bus': await repo.add(Annotation(0, 0, 10, 10), own_image, bus),
+            'duplicate': await repo.add(Annotation(0, 0, 10, 10), other_image, duplicate)
+        }
+        for i in range(4):
+            ids[f"duplicate-{i}"] = await repo.add(Annotation(i, i, 10, 10), other_image, duplicate)
+
+        await db.commit()
+
+        return ids
+
+    ids = run_db(add_boxes)
+
+    async def read(db):
+        categories = {
+            id: (project_id, name)
+            for id, project_id, name in (await db.exec(
+                select(CategoryORM.id, CategoryORM.project_id, CategoryORM.name)
+                .where(CategoryORM.project_id.in_([own['id'], other['id']]))
+            )).all()
+        }
+        annotations = dict((await db.exec(
+            select(AnnotationORM.id, AnnotationORM.category_id).where(AnnotationORM.id.in_(list(ids.values())))
+        )).all())
+
+        return categories, annotations
+
+    return own, other, ids, lambda: run_db(read)
+
+
+def test_annotations_are_moved_to_categories_of_their_own_project(misplaced):
+    own, other, ids, read = misplaced
+    car, duplicate, bus = other['categories']
+
+    run_upgrade(scope_annotation_categories)
+
+    categories, annotations = read()
+    assert categories[annotations[ids['foreign_car']]] == (own['id'], 'car')
+    assert annotations[ids['foreign_car']] == own['categories'][0]
+    assert categories[annotations[ids['foreign_bus']]] == (own['id'], 'bus')
+    assert annotations[ids['duplicate']] == car
+    assert all(annotations[ids[f"duplicate-{i}"]] == car for i in range(4))
+    assert duplicate not in categories
+    assert sorted(categories.values()) == sorted([
+        (own['id'], 'bus'),
+        (own['id'], 'car'),
+        (other['id'], 'bus'),
+        (other['id'], 'car')
+    ])
+
+    # Running it again changes nothing
+    run_upgrade(scope_annotation_categories)
+
+    assert read() == (categories, annotations)
+
+
+def test_interrupted_category_scoping_resumes(misplaced):
+    own, other, ids, read = misplaced
+    car, duplicate, bus = other['categories']
+    updates = []
+
+    def interrupt(conn, cursor, statement, *args):
+        if statement.startswith('UPDATE annotations'):
+            updates.append(statement)
+            if len(updates) == 2:
+                raise RuntimeError('Interrupted')
+
+    event.listen(engine, 'before_cursor_execute', interrupt)
+    try:
+        with pytest.raises(RuntimeError):
+            run_upgrade(scope_annotation_categories)
+    finally:
+        event.remove(engine, 'before_cursor_execute', interrupt)
+
+    # The batches before the failure are committed, the duplicate is still there
+    categories, annotations = read()
+    assert duplicate in categories
+    assert sum(category_id == car for category_id in annotations.values()) < 5
+
+    run_upgrade(scope_annotation_categories)
+
+    categories, annotations = read()
+    assert duplicate not in categories
+    assert all(annotations[ids[key]] == car for key in ids if key.startswith('duplicate'))
+    assert annotations[ids['foreign_car']] == own['categories'][0]
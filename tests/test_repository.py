@@ -0,0 +1,151 @@
+import pytest
+import uuid
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from src.models import Project, StoredObject
+from storage.orm import AnnotationORM, CategoryORM, ChangeORM, ImageORM
+from storage.repository import (
+    SQLModelProjectRepository,
+    SQLModelStoredObjectRepository,
+    SQLModelUserRepsitory
+)
+
+
+## Project trees
+@pytest.mark.parametrize('method', ['get_with_relationships', 'export_project_data'])
+def test_project_tree_query_count_does_not_grow(method, make_project, run_db, count_statements):
+    small = make_project(n_images=1, n_boxes=1)
+    large = make_project(n_images=30, n_boxes=20, categories=('car', 'bus', 'van'))
+
+    async def load(db, id):
+        return await getattr(SQLModelProjectRepository(db), method)(id)
+
+    counts = []
+    for project in (small, large):
+        with count_statements() as statements:
+            loaded = run_db(load, project['id'])
+
+        assert loaded
+        counts.append(len(statements))
+
+    assert counts[0] == counts[1]
+
+
+## Removal
+# Rows left of the given project and of its annotations
+async def count_rows(db, project: dict) -> dict[str, int]:
+    annotation_ids = [id for ids in project['images'].values() for id in ids]
+    counts = {}
+    for table, condition in (
+        (ImageORM, ImageORM.project_id == project['id']),
+        (CategoryORM, CategoryORM.project_id == project['id']),
+        (ChangeORM, ChangeORM.project_id == project['id']),
+        (AnnotationORM, AnnotationORM.id.in_(annotation_ids))
+    ):
+        counts[table.__tablename__] = (await db.exec(select(func.count()).select_from(table).where(condition))).one()
+
+    return counts
+
+
+@pytest.mark.parametrize('remove', ['project', 'user'])
+def test_removal_cascades_in_the_database(remove, make_project, run_db, count_statements):
+    small = make_project(n_images=1, n_boxes=1)
+    large = make_project(n_images=30, n_boxes=20, categories=('car', 'bus', 'van'))
+    assert run_db(count_rows, large) == {'images': 30, 'categories': 3, 'changes': 633, 'annotations': 600}
+
+    async def delete(db, project):
+        if remove == 'project':
+            await SQLModelProjectRepository(db).remove(project['id'])
+        else:
+            await SQLModelUserRepsitory(db).remove(project['user_id'])
+
+        await db.commit()
+
+    # Nothing under the project is loaded, however much there is
+    counts = []
+    for project in (small, large):
+        with count_statements() as statements:
+            run_db(delete, project)
+
+        counts.append(len(statements))
+        assert set(run_db(count_rows, project).values()) == {0}
+
+    assert counts[0] == counts[1]
+
+
+## Unique names
+def test_unique_insert_only_retries_name_conflicts(make_project, run_db):
+    existing = make_project(n_images=0)
+    names = iter(['first', 'second'])
+
+    # Another name is tried only when the name itself is taken, any other conflict is raised
+    async def add(db):
+        project = Project('', id=existing['id'])
+        await SQLModelProjectRepository(db).add_unique(project, existing['user_id'], lambda: next(names))
+
+    with pytest.raises(IntegrityError):
+        run_db(add)
+
+    assert next(names) == 'second'
+
+
+## Stored objects
+def stored_object() -> StoredObject:
+    digest = uuid.uuid4().hex
+    return StoredObject(
+        f"/media/{digest}.png",
+        100,
+        100,
+        variants=[{'url': f"/media/{digest}-128.jpg", 'width': 100, 'height': 100}],
+        id=digest
+    )
+
+
+def test_references_are_counted_and_released_together(run_db):
+    obj = stored_object()
+
+    async def scenario(db):
+        repo = SQLModelStoredObjectRepository(db)
+        await repo.add(obj)
+        await repo.acquire([obj, obj])
+        await repo.acquire([obj])
+        refcount = (await repo.get_many([obj.id]))[obj.id].refcount
+
+        kept = await repo.release([obj.id, obj.id])
+        removed = await repo.release([obj.id])
+        await db.commit()
+
+        return refcount, kept, removed, await repo.get_many([obj.id])
+
+    refcount, kept, removed, remaining = run_db(scenario)
+
+    assert refcount == 3
+    assert kept == []
+    assert removed == [obj.url, obj.variants[0]['url']]
+    assert remaining == {}
+
+
+def test_acquire_recreates_an_object_released_after_it_was_read(run_db):
+    obj = stored_object()
+
+    async def scenario(db):
+        repo = SQLModelStoredObjectRepository(db)
+        await repo.add(obj)
+        await repo.acquire([obj])
+        await db.commit()
+
+        # Read by an upload, then released by a delete before the upload takes its reference
+        seen = (await repo.get_many([obj.id]))[obj.id]
+        unreferenced = await repo.release([obj.id])
+        await repo.acquire([seen])
+        await db.commit()
+
+        return unreferenced, await repo.get_many([obj.id]), await repo.get_referenced_urls(unreferenced)
+
+    unreferenced, stored, referenced = run_db(scenario)
+
+    assert stored[obj.id].refcount == 1
+    # The queued storage delete skips the urls that are referenced again
+    assert referenced == set(unreferenced)
@@ -0,0 +1,171 @@
+import asyncio
+import httpx
+import io
+import mmap
+import pytest
+
+from PIL import Image as PILImage
+from storage.backends import LocalStorage
+from storage.cache import DiskCache
+from utils import HTTPClient, ImageProcessor, ImageUtil
+
+
+class MemoryStorage:
+    def __init__(self, files: dict[str, bytes]) -> None:
+        self.files = files
+
+    def owns(self, url: str) -> bool:
+        return True
+
+    async def fetch(self, url: str) -> bytes:
+        return self.files[url]
+
+
+class MemoryObjectRepository:
+    def __init__(self) -> None:
+        self.objects = {}
+        self.acquired = []
+
+    async def get_many(self, ids: list[str]) -> dict:
+        return {id: self.objects[id] for id in ids if id in self.objects}
+
+    async def add(self, stored_object) -> str:
+        self.objects[stored_object.id] = stored_object
+
+        return stored_object.id
+
+    async def acquire(self, objects: list) -> None:
+        self.acquired += [stored_object.id for stored_object in objects]
+
+
+def png(width: int, height: int) -> bytes:
+    content = io.BytesIO()
+    PILImage.new('RGB', (width, height), 'red').save(content, 'PNG')
+
+    return content.getvalue()
+
+
+## Image cache
+def test_streamed_images_are_unmapped_once_consumed(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024 * 1024)
+    img_util = ImageUtil(storage=MemoryStorage({'a': b'first', 'b': b'second'}), cache=cache)
+
+    async def stream() -> list:
+        # The first pass fills the cache, the second one reads mapped files
+        for _ in range(2):
+            seen = []
+            async for content in img_util.stream_images(['a', 'b'], concurrency=1):
+                seen.append((content, bytes(content)))
+
+        return seen
+
+    seen = asyncio.run(stream())
+
+    assert [data for _, data in seen] == [b'first', b'second']
+    assert all(isinstance(content, mmap.mmap) and content.closed for content, _ in seen)
+    assert cache.hits == 2
+
+
+## Fetching
+def test_urls_outside_the_storage_are_fetched_over_http(tmp_path):
+    (tmp_path / 'local.png').write_bytes(b'local')
+    requested = []
+
+    def respond(request: httpx.Request) -> httpx.Response:
+        requested.append(str(request.url))
+
+        return httpx.Response(200, content=b'remote')
+
+    http = HTTPClient(10, 10, 5.0, 10, 5.0, transport=httpx.MockTransport(respond))
+    img_util = ImageUtil(storage=LocalStorage(str(tmp_path), '/media'), cache=None, http=http)
+    remote_url = 'https://res.cloudinary.com/demo/image/upload/demo/d1.png'
+
+    async def fetch():
+        try:
+            return await img_util.fetch_images(['/media/local.png', remote_url])
+        finally:
+            await http.close()
+
+    fetched, failed = asyncio.run(fetch())
+
+    assert fetched == {'/media/local.png': b'local', remote_url: b'remote'}
+    assert failed == []
+    assert requested == [remote_url]
+
+
+## Variants
+def test_configured_variant_sizes_are_rendered_and_stored(tmp_path):
+    # Sizes at or above the longest side of the image are skipped
+    processor = ImageProcessor(1, [64, 16, 200, 1024])
+    img_util = ImageUtil(storage=LocalStorage(str(tmp_path), '/media'), cache=None, processor=processor)
+    object_repo = MemoryObjectRepository()
+
+    try:
+        stored, failed = asyncio.run(img_util.store_images(object_repo, [('a.png', png(200, 100), 'image/png')]))
+    finally:
+        processor.close()
+
+    assert failed == []
+    image, = stored
+    assert (image['width'], image['height']) == (200, 100)
+    assert [(v['width'], v['height']) for v in image['variants']] == [(16, 8), (64, 32)]
+    assert [v['url'] for v in image['variants']] == [
+        f"/media/FASTAPI/objects/{image['digest']}-{size}.jpeg" for size in (16, 64)
+    ]
+    for variant in image['variants']:
+        with PILImage.open(tmp_path / variant['url'].removeprefix('/media/')) as img:
+            assert (img.format, img.size) == ('JPEG', (variant['width'], variant['height']))
+
+    assert object_repo.acquired == [image['digest']]
+
+
+def test_images_that_cannot_be_decoded_are_reported_as_failed(tmp_path):
+    processor = ImageProcessor(1, [16])
+    img_util = ImageUtil(storage=LocalStorage(str(tmp_path), '/media'), cache=None, processor=processor)
+    object_repo = MemoryObjectRepository()
+    files = [('broken.png', b'not an image', 'image/png'), ('a.png', png(32, 32), 'image/png')]
+
+    try:
+        with pytest.raises(ValueError, match='Invalid image file'):
+            asyncio.run(processor.render(b'not an image'))
+
+        stored, failed = asyncio.run(img_util.store_images(object_repo, files))
+    finally:
+        processor.close()
+
+    # Nothing of the broken file reaches the storage, the other one is kept
+    assert failed == ['broken.png']
+    assert [image['filename'] for image in stored] == ['a.png']
+    assert len(object_repo.objects) == 1
+    assert sorted(path.name for path in tmp_path.rglob('*.*')) == sorted(
+        [f"{stored[0]['digest']}.png", f"{stored[0]['digest']}-16.jpeg"]
+    )
+
+
+## Retries
+@pytest.mark.parametrize('error, attempts', [
+    (httpx.ConnectError('refused'), 3),
+    (OSError('disk full'), 3),
+    (503, 3),
+    (429, 3),
+    (404, 1),
+    (RuntimeError('Unexpected response: error'), 1),
+    (ValueError('Invalid image file'), 1)
+])
+def test_only_transient_failures_are_retried(error, attempts):
+    calls = []
+
+    async def transfer():
+        calls.append(1)
+        if isinstance(error, int):
+            response = httpx.Response(error, request=httpx.Request('POST', 'https://api.example.com'))
+            response.raise_for_status()
+
+        raise error
+
+    img_util = ImageUtil(storage=MemoryStorage({}), cache=None, retries=3, backoff_base=0)
+
+    with pytest.raises(Exception):
+        asyncio.run(img_util._retry(transfer, 'a.png'))
+
+    assert len(calls) == attempts
@@ -1,30 +1,29 @@
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
+import json
+import base64
 import logging
 import string
 import random
 import asyncio
 import hashlib
-import time
 import httpx
 
-from src.models import Image
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Container
+from src.models import Image, StoredObject
 from fastapi_app import settings
+from storage.backends import ImageStorage, CloudinaryStorage, LocalStorage, read_content, render_variants
+from storage.cache import DiskCache, close_content
+from storage.repository import StoredObjectRepository
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Cloudinary configuration
-cloudinary.config(
-    cloud_name=settings.cloudinary_cloud_name,
-    api_key=settings.cloudinary_api_key,
-    api_secret=settings.cloudinary_api_secret
-)
-
 
-def generate_unique_name(str_list: list[str], affix: str) -> str:
+def generate_unique_name(str_list: Container[str], affix: str) -> str:
     str_len = 5
     random_name = affix + '-' + ''.join(random.choices(string.ascii_lowercase, k=str_len))
     while random_name in str_list:
@@ -33,128 +32,468 @@ def generate_unique_name(str_list: list[str], affix: str) -> str:
     return random_name
 
 
-class ImageUtil:
-    def __init__(self, retries: int = 1) -> None:
-        self.retries = retries
+# Cursors are opaque to clients, they carry the (created_at, id) key of the last row
+def encode_cursor(key: tuple[datetime, str] | None) -> str | None:
+    if key is None:
+        return None
 
-    async def upload_images(self, files: list[tuple], folder: str) -> list[dict]:
-        async def upload(client: httpx.AsyncClient, file: tuple):
-            cloud_name=settings.cloudinary_cloud_name
-            api_key=settings.cloudinary_api_key
-            api_secret=settings.cloudinary_api_secret
-            timestamp = str(int(time.time()))
-
-            # Build signature string
-            params_to_sign = f"folder={folder}&public_id={file[0]}&timestamp={timestamp}{api_secret}"
-            signature = hashlib.sha1(params_to_sign.encode("utf-8")).hexdigest()
-
-            upload_url = f"https://api.cloudinary.com/v1_1/{cloud_name}/image/upload"
-            data = {
-                "api_key": api_key,
-                "timestamp": timestamp,
-                "public_id": file[0],
-                "folder": folder,
-                "signature": signature,
-            }
-
-            response = await client.post(upload_url, data=data, files={"file": file})
-            response.raise_for_status()
+    created_at, id = key
+
+    return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), id]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str | None) -> tuple[datetime, str] | None:
+    if not cursor:
+        return None
+
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+        return datetime.fromisoformat(created_at), str(id)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    # If-None-Match uses the weak comparison
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+# Content-addressed objects shared by every project that uploads the same bytes
+OBJECTS_FOLDER = 'FASTAPI/objects'
+
+
+def hash_content(content) -> str:
+    digest = hashlib.sha256()
+    if hasattr(content, 'read'):
+        # Hash spooled uploads in chunks instead of loading them whole
+        content.seek(0)
+        for chunk in iter(lambda: content.read(1024 * 1024), b''):
+            digest.update(chunk)
+        content.seek(0)
+    else:
+        digest.update(content)
+
+    return digest.hexdigest()
+
+
+# Unseekable sink for zipfile.ZipFile: entries are written with data descriptors,
+# so the archive can be drained and sent while it is still being built
+class ZipStream:
+    def __init__(self) -> None:
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+
+        return data
+
+
+# One pooled client per process, opened and closed by the app lifespan.
+# The semaphore caps in-flight transfers across all requests of the worker.
+class HTTPClient:
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        max_in_flight: int,
+        timeout: float,
+        http2: bool = False,
+        transport: httpx.AsyncBaseTransport | None = None
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.http2 = http2
+        self.transport = transport
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Started lazily so the utilities also work outside of the app lifespan
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=httpx.Timeout(self.timeout),
+                http2=self.http2,
+                transport=self.transport
+            )
+
+        return self._client
+
+    async def start(self) -> None:
+        _ = self.client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[httpx.AsyncClient]:
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                yield self.client
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        connections = []
+        queued_requests = 0
+        if self._client is not None:
+            pool = getattr(self._client._transport, '_pool', None)
+            connections = getattr(pool, 'connections', [])
+            queued_requests = len(getattr(pool, '_requests', []))
+
+        idle = sum(1 for conn in connections if conn.is_idle())
+
+        return {
+            'http2': self.http2,
+            'max_connections': self.limits.max_connections,
+            'max_keepalive_connections': self.limits.max_keepalive_connections,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'connections': len(connections),
+            'active_connections': len(connections) - idle,
+            'idle_connections': idle,
+            'queued_requests': queued_requests
+        }
+
+
+# Decoding and resizing is CPU bound, so it runs in a pool of worker processes
+# instead of the event loop; without processes it falls back to a thread
+class ImageProcessor:
+    def __init__(self, processes: int, sizes: list[int]) -> None:
+        self.processes = processes
+        self.sizes = sizes
+        self._executor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor | None:
+        if self._executor is None and self.processes > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        return self._executor
+
+    async def render(self, content: bytes) -> list[tuple[int, bytes, int, int]]:
+        if not self.sizes:
+            return []
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, render_variants, content, self.sizes)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+def create_http_client() -> HTTPClient:
+    transport = None
+    if settings.storage_backend == 'fake':
+        from storage.fake_cloudinary import app as fake_cloudinary_app
+
+        transport = httpx.ASGITransport(app=fake_cloudinary_app)
+
+    return HTTPClient(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry,
+        max_in_flight=settings.http_max_in_flight,
+        timeout=settings.http_timeout,
+        http2=settings.http2,
+        transport=transport
+    )
+
+
+def create_image_storage(http_client: HTTPClient) -> ImageStorage:
+    if settings.storage_backend == 'local':
+        return LocalStorage(settings.local_storage_dir, settings.local_storage_url)
+
+    api_url = settings.cloudinary_api_url
+    if settings.storage_backend == 'fake':
+        from storage.fake_cloudinary import FAKE_CLOUDINARY_URL
 
-            return response.json()
+        api_url = FAKE_CLOUDINARY_URL
 
+    return CloudinaryStorage(
+        http_client,
+        cloud_name=settings.cloudinary_cloud_name,
+        api_key=settings.cloudinary_api_key,
+        api_secret=settings.cloudinary_api_secret,
+        api_url=api_url
+    )
+
+
+http_client = create_http_client()
+image_storage = create_image_storage(http_client)
+image_cache = (
+    DiskCache(settings.image_cache_dir, settings.image_cache_max_bytes)
+    if settings.image_cache_max_bytes > 0
+    else None
+)
+image_processor = ImageProcessor(settings.image_processes, settings.image_variant_sizes)
+
+
+class ImageUtil:
+    def __init__(
+        self,
+        storage: ImageStorage = image_storage,
+        cache: DiskCache | None = image_cache,
+        processor: ImageProcessor = image_processor,
+        http: HTTPClient = http_client,
+        retries: int = settings.transfer_retries,
+        backoff_base: float = settings.transfer_backoff_base,
+        backoff_max: float = settings.transfer_backoff_max
+    ) -> None:
+        self.storage = storage
+        self.cache = cache
+        self.processor = processor
+        self.http = http
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    async def _retry(self, transfer: Callable[[], Awaitable], name: str):
         attempt = 0
-        while attempt < self.retries:
+        while True:
             try:
-                logger.info(f"Uploading image to folder: {folder}")
-
-                async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as client:
-                    tasks = [upload(client, file) for file in files]
-                    responses = await asyncio.gather(*tasks)
-
-                logger.info("Images uploaded successfully")
-
-                return [
-                    {
-                        'url': response['secure_url'],
-                        'filename': file[0],
-                        'width': response['width'],
-                        'height': response['height']
-                    }
-                    for file, response in zip(files, responses)
-                ]
+                return await transfer()
             except Exception as e:
                 attempt += 1
-                logger.warning(f"Upload attempt {attempt} failed: {e}")
-                if not (attempt < self.retries):
-                    logger.error(f"Failed to upload image after {self.retries} attempts.")
+                # Only network failures, server errors and throttling may succeed on a
+                # retry, a malformed or unexpected response fails the same way again
+                if isinstance(e, httpx.HTTPStatusError):
+                    status_code = e.response.status_code
+                    retryable = status_code >= 500 or status_code == 429
+                else:
+                    retryable = isinstance(e, (httpx.TransportError, OSError))
+
+                if not retryable or attempt >= self.retries:
+                    logger.error(f"Transfer of {name} failed after {attempt} attempts: {e}")
                     raise
 
+                # Exponential backoff with full jitter
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                logger.warning(f"Transfer attempt {attempt} of {name} failed: {e}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
 
-    async def fetch_images(self, urls: list[str]) -> list[httpx.Response]:
-        async def fetch(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    async def _download(self, url: str) -> bytes:
+        async with self.http.slot() as client:
             response = await client.get(url)
             response.raise_for_status()
 
-            return response
+        return response.content
 
-        attempt = 0
-        while attempt < self.retries:
-            try:
-                logger.info(f"Fetching images")
+    async def _fetch(self, url: str) -> bytes:
+        # Read-through the disk cache, cached content comes back memory-mapped
+        if self.cache is not None:
+            content = await self.cache.get(url)
+            if content is not None:
+                return content
 
-                async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as client:
-                    tasks = [fetch(client, url) for url in urls]
-                    responses = await asyncio.gather(*tasks)
+        fetch = self.storage.fetch if self.storage.owns(url) else self._download
+        content = await self._retry(lambda: fetch(url), url)
+        if self.cache is not None:
+            await self.cache.put(url, content)
 
-                logger.info("Images uploaded successfully")
+        return content
 
-                return responses
-            except Exception as e:
-                attempt += 1
-                logger.warning(f"Fetch attempt {attempt} failed: {e}")
-                if not (attempt < self.retries):
-                    logger.error(f"Failed to download images after {self.retries} attempts.")
-                    raise
+    async def upload_images(self, files: list[tuple], folder: str) -> tuple[list[dict], list[str]]:
+        logger.info(f"Uploading images to folder: {folder}")
 
+        tasks = [
+            self._retry(lambda file=file: self.storage.upload(file, folder), file[0])
+            for file in files
+        ]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
 
-    def delete_image(self, image: Image) -> None:
-        attempt = 0
-        while attempt < self.retries:
-            try:
-                public_id = image.url.rsplit('/', 3)[1:]
-                public_id = '/'.join(public_id).rsplit('.', 1)[0]
-
-                logger.info(f"Deleting image: {public_id}")
-                response = cloudinary.uploader.destroy(public_id)
-                if response.get("result") == "ok":
-                    logger.info(f"Image deleted successfully: {public_id}")
-                    break
-                else:
-                    logger.warning(f"Unexpected response for {public_id}: {response}")
-                    raise Exception('Unexpected response')
-            except Exception as e:
-                attempt += 1
-                logger.warning(f"Attempt {attempt} failed for {public_id}: {e}")
-                if not (attempt < self.retries):
-                    logger.error(f"Failed to delete image {public_id} after {self.retries} attempts.")
-                    raise
+        uploaded = []
+        failed = []
+        for file, response in zip(files, responses):
+            if isinstance(response, Exception):
+                failed.append(file[0])
+            else:
+                uploaded.append({**response, 'filename': file[0]})
 
-    def delete_all(self, folder: str) -> None:
-        attempt = 0
-        while attempt < self.retries:
+        logger.info(f"Uploaded {len(uploaded)} images, {len(failed)} failed")
+
+        return uploaded, failed
+
+    async def _store_object(self, file: tuple) -> StoredObject:
+        # The original and its downscaled variants are stored side by side under the digest
+        digest = file[0]
+        content = await asyncio.to_thread(read_content, file)
+        variants = await self.processor.render(content)
+
+        files = [(digest, content, file[2])] + [
+            (f"{digest}-{size}", variant, 'image/jpeg')
+            for size, variant, _, _ in variants
+        ]
+        responses = await asyncio.gather(*[
+            self._retry(lambda file=file: self.storage.upload(file, OBJECTS_FOLDER), file[0])
+            for file in files
+        ])
+
+        return StoredObject(
+            url=responses[0]['url'],
+            width=responses[0]['width'],
+            height=responses[0]['height'],
+            variants=[
+                {'url': response['url'], 'width': response['width'], 'height': response['height']}
+                for response in responses[1:]
+            ],
+            id=digest
+        )
+
+    async def store_images(
+        self,
+        object_repo: StoredObjectRepository,
+        files: list[tuple]
+    ) -> tuple[list[dict], list[str]]:
+        # Only content that is not stored yet is uploaded, every stored image takes a
+        # reference on its object which is released when the image is removed
+        digests = [await asyncio.to_thread(hash_content, file[1]) for file in files]
+        stored_objects = await object_repo.get_many(digests)
+
+        new_files = {}
+        for file, digest in zip(files, digests):
+            if digest not in stored_objects and digest not in new_files:
+                new_files[digest] = (digest, file[1], file[2])
+
+        logger.info(f"{len(files) - len(new_files)} of {len(files)} images are already stored")
+
+        results = await asyncio.gather(
+            *[self._store_object(file) for file in new_files.values()],
+            return_exceptions=True
+        )
+        for digest, result in zip(new_files, results):
+            if isinstance(result, Exception):
+                logger.error(f"Storing {digest} failed: {result}")
+            else:
+                _ = await object_repo.add(result)
+                stored_objects[digest] = result
+
+        stored = []
+        failed = []
+        for file, digest in zip(files, digests):
+            stored_object = stored_objects.get(digest)
+            if stored_object is None:
+                failed.append(file[0])
+                continue
+
+            stored.append({
+                'url': stored_object.url,
+                'width': stored_object.width,
+                'height': stored_object.height,
+                'filename': file[0],
+                'digest': digest,
+                'variants': stored_object.variants
+            })
+
+        await object_repo.acquire([stored_objects[img['digest']] for img in stored])
+
+        return stored, failed
+
+    async def fetch_images(self, urls: list[str]) -> tuple[dict[str, bytes], list[str]]:
+        logger.info("Fetching images")
+
+        tasks = [self._fetch(url) for url in urls]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
+
+        fetched = {}
+        failed = []
+        for url, response in zip(urls, responses):
+            if isinstance(response, Exception):
+                failed.append(url)
+            else:
+                fetched[url] = response
+
+        logger.info(f"Fetched {len(fetched)} images, {len(failed)} failed")
+
+        return fetched, failed
+
+    async def stream_images(
+        self,
+        urls: list[str],
+        concurrency: int = 8
+    ) -> AsyncIterator[bytes | None]:
+        async def fetch(url: str) -> bytes | None:
             try:
-                logger.info(f"Deleting images")
-                response = cloudinary.api.delete_resources_by_prefix(folder + "/")
-                print(response)
-                if "deleted" in response:
-                    logger.info("Images deleted successfully")
-                    break
-                else:
-                    logger.warning("Unexpected response")
-                    raise Exception('Unexpected response')
-            except Exception as e:
-                attempt += 1
-                logger.warning(f"Attempt {attempt} failed")
-                if not (attempt < self.retries):
-                    logger.error(f"Failed to delete images after attempts.")
-                    raise
+                return await self._fetch(url)
+            except Exception:
+                return None
+
+        # Yield in order while keeping at most `concurrency` downloads in flight;
+        # images that could not be fetched are yielded as None. Cached images are
+        # unmapped once the next one is requested, so each must be used before that
+        pending = deque()
+        try:
+            for url in urls:
+                pending.append(asyncio.create_task(fetch(url)))
+                if len(pending) < concurrency:
+                    continue
+
+                content = await pending.popleft()
+                try:
+                    yield content
+                finally:
+                    close_content(content)
+
+            while pending:
+                content = await pending.popleft()
+                try:
+                    yield content
+                finally:
+                    close_content(content)
+        finally:
+            for task in pending:
+                task.cancel()
+                if task.done() and not task.cancelled():
+                    close_content(task.result())
+
+    async def delete_image(self, image: Image) -> None:
+        logger.info(f"Deleting image: {image.url}")
+        await self._retry(lambda: self.storage.delete(image.url), image.url)
+
+    async def delete_urls(self, urls: list[str]) -> None:
+        if self.cache is not None:
+            for url in urls:
+                await self.cache.discard(url)
+
+        results = await asyncio.gather(
+            *[self._retry(lambda url=url: self.storage.delete(url), url) for url in urls],
+            return_exceptions=True
+        )
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+    async def delete_all(self, folder: str) -> None:
+        logger.info(f"Deleting images in folder: {folder}")
+        await self._retry(lambda: self.storage.delete_prefix(folder), folder)